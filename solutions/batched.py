@@ -0,0 +1,192 @@
+import os
+import numpy as np
+import pyopencl as cl
+from collections import OrderedDict
+from oclutils import Ocl
+from filters import gaussian_kernel, device_gaussian
+from rotation import Gpurotation
+
+
+class Batched2D:
+    """
+    Helper class for 2D operators applied to stacks of frames (n_frames, Nr, Nc) on GPU.
+    All the frames of a stack are processed in a single launch : the third dimension of the grid is the frame index.
+    For stacks of many small frames, this avoids the launch overhead of one kernel call per frame.
+
+    The methods accept a numpy array (a single frame (Nr, Nc) or a stack (n_frames, Nr, Nc)), or a device buffer
+    with its shape. Numpy inputs give numpy arrays ; device buffers give the output device buffer and the event
+    of the last kernel, so that the result can be used by other kernels without transfer.
+    """
+
+    def __init__(self, device=None, program_dir=None, ocl=None, max_filters=8):
+        """
+        @param device : (optional) device in the format (0, 0)
+        @param program_dir : (optional) directory of the OpenCL programs
+        @param ocl : (optional) existing Ocl instance
+        @param max_filters : (optional) maximum number of 2D filters (non-separable convolution) kept on the device
+        """
+        self.ocl = ocl if ocl is not None else Ocl(device=device)
+        self.program_dir = program_dir if program_dir is not None else "opencl"
+        self.kernels = {}
+        for fname, names in [
+            ("binning.cl", ["binning2_batched"]),
+            ("histogram.cl", ["histogram256_batched"]),
+            ("separable_nonseparable.cl", ["horizontal_convolution_batched", "vertical_convolution_batched", "nonseparable_convolution_batched"]),
+        ]:
+            program = self.ocl.compile_file(os.path.join(self.program_dir, fname))
+            for name in names:
+                self.kernels[name] = self.ocl.kernel(program, name)
+        self.rotations = {} # frame shape -> Gpurotation
+        self.filters = OrderedDict() # sigma -> (device buffer of the 2D filter, filter size), the least recently used first
+        self.max_filters = max_filters
+
+
+    @staticmethod
+    def stack_shape(shape):
+        """
+        Return the shape (n_frames, Nr, Nc) of a frame or a stack of frames
+        """
+        shape = tuple(shape)
+        if len(shape) == 2:
+            return (1,) + shape
+        if len(shape) != 3:
+            raise ValueError("Batched2D: expected a frame (Nr, Nc) or a stack (n_frames, Nr, Nc), got shape %s" % str(shape))
+        return shape
+
+
+    def prepare(self, data, shape, dtype):
+        """
+        Return the device buffer of the input, its stack shape, and whether the input was transferred from the host
+        """
+        if isinstance(data, cl.Buffer):
+            if shape is None:
+                shape = self.ocl.buffer_type(data, "Batched2D")[0]
+            return data, Batched2D.stack_shape(shape), False
+        data = np.ascontiguousarray(Ocl.check_array(data), dtype=dtype)
+        stack = Batched2D.stack_shape(data.shape)
+        return self.ocl.to_device(data, flags="r"), stack, True
+
+
+    def finish(self, d_input, d_output, ev, on_host, out_shape, dtype=np.float32):
+        """
+        Return the result : a numpy array of shape out_shape if the input was on the host, otherwise (d_output, ev)
+        """
+        if not on_host:
+            return d_output, ev
+        res = self.ocl.fetch(d_output, dest=np.empty(out_shape, dtype=dtype), wait_for=[ev])
+        self.ocl.release_buffer(d_input)
+        self.ocl.release_buffer(d_output)
+        return res
+
+
+    def binning2(self, data, shape=None, wait_for=None):
+        """
+        2x2 binning of each frame.
+
+        @param data : numpy array (Nr, Nc) or (n_frames, Nr, Nc), or float32 device buffer
+        @param shape : (optional) shape of the data in the device buffer
+        @param wait_for : (optional) list of events to wait for
+        """
+        d_input, (n_frames, Nr, Nc), on_host = self.prepare(data, shape, np.float32)
+        if (Nr % 2) or (Nc % 2):
+            raise ValueError("binning2(): the frame size must be even, got (%d, %d)" % (Nr, Nc))
+        Nr2, Nc2 = Nr//2, Nc//2
+        d_output = self.ocl.create_buffer((n_frames, Nr2, Nc2), np.float32)
+        ev = self.ocl.call(self.kernels["binning2_batched"], (Nc2, Nr2, n_frames), None, d_input, d_output, Nr2, Nc2, n_frames,
+                           wait_for=wait_for, nbytes=n_frames*Nr*Nc*4*5//4)
+        out_shape = (Nr2, Nc2) if (on_host and np.ndim(data) == 2) else (n_frames, Nr2, Nc2)
+        return self.finish(d_input, d_output, ev, on_host, out_shape)
+
+
+    def histogram256(self, data, shape=None, wait_for=None):
+        """
+        256-bins histogram of each frame, for values in [0, 255]. The histograms are int32, of shape (n_frames, 256).
+
+        @param data : numpy array (Nr, Nc) or (n_frames, Nr, Nc), or int32 device buffer
+        @param shape : (optional) shape of the data in the device buffer
+        @param wait_for : (optional) list of events to wait for
+        """
+        d_input, (n_frames, Nr, Nc), on_host = self.prepare(data, shape, np.int32)
+        d_hist = self.ocl.create_buffer_zeros((n_frames, 256), np.int32)
+        ev = self.ocl.call(self.kernels["histogram256_batched"], (Nc, Nr, n_frames), None, d_input, d_hist, Nr, Nc, n_frames,
+                           wait_for=wait_for, nbytes=n_frames*Nr*Nc*4)
+        out_shape = (256,) if (on_host and np.ndim(data) == 2) else (n_frames, 256)
+        return self.finish(d_input, d_hist, ev, on_host, out_shape, dtype=np.int32)
+
+
+    def rotate(self, data, angles, shape=None, center=None, wait_for=None):
+        """
+        Rotate each frame by its own angle. A single frame is rotated by all the angles.
+        The result has shape (n_angles, Nr, Nc).
+
+        @param data : numpy array (Nr, Nc) or (n_frames, Nr, Nc), or float32 device buffer
+        @param angles : rotation angles in radians, one for each output frame
+        @param shape : (optional) shape of the data in the device buffer
+        @param center : (optional) center (x, y) of the rotation. Default is the center of the frames.
+        @param wait_for : (optional) list of events to wait for
+        """
+        d_input, (n_frames, Nr, Nc), on_host = self.prepare(data, shape, np.float32)
+        if (Nr, Nc) not in self.rotations:
+            self.rotations[(Nr, Nc)] = Gpurotation((Nr, Nc), ocl=self.ocl, program_path=os.path.join(self.program_dir, "rotation.cl"))
+        matrices = Gpurotation.rotation_matrices(angles, (Nr, Nc), center)
+        d_output, ev = self.rotations[(Nr, Nc)].transform_device(d_input, n_frames, matrices, wait_for=wait_for)
+        return self.finish(d_input, d_output, ev, on_host, (matrices.shape[0], Nr, Nc))
+
+
+    def get_filter(self, sigma, separable=True):
+        """
+        Return the device buffer of the Gaussian filter and its size.
+        The 1D filters come from the FilterCache of the Ocl instance (see filters.device_gaussian()). The 2D filters
+        are transferred once for each sigma, and the least recently used are released beyond max_filters.
+        """
+        if separable:
+            return device_gaussian(self.ocl, sigma)
+        key = float(sigma)
+        if key in self.filters:
+            self.filters.move_to_end(key)
+            return self.filters[key]
+        gaussian = gaussian_kernel(sigma)
+        gaussian2 = np.outer(gaussian, gaussian).astype(np.float32)
+        self.filters[key] = (self.ocl.to_device(gaussian2, flags="r"), gaussian.shape[0])
+        while len(self.filters) > self.max_filters:
+            old_key, (d_old, size) = self.filters.popitem(last=False)
+            self.ocl.release_buffer(d_old)
+        return self.filters[key]
+
+
+    def release(self):
+        """
+        Release the device buffers of the 2D filters
+        """
+        for d_id, size in self.filters.values():
+            self.ocl.release_buffer(d_id)
+        self.filters.clear()
+
+
+    def gaussian_filter(self, data, sigma, shape=None, separable=True, wait_for=None):
+        """
+        2D Gaussian filter of each frame, with the same boundary handling as scipy.ndimage.gaussian_filter.
+
+        @param data : numpy array (Nr, Nc) or (n_frames, Nr, Nc), or float32 device buffer
+        @param sigma : standard deviation of the Gaussian
+        @param shape : (optional) shape of the data in the device buffer
+        @param separable : (optional) if False, use the non-separable 2D convolution
+        @param wait_for : (optional) list of events to wait for
+        """
+        d_input, (n_frames, Nr, Nc), on_host = self.prepare(data, shape, np.float32)
+        d_gaussian, ksize = self.get_filter(sigma, separable)
+        d_output = self.ocl.create_buffer((n_frames, Nr, Nc), np.float32)
+        grid = (Nc, Nr, n_frames)
+        nbytes = n_frames*Nr*Nc*8
+        if separable:
+            d_tmp = self.ocl.create_buffer((n_frames, Nr, Nc), np.float32)
+            ev = self.ocl.call(self.kernels["horizontal_convolution_batched"], grid, None, d_input, d_tmp, d_gaussian, ksize, Nc, Nr, n_frames,
+                               wait_for=wait_for, nbytes=nbytes, flops=2*ksize*n_frames*Nr*Nc)
+            ev = self.ocl.call(self.kernels["vertical_convolution_batched"], grid, None, d_tmp, d_output, d_gaussian, ksize, Nc, Nr, n_frames,
+                               wait_for=[ev], nbytes=nbytes, flops=2*ksize*n_frames*Nr*Nc)
+            self.ocl.release_buffer(d_tmp)
+        else:
+            ev = self.ocl.call(self.kernels["nonseparable_convolution_batched"], grid, None, d_input, d_output, d_gaussian, ksize, Nc, Nr, n_frames,
+                               wait_for=wait_for, nbytes=nbytes, flops=2*ksize*ksize*n_frames*Nr*Nc)
+        out_shape = (Nr, Nc) if (on_host and np.ndim(data) == 2) else (n_frames, Nr, Nc)
+        return self.finish(d_input, d_output, ev, on_host, out_shape)
@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the solution kernels against their NumPy/SciPy counterparts.
+
+For each kernel, data size and data type, the transfers (host to device, device to host)
+and the kernels are timed separately with the OpenCL profiling events, after a few warm-up runs.
+The results are saved in a JSON file, and can be compared to a previous run :
+
+    python benchmark.py --device 0,0 --output results.json
+    python benchmark.py --device 0,0 --baseline results.json
+
+The benchmark only needs a CPU OpenCL implementation (for eg. pocl) and does not display anything.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+import scipy.ndimage
+from oclutils import Ocl
+from convol import Gpuconvol, scipy_gaussianfilter
+from filters import comp_kern_scipy
+from binning import mybin2
+from histogram import myhist256
+from rotation import Gpurotation
+from flatfield import FlatField, myflatfield
+
+
+OPENCL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "opencl")
+
+
+def test_image(shape, dtype=np.float32, seed=0):
+    """
+    Synthetic test image : smooth structures plus noise, in the range [0, 255].
+    """
+    rng = np.random.RandomState(seed)
+    grids = np.meshgrid(*[np.linspace(0, 4*np.pi, n) for n in shape], indexing="ij")
+    img = 127.5 * (1 + np.sin(sum(grids)) * np.cos(grids[-1] / 2))
+    img = 0.8*img + 0.2*255*rng.rand(*shape)
+    return img.astype(dtype)
+
+
+def percentiles(values):
+    values = np.array(values)
+    return {"median": float(np.median(values)), "p95": float(np.percentile(values, 95))}
+
+
+class Case:
+    """
+    A benchmark case : the kernel(s) and their reference implementation, for one data size and type.
+    Subclasses implement :
+        - upload() : transfer the input data to the device
+        - compute() : launch the kernel(s)
+        - download() : transfer the result to the host and return it
+        - reference() : compute the result on the host
+    The cases whose kernels only take float32 data are run for the float32 data type only (see dtypes) :
+    the other types would only be converted on the host before the transfer.
+    """
+
+    name = None
+    check = True # compare the result to the reference
+    dtypes = ("float32",) # input data types processed by the kernels, None for any type
+
+    def __init__(self, ocl, shape, dtype):
+        self.ocl = ocl
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.img = test_image(self.shape, self.dtype)
+
+
+    @classmethod
+    def case_name(cls, shape):
+        """
+        Name of the case for a data shape, known before the case is built (for the --cases filter)
+        """
+        return cls.name
+
+
+    @classmethod
+    def supports(cls, dtype):
+        return cls.dtypes is None or np.dtype(dtype).name in cls.dtypes
+
+
+    def key(self):
+        return "%s|%s|%s" % (self.name, "x".join(str(n) for n in self.shape), self.dtype.name)
+
+
+    def run(self, n_warmup, n_repeat):
+        tracer = self.ocl.tracer
+        for i in range(n_warmup):
+            self.upload(); self.compute(); self.download()
+        times = {"to_device": [], "kernel": [], "fetch": []}
+        for i in range(n_repeat):
+            tracer.clear()
+            self.upload(); self.compute(); res = self.download()
+            totals = {"to_device": 0., "kernel": 0., "fetch": 0.}
+            for r in tracer.records():
+                # Copies between device objects (for eg. buffer to image) are counted as kernel time
+                totals[r["kind"] if r["kind"] in totals else "kernel"] += (r["end"] - r["start"]) * 1e-6
+            for kind in times:
+                times[kind].append(totals[kind])
+        ref_times = []
+        for i in range(max(1, n_repeat // 2)):
+            t0 = time.perf_counter()
+            ref = self.reference()
+            ref_times.append((time.perf_counter() - t0) * 1e3)
+        tracer.clear()
+        npix = float(np.prod(self.shape))
+        kernel_ms = percentiles(times["kernel"])
+        result = {
+            "case": self.name,
+            "shape": list(self.shape),
+            "dtype": self.dtype.name,
+            "to_device_ms": percentiles(times["to_device"]),
+            "kernel_ms": kernel_ms,
+            "fetch_ms": percentiles(times["fetch"]),
+            "total_ms": percentiles(np.sum([times[k] for k in times], axis=0)),
+            "reference_ms": percentiles(ref_times),
+            "kernel_mpix_s": npix / kernel_ms["median"] * 1e-3 if kernel_ms["median"] > 0 else 0.,
+            "max_error": float(np.max(np.abs(np.asarray(res, dtype=np.float64) - ref))) if self.check else None,
+        }
+        result["speedup"] = result["reference_ms"]["median"] / result["total_ms"]["median"] if result["total_ms"]["median"] > 0 else 0.
+        return result
+
+
+
+class GaussianCase(Case):
+    """
+    Separable gaussian filter (convolution.cl), 2D or 3D
+    """
+
+    name = "gaussian_separable"
+    sigma = 2.0
+    fused = False
+
+    @classmethod
+    def case_name(cls, shape):
+        return "%s_%dd" % (cls.name, len(shape))
+
+    def __init__(self, ocl, shape, dtype):
+        Case.__init__(self, ocl, shape, dtype)
+        self.name = self.case_name(shape)
+        self.conv = Gpuconvol(shape, ocl=ocl, program_path=os.path.join(OPENCL_PATH, "convolution.cl"), fused=self.fused)
+        self.gaussian = comp_kern_scipy(self.sigma)
+        self.d_gaussian = ocl.to_device(self.gaussian, flags="r")
+
+    def upload(self):
+        self.ocl.to_device(self.img.astype(np.float32), destbuf=self.conv.d_input)
+
+    def compute(self):
+        self.d_res, ev = self.conv.convolve(self.conv.d_input, self.conv.d_output, self.conv.d_tmp, self.d_gaussian, self.gaussian.shape[0])
+
+    def download(self):
+        return self.ocl.fetch(self.d_res)
+
+    def reference(self):
+        return scipy_gaussianfilter(self.img.astype(np.float32), self.sigma)
+
+
+
+class FusedGaussianCase(GaussianCase):
+    """
+    Separable gaussian filter in a single kernel (convolution_fused.cl), 2D or 3D
+    """
+
+    name = "gaussian_fused"
+    fused = True
+
+
+
+class NonSeparableCase(Case):
+    """
+    2D non-separable gaussian filter (separable_nonseparable.cl)
+    """
+
+    name = "gaussian_nonseparable_2d"
+    sigma = 1.6
+
+    def __init__(self, ocl, shape, dtype):
+        Case.__init__(self, ocl, shape, dtype)
+        program = ocl.compile_file("separable_nonseparable.cl")
+        self.kernel = ocl.kernel(program, "nonseparable_convolution")
+        gaussian = comp_kern_scipy(self.sigma)
+        self.ksize = gaussian.shape[0]
+        self.d_gaussian = ocl.to_device(np.outer(gaussian, gaussian), flags="r")
+        self.d_input = ocl.create_buffer(shape, np.float32)
+        self.d_output = ocl.create_buffer(shape, np.float32)
+
+    def upload(self):
+        self.ocl.to_device(self.img.astype(np.float32), destbuf=self.d_input)
+
+    def compute(self):
+        Nr, Nc = self.shape
+        self.ocl.call(self.kernel, (Nc, Nr), None, self.d_input, self.d_output, self.d_gaussian, self.ksize, Nc, Nr,
+                      nbytes=2*Nr*Nc*4, flops=2*Nr*Nc*self.ksize**2)
+
+    def download(self):
+        return self.ocl.fetch(self.d_output)
+
+    def reference(self):
+        return scipy_gaussianfilter(self.img.astype(np.float32), self.sigma)
+
+
+
+class BinningCase(Case):
+    """
+    2x2 binning (binning.cl)
+    """
+
+    name = "binning2"
+
+    def __init__(self, ocl, shape, dtype):
+        Case.__init__(self, ocl, shape, dtype)
+        program = ocl.compile_file("binning.cl")
+        self.kernel = ocl.kernel(program, "binning2")
+        Nr, Nc = shape
+        self.d_input = ocl.create_buffer(shape, np.float32)
+        self.d_output = ocl.create_buffer((Nr//2, Nc//2), np.float32)
+
+    def upload(self):
+        self.ocl.to_device(self.img.astype(np.float32), destbuf=self.d_input)
+
+    def compute(self):
+        Nr2, Nc2 = self.shape[0]//2, self.shape[1]//2
+        self.ocl.call(self.kernel, (Nc2, Nr2), None, self.d_input, self.d_output, Nr2, Nc2, nbytes=5*Nr2*Nc2*4, flops=4*Nr2*Nc2)
+
+    def download(self):
+        return self.ocl.fetch(self.d_output)
+
+    def reference(self):
+        return mybin2(self.img)
+
+
+
+class HistogramCase(Case):
+    """
+    256-bins histogram (histogram.cl)
+    """
+
+    name = "histogram256"
+
+    def __init__(self, ocl, shape, dtype):
+        Case.__init__(self, ocl, shape, dtype)
+        program = ocl.compile_file("histogram.cl")
+        self.kernel = ocl.kernel(program, "histogram256")
+        self.d_input = ocl.create_buffer(shape, np.int32)
+        self.d_output = ocl.create_buffer(256, np.int32)
+        self.zeros = np.zeros(256, dtype=np.int32)
+
+    def upload(self):
+        self.ocl.to_device(self.img.astype(np.int32), destbuf=self.d_input)
+        self.ocl.to_device(self.zeros, destbuf=self.d_output)
+
+    def compute(self):
+        Nr, Nc = self.shape
+        self.ocl.call(self.kernel, (Nc, Nr), None, self.d_input, self.d_output, Nr, Nc, nbytes=Nr*Nc*4)
+
+    def download(self):
+        return self.ocl.fetch(self.d_output)
+
+    def reference(self):
+        return myhist256(self.img)
+
+
+
+class RotationCase(Case):
+    """
+    Rotation with bilinear interpolation (rotation.cl)
+    """
+
+    name = "rotation"
+    theta = 0.785
+    check = False # the rotation kernel does not follow the same conventions as scipy
+
+    def __init__(self, ocl, shape, dtype):
+        Case.__init__(self, ocl, shape, dtype)
+        program = ocl.compile_file("rotation.cl")
+        self.kernel = ocl.kernel(program, "rotation")
+        self.d_input = ocl.create_buffer(shape, np.float32)
+        self.d_output = ocl.create_buffer(shape, np.float32)
+
+    def upload(self):
+        self.ocl.to_device(self.img.astype(np.float32), destbuf=self.d_input)
+
+    def compute(self):
+        Nr, Nc = self.shape
+        self.ocl.call(self.kernel, (Nc, Nr), None, self.d_input, self.d_output, Nc, Nr, Nc//2, Nr//2, np.float32(self.theta),
+                      nbytes=5*Nr*Nc*4)
+
+    def download(self):
+        return self.ocl.fetch(self.d_output)
+
+    def reference(self):
+        return scipy.ndimage.rotate(self.img.astype(np.float32), np.rad2deg(self.theta), order=1, reshape=False)
+
+
+
+class BatchedRotationCase(Case):
+    """
+    Batch of rotations of an image in a single launch (Gpurotation)
+    """
+
+    name = "rotation_batch"
+    angles = np.linspace(0, np.pi, 16)
+
+    def __init__(self, ocl, shape, dtype):
+        Case.__init__(self, ocl, shape, dtype)
+        self.rot = Gpurotation(shape, ocl=ocl, program_path=os.path.join(OPENCL_PATH, "rotation.cl"))
+        self.matrices = Gpurotation.rotation_matrices(self.angles, shape)
+        self.d_input = ocl.create_buffer(shape, np.float32)
+        self.d_output = ocl.create_buffer((len(self.angles),) + tuple(shape), np.float32)
+
+    def upload(self):
+        self.ocl.to_device(self.img.astype(np.float32), destbuf=self.d_input)
+
+    def compute(self):
+        self.rot.transform_device(self.d_input, 1, self.matrices, d_output=self.d_output)
+
+    def download(self):
+        return self.ocl.fetch(self.d_output)
+
+    def reference(self):
+        img = self.img.astype(np.float32)
+        res = []
+        for m in self.matrices:
+            matrix = np.array([[m[1, 1], m[1, 0]], [m[0, 1], m[0, 0]]])
+            res.append(scipy.ndimage.affine_transform(img, matrix, (m[1, 2], m[0, 2]), order=1, mode="grid-constant"))
+        return np.array(res)
+
+
+
+class FlatFieldCase(Case):
+    """
+    Flat-field correction of raw frames of the input data type (flatfield.cl)
+    """
+
+    name = "flatfield"
+    dtypes = None # the raw frames are transferred in their own type
+
+    def __init__(self, ocl, shape, dtype):
+        Case.__init__(self, ocl, shape, dtype)
+        rng = np.random.RandomState(1)
+        self.dark = (10 * rng.rand(*shape)).astype(np.float32)
+        self.flat = (300 + 10 * rng.rand(*shape)).astype(np.float32)
+        self.ff = FlatField(self.dark, self.flat, ocl=ocl, program_path=os.path.join(OPENCL_PATH, "flatfield.cl"))
+        self.raw = self.ff.check_frames(self.img)
+        self.d_input = ocl.create_buffer(shape, self.raw.dtype)
+        self.d_output = ocl.create_buffer(shape, np.float32)
+
+    def upload(self):
+        self.ocl.to_device(self.raw, destbuf=self.d_input)
+
+    def compute(self):
+        self.ff.correct_device(self.d_input, 1, self.raw.dtype, d_output=self.d_output)
+
+    def download(self):
+        return self.ocl.fetch(self.d_output, dest=np.empty(self.shape, dtype=np.float32))
+
+    def reference(self):
+        return myflatfield(self.img, self.dark, self.flat)
+
+
+
+CASES_2D = [GaussianCase, FusedGaussianCase, NonSeparableCase, BinningCase, HistogramCase, RotationCase, BatchedRotationCase, FlatFieldCase]
+CASES_3D = [GaussianCase, FusedGaussianCase]
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results to a baseline. Returns the list of regressions : cases whose median total time
+    is larger than the baseline one by more than the tolerance (relative).
+    """
+    base = dict(("%s|%s|%s" % (r["case"], "x".join(str(n) for n in r["shape"]), r["dtype"]), r) for r in baseline["results"])
+    regressions = []
+    for r in results["results"]:
+        key = "%s|%s|%s" % (r["case"], "x".join(str(n) for n in r["shape"]), r["dtype"])
+        if key not in base:
+            continue
+        for field in ["kernel_ms", "total_ms"]:
+            t, t_ref = r[field]["median"], base[key][field]["median"]
+            if t_ref > 0 and t > t_ref * (1 + tolerance):
+                regressions.append("%s : %s %.3f ms (baseline %.3f ms, +%.0f%%)" % (key, field, t, t_ref, (t/t_ref - 1)*100))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the OpenCL solution kernels")
+    parser.add_argument("--device", default="0,0", help="OpenCL device as platform,device (default: 0,0)")
+    parser.add_argument("--sizes", default="256,512,1024", help="2D image sizes (default: 256,512,1024)")
+    parser.add_argument("--sizes3d", default="64,128", help="3D volume sizes (default: 64,128)")
+    parser.add_argument("--dtypes", default="float32", help="input data types, for eg. float32,uint16 (default: float32). "
+                        "The cases whose kernels only take float32 data are skipped for the other types.")
+    parser.add_argument("--cases", default=None, help="comma-separated list of cases to run (default: all)")
+    parser.add_argument("--warmup", type=int, default=2, help="number of warm-up runs (default: 2)")
+    parser.add_argument("--repeat", type=int, default=10, help="number of timed runs (default: 10)")
+    parser.add_argument("--output", default=None, help="JSON file where the results are saved")
+    parser.add_argument("--baseline", default=None, help="JSON file of a previous run, to detect regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative slowdown reported as a regression (default: 0.1)")
+    args = parser.parse_args(argv)
+
+    ocl = Ocl(device=tuple(int(i) for i in args.device.split(",")), trace=True)
+    ocl.add_program_path(OPENCL_PATH)
+    print("Running on %s (%s)" % (ocl.devicename, ocl.device.platform.name))
+
+    configs = []
+    for n in [int(n) for n in args.sizes.split(",") if n]:
+        configs += [(case, (n, n)) for case in CASES_2D]
+    for n in [int(n) for n in args.sizes3d.split(",") if n]:
+        configs += [(case, (n, n, n)) for case in CASES_3D]
+    selected = args.cases.split(",") if args.cases else None
+
+    results = {
+        "device": ocl.devicename,
+        "platform": ocl.device.platform.name,
+        "driver_version": ocl.device.driver_version,
+        "host": platform.node(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {"warmup": args.warmup, "repeat": args.repeat},
+        "results": [],
+    }
+    print("%-28s %-14s %-8s %10s %10s %10s %10s %10s %10s %10s" % ("case", "shape", "dtype", "h2d(ms)", "kernel(ms)", "k-p95(ms)", "d2h(ms)", "ref(ms)", "Mpix/s", "max err"))
+    skipped = {}
+    for case_class, shape in configs:
+        if selected and case_class.case_name(shape) not in selected:
+            continue
+        for dtype in args.dtypes.split(","):
+            if not case_class.supports(dtype):
+                names = skipped.setdefault(np.dtype(dtype).name, [])
+                if case_class.case_name(shape) not in names:
+                    names.append(case_class.case_name(shape))
+                continue
+            case = case_class(ocl, shape, dtype)
+            r = case.run(args.warmup, args.repeat)
+            results["results"].append(r)
+            print("%-28s %-14s %-8s %10.3f %10.3f %10.3f %10.3f %10.3f %10.1f %10s" % (
+                r["case"], "x".join(str(n) for n in r["shape"]), r["dtype"], r["to_device_ms"]["median"], r["kernel_ms"]["median"],
+                r["kernel_ms"]["p95"], r["fetch_ms"]["median"], r["reference_ms"]["median"], r["kernel_mpix_s"],
+                "-" if r["max_error"] is None else "%.2e" % r["max_error"]))
+            sys.stdout.flush()
+    for dtype, names in skipped.items():
+        print("Skipped for %s (float32 kernels): %s" % (dtype, ", ".join(names)))
+    results["skipped"] = skipped
+
+    if args.output:
+        with open(args.output, "w") as fid:
+            json.dump(results, fid, indent=1)
+    if args.baseline:
+        with open(args.baseline) as fid:
+            baseline = json.load(fid)
+        regressions = compare(results, baseline, args.tolerance)
+        for reg in regressions:
+            print("REGRESSION: %s" % reg)
+        if regressions:
+            return 1
+    return 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
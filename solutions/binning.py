@@ -1,22 +1,121 @@
 import numpy as np
-from oclutils import Ocl
-import matplotlib.pyplot as plt
+from oclutils import Ocl, CL_TYPES
 
 
 def mybin2(img):
     res = img.astype(np.float32)
     Nr, Nc = img.shape
-    Nr2, Nc2 = Nr/2, Nc/2
+    Nr2, Nc2 = Nr//2, Nc//2
     res = res.reshape((Nr2, 2, Nc2, 2)).sum(axis=1).sum(axis=-1)
     return res*0.25
 
 
+def mybin(data, factors, edges="truncate"):
+    """
+    Reference for Binning : average of data over blocks of size "factors" (one factor per axis).
+
+    @param edges : "truncate" to discard the incomplete blocks on the edges, "partial" to average them over the available pixels
+    """
+    data = np.asarray(data, dtype=np.float64)
+    res = data
+    for axis, f in enumerate(factors):
+        n = res.shape[axis]
+        n_out = n // f if edges == "truncate" else (n + f - 1) // f
+        starts = np.arange(n_out) * f
+        sums = np.add.reduceat(np.take(res, np.arange(min(n, n_out*f)), axis=axis), starts, axis=axis)
+        counts = np.minimum(starts + f, n) - starts
+        shape = [1] * res.ndim
+        shape[axis] = n_out
+        res = sums / counts.reshape(shape)
+    return res.astype(np.float32)
+
+
+class Binning:
+    """
+    Helper class for binning on GPU : arbitrary integer factor on each axis of 2D or 3D data,
+    incomplete blocks on the edges, and integer inputs (uint16, int32, ...) read directly by the kernel.
+    A stack of frames (n_frames, Nr, Nc) is binned frame by frame with factors (1, fy, fx).
+    """
+
+    def __init__(self, device=None, program_path=None, ocl=None):
+        """
+        @param device : (optional) device in the format (0, 0)
+        @param program_path : (optional) path of the binning program
+        @param ocl : (optional) existing Ocl instance
+        """
+        self.ocl = ocl if ocl is not None else Ocl(device=device)
+        self.program_path = program_path if program_path is not None else "opencl/binning.cl"
+        self.kernels = {}
+
+
+    def get_kernel(self, dtype):
+        dtype = np.dtype(dtype)
+        if dtype not in self.kernels:
+            program = self.ocl.compile_file(self.program_path, defines={"DTYPE": CL_TYPES[dtype]})
+            self.kernels[dtype] = self.ocl.kernel(program, "binning_nd")
+        return self.kernels[dtype]
+
+
+    @staticmethod
+    def output_shape(shape, factors, edges="truncate"):
+        if len(factors) != len(shape):
+            raise ValueError("Binning: expected %d factors, got %d" % (len(shape), len(factors)))
+        if edges == "truncate":
+            return tuple(n // f for n, f in zip(shape, factors))
+        return tuple((n + f - 1) // f for n, f in zip(shape, factors))
+
+
+    def bin_device(self, d_input, shape, dtype, factors, edges="truncate", d_output=None, wait_for=None):
+        """
+        Bin data already on the device. Returns the float32 output device buffer and the event of the kernel.
+
+        @param d_input : device buffer of the data
+        @param shape : shape of the data (2D or 3D)
+        @param dtype : data type of the data
+        @param factors : binning factor of each axis, for eg. (2, 2) or (1, 4, 4)
+        @param edges : (optional) "truncate" to discard the incomplete blocks on the edges, "partial" to average them
+        @param d_output : (optional) output device buffer
+        @param wait_for : (optional) list of events to wait for
+        """
+        out_shape = Binning.output_shape(shape, factors, edges)
+        if d_output is None:
+            d_output = self.ocl.create_buffer(out_shape, np.float32)
+        # Kernel dimensions are (x, y, z) = reversed numpy dimensions, 1 for the missing ones
+        in_w, in_h, in_z = (tuple(reversed(shape)) + (1, 1))[:3]
+        out_w, out_h, out_z = (tuple(reversed(out_shape)) + (1, 1))[:3]
+        fx, fy, fz = (tuple(reversed(factors)) + (1, 1))[:3]
+        ev = self.ocl.call(self.get_kernel(dtype), (out_w, out_h, out_z), None, d_input, d_output,
+                           in_w, in_h, in_z, out_w, out_h, out_z, fx, fy, fz, wait_for=wait_for,
+                           nbytes=int(np.prod(shape))*np.dtype(dtype).itemsize + int(np.prod(out_shape))*4)
+        return d_output, ev
+
+
+    def bin(self, data, factors, edges="truncate"):
+        """
+        Bin a 2D image, a 3D volume or a stack of frames. Returns a float32 numpy array.
+
+        @param data : numpy array. Integer types are transferred as they are, and converted on the device.
+        @param factors : binning factor of each axis, for eg. (2, 2) ; (1, 2, 2) for a stack of frames
+        @param edges : (optional) "truncate" to discard the incomplete blocks on the edges, "partial" to average them
+        """
+        data = np.asarray(data)
+        if data.dtype not in CL_TYPES:
+            data = Ocl.check_array(data)
+        d_input = self.ocl.to_device(data, flags="r")
+        d_output, ev = self.bin_device(d_input, data.shape, data.dtype, factors, edges)
+        res = self.ocl.fetch(d_output)
+        self.ocl.release_buffer(d_input)
+        self.ocl.release_buffer(d_output)
+        return res
+
+
 if __name__ == "__main__":
 
+    import matplotlib.pyplot as plt
     from scipy.misc import lena
     img = lena().astype(np.float32)
     Nr, Nc = img.shape
-    Nr2, Nc2 = Nr/2, Nc/2
+    Nr2, Nc2 = Nr//2, Nc//2
 
     # Initialize device
     ocl = Ocl(profile=True)
@@ -3,32 +3,32 @@
 
 import numpy as np
 import scipy, scipy.misc, scipy.ndimage
-import math
+import os
+import pyopencl as cl
 import time
-from oclutils import Ocl
+from collections import deque
+from oclutils import Ocl, CL_TYPES
+from fftconvol import FFTConvol, use_fft
+from filters import comp_kern_scipy, device_gaussian
 
 
 def scipy_gaussianfilter(img, sigma):
     return scipy.ndimage.gaussian_filter(img, sigma)#, mode="reflect")
 
 
-def comp_kern_scipy(sigma, truncate=4):
-    sd = float(sigma)
-    # make the radius of the filter equal to truncate standard deviations
-    lw = int(truncate * sd + 0.5)
-    weights = [0.0] * (2 * lw + 1)
-    weights[lw] = 1.0
-    sum = 1.0
-    sd = sd * sd
-    # calculate the kernel:
-    for ii in range(1, lw + 1):
-        tmp = math.exp(-0.5 * float(ii * ii) / sd)
-        weights[lw + ii] = tmp
-        weights[lw - ii] = tmp
-        sum += 2.0 * tmp
-    for ii in range(2 * lw + 1):
-        weights[ii] /= sum
-    return np.ascontiguousarray(weights)
+def storage_defines(dtype, prefix):
+    """
+    Build-time definitions of the storage type of an array in convolution_tiled.cl
+
+    @param dtype : numpy data type of the array
+    @param prefix : "INPUT" or "OUTPUT"
+    """
+    dtype = np.dtype(dtype)
+    if dtype == np.float16:
+        return {prefix + "_T": "half", prefix + "_HALF": None}
+    if dtype == np.float64:
+        return {prefix + "_T": "double"}
+    return {prefix + "_T": CL_TYPES[dtype]}
 
 
 
@@ -38,50 +38,107 @@ class Gpuconvol:
     """
 
 
-    def __init__(self, shape, device=None, program_path=None):
+    def __init__(self, shape, device=None, program_path=None, ocl=None, tiled=False, wg=None, fused=False, pre_op=None, post_op=None, storage=np.float32, fft=None):
         """
         Initialize the Gpu Convolution : context, temporary/output device arrays
         and program.
+
+        @param shape : shape of the images/volumes to be filtered
+        @param device : (optional) device in the format (0, 0)
+        @param program_path : (optional) path of the convolution program
+        @param ocl : (optional) existing Ocl instance. Instances sharing the same Ocl share
+            the context and the compiled program.
+        @param tiled : (optional) if True, use the kernels of convolution_tiled.cl (local memory tiles,
+            filter in constant memory, filter size fixed at build time)
+        @param wg : (optional) work-group size of the (non tiled) kernels. Use "auto" for the size found by Ocl.autotune().
+        @param fused : (optional) if True, use the kernels of convolution_fused.cl : the passes are done in a single kernel
+            (in 3D, when the tile fits in local memory), the intermediate results are kept in local memory.
+        @param pre_op : (optional) with fused=True, element-wise operation applied to the input, as an OpenCL expression
+            of the value x and of the pixel index i. It can use the arrays given to set_op_arrays() as a and b,
+            for eg. "(x - a[i]) / (b[i] - a[i])"
+        @param post_op : (optional) with fused=True, element-wise operation applied to the result, for eg. "2.0f*x"
+        @param storage : (optional) with tiled=True, data type of the intermediate and output arrays :
+            np.float16 halves the memory traffic of the passes (the computations are still done in float32),
+            np.float64 requires an Ocl instance created with double=True. Not available with fused=True.
+            In tiled mode (not fused), the images of narrow types (for eg. uint16) are also transferred as they are and converted by the first pass.
+        @param fft : (optional) convolution in the frequency domain (see FFTConvol) : True to always use it, False to never
+            use it. Default is to use it for the filters where it is expected to be faster and its buffers fit in the device
+            memory (see fftconvol.use_fft()).
+            It is not available with pre_op, post_op or a storage type other than float32.
         """
 
         # Create the GPU context
-        self.ocl = Ocl(device=device)
-
-        # Pre-allocate the arrays : input, output and tmp
-        nbytes = np.prod(shape)*4
-        self.d_input = self.ocl.create_buffer(shape, np.float32, flags="r")
-        self.d_output = self.ocl.create_buffer(shape, np.float32, flags="w")
-        self.d_tmp = self.ocl.create_buffer(shape, np.float32)
+        self.ocl = ocl if ocl is not None else Ocl(device=device)
+        self.storage = np.dtype(storage)
+        if self.storage not in [np.float16, np.float32, np.float64]:
+            raise ValueError("Gpuconvol: storage should be float16, float32 or float64, got %s" % self.storage)
+        if self.storage != np.float32 and not(tiled):
+            raise ValueError("Gpuconvol: %s storage requires tiled=True" % self.storage)
+        if self.storage != np.float32 and fused:
+            raise ValueError("Gpuconvol: the fused kernels only support float32 storage, got %s" % self.storage)
+        if self.storage == np.float64 and not(self.ocl.double):
+            raise ValueError("Gpuconvol: float64 storage requires an Ocl instance created with double=True, on a device supporting double precision")
+        # Type of the filter coefficients and of the computations
+        self.real_dtype = np.dtype(np.float64 if self.storage == np.float64 else np.float32)
+
+        # Pre-allocate the arrays : input (large enough for any input type), output and tmp
+        self.d_input = self.ocl.create_buffer(shape, self.real_dtype, flags="r")
+        self.d_output = self.ocl.create_buffer(shape, self.storage, flags="w")
+        self.d_tmp = self.ocl.create_buffer(shape, self.storage)
 
         # Compile the OpenCL kernels
         if program_path is None:
             program_path = "opencl/convolution.cl"
         self.program = self.ocl.compile_file(program_path)
-
+        self.kernels = {}
+        for name in ["horizontal_convolution", "vertical_convolution", "depth_convolution"]:
+            self.kernels[name] = self.ocl.kernel(self.program, name)
+        self.tiled = tiled
+        self.tiled_program_path = os.path.join(os.path.dirname(program_path), "convolution_tiled.cl")
+        self.tiled_block = (16, 8)
+        self.tiled_kernels_cache = {}
+        if (pre_op is not None or post_op is not None) and not(fused):
+            raise ValueError("Gpuconvol: pre_op and post_op require fused=True")
+        self.fused = fused
+        self.fused_program_path = os.path.join(os.path.dirname(program_path), "convolution_fused.cl")
+        self.fused_block = (16, 8)
+        self.fused_block3d = (8, 8, 4)
+        self.fused3d_max_overhead = 4.0 # max. ratio (tile volume)/(block volume) of the 3D fused kernel
+        self.fused_ops = pre_op is not None or post_op is not None
+        self.fused_header = "#define PRE_OP(x, i) (%s)\n#define POST_OP(x, i) (%s)\n" % (pre_op or "x", post_op or "x")
+        self.fused_kernels_cache = {}
+        self.op_arrays = (None, None)
+        fft_possible = (pre_op is None and post_op is None and self.storage == np.float32)
+        if fft and not(fft_possible):
+            raise ValueError("Gpuconvol: fft=True is not available with pre_op, post_op or a storage type other than float32")
+        self.fft = fft if fft_possible else False
+        self.fft_program_path = os.path.join(os.path.dirname(program_path), "fft.cl")
+        self.fft_conv = None # created on first use
 
         # Prepare the grid/block size
         self.ndim = len(shape)
+        self.image_shape = tuple(shape)
+        self.streams = []
         if self.ndim == 3:
             im_z, im_h, im_w = shape
             self.shape = (im_w, im_h, im_z)
         else: #elif self.ndim == 2:
             im_h, im_w = shape
             self.shape = (im_w, im_h)
-        self.wg = None
+        if wg is None:
+            wg = (4, 4, 4) if (self.ndim == 3) else (4, 4, 1) # For CC <= 2.0, no more than 512 threads/block (1024 otherwise)
+        self.wg = wg
 
-        self.wg = (4, 4, 4) if (self.ndim == 3) else (4, 4, 1) # For CC <= 2.0, no more than 512 threads/block (1024 otherwise)
-        self.grid = self.ocl.calc_size(self.shape, self.wg)
+        # The kernels are always launched on a 3D grid (with a depth of 1 for 2D images)
+        self.grid = self.shape if (self.ndim == 3) else self.shape + (1,)
+        if self.wg != "auto":
+            self.grid = self.ocl.calc_size(self.grid, self.wg)
 
 
-    def gaussian_filter(self, image, sigma):
-        # Compute the gaussian filter
-        gaussian = comp_kern_scipy(sigma)
-
-        # Transfer the image and the gaussian kernel
-        d_input = self.ocl.to_device(image, destbuf=self.d_input, flags="r")
-        d_gaussian = self.ocl.to_device(gaussian, flags="r")
-
-        # Check that the size is valid
+    def check_shape(self, image):
+        """
+        Check that the size of an image is valid
+        """
         if self.ndim == 3: # 3D
             if (image.shape[0] != self.shape[2]) or (image.shape[1] != self.shape[1]) or (image.shape[2] != self.shape[0]):
                 raise ValueError('gaussian_filter(): invalid volume size: expected (%d, %d, %d), got (%d, %d, %d)' % (self.shape[2], self.shape[1], self.shape[0], image.shape[0], image.shape[1], image.shape[2]))
@@ -89,20 +146,304 @@ class Gpuconvol:
             if (image.shape[0] != self.shape[1]) or (image.shape[1] != self.shape[0]):
                 raise ValueError('gaussian_filter(): invalid volume size: expected (%d, %d), got (%d, %d)' % (self.shape[1], self.shape[0], image.shape[0], image.shape[1]))
 
-        # Execute
-        ksize = gaussian.shape[0]
+
+    def input_dtype(self, dtype):
+        """
+        Data type of the images of type dtype once transferred to the device.
+        In tiled mode, the kernels convert the input values : the narrow types are transferred as they are.
+        The fused kernels only read float32 values.
+        """
+        dtype = self.ocl.device_dtype(dtype)
+        if self.tiled and not(self.fused) and (dtype in CL_TYPES or dtype == np.float16 or dtype == self.real_dtype):
+            return dtype
+        return self.real_dtype
+
+
+    def tiled_kernels(self, ksize, input_dtype=np.float32):
+        """
+        Return the tiled kernels specialized for a filter size and an input data type, with their work-group size.
+        The first pass reads the input type, the other passes read the storage type.
+        The programs are built once for each filter size and data type.
+        """
+        key = (ksize, np.dtype(input_dtype))
+        if key not in self.tiled_kernels_cache:
+            bx, by = self.tiled_block
+            defines = {"HLEN": ksize, "BLOCK_X": bx, "BLOCK_Y": by}
+            defines.update(storage_defines(self.storage, "OUTPUT"))
+            if self.storage == np.float64:
+                defines["USE_DOUBLE"] = None
+            first = dict(defines, **storage_defines(input_dtype, "INPUT"))
+            other = dict(defines, **storage_defines(self.storage, "INPUT"))
+            program_first = self.ocl.compile_file(self.tiled_program_path, defines=first)
+            program = self.ocl.compile_file(self.tiled_program_path, defines=other)
+            self.tiled_kernels_cache[key] = {
+                "horizontal_convolution": (self.ocl.kernel(program_first, "horizontal_convolution_tiled"), (bx, by, 1)),
+                "vertical_convolution": (self.ocl.kernel(program, "vertical_convolution_tiled"), (bx, by, 1)),
+                "depth_convolution": (self.ocl.kernel(program, "depth_convolution_tiled"), (bx, 1, by)),
+            }
+        return self.tiled_kernels_cache[key]
+
+
+    def fused_local_size(self, ksize):
+        """
+        Local memory (in bytes) used by the 3D fused kernel for a filter size
+        """
+        bx, by, bz = self.fused_block3d
+        tx, ty, tz = bx + ksize - 1, by + ksize - 1, bz + ksize - 1
+        return (tz*ty*tx + tz*ty*bx + tz*by*bx) * 4
+
+
+    def fused_local_size2d(self, ksize):
+        """
+        Local memory (in bytes) used by the 2D fused kernel for a filter size : the tile and the result of the
+        horizontal pass. It is larger than the tile of depth_convolution_post.
+        """
+        bx, by = self.fused_block
+        tx, ty = bx + ksize - 1, by + ksize - 1
+        return (ty*tx + ty*bx) * 4
+
+
+    def fused_fits(self, ksize):
+        """
+        Check that the tiles of the 2D fused kernels fit in local memory for a filter size
+        """
+        return self.fused_local_size2d(ksize) <= self.ocl.device.local_mem_size
+
+
+    def fused_kernels(self, ksize):
+        """
+        Return the fused kernels specialized for a filter size, with their work-group size.
+        The 2D fused kernel must fit in local memory (see fused_fits() : otherwise convolve() does not use the fused kernels).
+        The 3D fused kernel is only built if its tile fits in local memory, and if its halo is small enough :
+        the values of the halo are computed by several work-groups. Otherwise the volumes are filtered by the 2D fused
+        kernel followed by the depth pass.
+        """
+        if ksize not in self.fused_kernels_cache:
+            bx, by = self.fused_block
+            defines = {"HLEN": ksize, "BLOCK_X": bx, "BLOCK_Y": by}
+            block_volume = np.prod(self.fused_block3d)
+            tile_volume = np.prod([n + ksize - 1 for n in self.fused_block3d])
+            fits = (self.fused_local_size(ksize) <= self.ocl.device.local_mem_size
+                    and block_volume <= self.ocl.device.max_work_group_size
+                    and tile_volume <= self.fused3d_max_overhead * block_volume)
+            if self.ndim == 3 and fits:
+                defines.update({"FUSED_3D": None, "BLOCK3_X": self.fused_block3d[0], "BLOCK3_Y": self.fused_block3d[1], "BLOCK3_Z": self.fused_block3d[2]})
+            program = self.ocl.compile_file(self.fused_program_path, defines=defines, header=self.fused_header)
+            kernels = {
+                "separable_convolution_2d_fused": (self.ocl.kernel(program, "separable_convolution_2d_fused"), (bx, by, 1)),
+                "depth_convolution_post": (self.ocl.kernel(program, "depth_convolution_post"), (bx, 1, by)),
+            }
+            if "FUSED_3D" in defines:
+                kernels["separable_convolution_3d_fused"] = (self.ocl.kernel(program, "separable_convolution_3d_fused"), self.fused_block3d)
+            self.fused_kernels_cache[ksize] = kernels
+        return self.fused_kernels_cache[ksize]
+
+
+    def set_op_arrays(self, a=None, b=None):
+        """
+        Set the arrays used by pre_op and post_op. They are transferred once and stay on the device.
+
+        @param a, b : numpy arrays (converted to float32) or device buffers
+        """
+        arrays = []
+        for arr in [a, b]:
+            if arr is not None and not(isinstance(arr, cl.Buffer)):
+                arr = self.ocl.to_device(np.asarray(arr, dtype=np.float32), flags="r")
+            arrays.append(arr)
+        for old, new in zip(self.op_arrays, arrays):
+            if old is not None and old is not new and old in self.ocl.book:
+                self.ocl.release_buffer(old)
+        self.op_arrays = tuple(arrays)
+
+
+    def convolve_fused(self, d_input, d_output, d_tmp, d_gaussian, ksize, queue=None, wait_for=None):
+        """
+        Enqueue the fused convolution. Same results buffers as convolve() : d_output in 3D, d_tmp in 2D.
+        """
+        if self.ndim == 3: # 3D
+            im_w, im_h, im_z = self.shape
+        else: #2D
+            im_w, im_h = self.shape
+            im_z = 1
+        kernels = self.fused_kernels(ksize)
+        d_a, d_b = self.op_arrays
+        npix = im_w * im_h * im_z
+        flops = 2 * npix * ksize * self.ndim
+        if self.ndim == 2:
+            kernel, wg = kernels["separable_convolution_2d_fused"]
+            grid = self.ocl.calc_size((im_w, im_h, 1), wg)
+            ev = self.ocl.call(kernel, grid, wg, d_input, d_tmp, d_gaussian, im_w, im_h, im_z, d_a, d_b, 1,
+                               wait_for=wait_for, queue=queue, nbytes=2*npix*4, flops=flops)
+            return d_tmp, ev
+        if "separable_convolution_3d_fused" in kernels:
+            kernel, wg = kernels["separable_convolution_3d_fused"]
+            grid = self.ocl.calc_size((im_w, im_h, im_z), wg)
+            ev = self.ocl.call(kernel, grid, wg, d_input, d_output, d_gaussian, im_w, im_h, im_z, d_a, d_b,
+                               wait_for=wait_for, queue=queue, nbytes=2*npix*4, flops=flops)
+            return d_output, ev
+        # The 3D tile does not fit in local memory : fused 2D passes, then the depth pass
+        kernel, wg = kernels["separable_convolution_2d_fused"]
+        grid = self.ocl.calc_size((im_w, im_h, im_z), wg)
+        self.ocl.call(kernel, grid, wg, d_input, d_tmp, d_gaussian, im_w, im_h, im_z, d_a, d_b, 0,
+                      wait_for=wait_for, queue=queue, nbytes=2*npix*4, flops=4*npix*ksize)
+        kernel, wg = kernels["depth_convolution_post"]
+        grid = self.ocl.calc_size((im_w, im_h, im_z), wg)
+        ev = self.ocl.call(kernel, grid, wg, d_tmp, d_output, d_gaussian, im_w, im_h, im_z, d_a, d_b,
+                           queue=queue, nbytes=2*npix*4, flops=2*npix*ksize)
+        return d_output, ev
+
+
+    def convolve(self, d_input, d_output, d_tmp, d_gaussian, ksize, queue=None, wait_for=None, input_dtype=np.float32):
+        """
+        Enqueue the separable convolution passes.
+        Returns the device buffer holding the result (d_output in 3D, d_tmp in 2D),
+        and the event of the last pass.
+        d_gaussian is the filter of all the passes, or a list of filters of size ksize for the passes along x, y (and z).
+        With fused=True, when the tiles of the fused kernels do not fit in local memory (large filters), the passes of
+        convolution.cl are used instead : this is not possible with pre_op or post_op.
+        input_dtype is the data type of d_input : other types than float32 require tiled=True and fused=False (see input_dtype()).
+        """
+        input_dtype = np.dtype(input_dtype)
+        if input_dtype != self.real_dtype and (self.fused or not(self.tiled)):
+            raise ValueError("Gpuconvol: %s input requires tiled=True and fused=False" % input_dtype)
+        filters = list(d_gaussian) if isinstance(d_gaussian, (list, tuple)) else [d_gaussian] * self.ndim
+        tiled = self.tiled
+        if self.fused:
+            if any(f is not filters[0] for f in filters):
+                raise ValueError("Gpuconvol: the fused kernels use the same filter on all the axes")
+            if self.fused_fits(ksize):
+                return self.convolve_fused(d_input, d_output, d_tmp, filters[0], ksize, queue=queue, wait_for=wait_for)
+            if self.fused_ops:
+                raise ValueError("Gpuconvol: the fused kernels need %d bytes of local memory for a filter of size %d (device: %d bytes), "
+                                 "and pre_op/post_op are only available with the fused kernels" % (self.fused_local_size2d(ksize), ksize, self.ocl.device.local_mem_size))
+            tiled = False # passes of convolution.cl, without local memory
         if self.ndim == 3: # 3D
-            im_z, im_h, im_w = self.shape
+            im_w, im_h, im_z = self.shape
         else: #2D
-            im_h, im_w = self.shape
+            im_w, im_h = self.shape
             im_z = 1
-        k1 = self.ocl.call(self.program.horizontal_convolution, self.grid, self.wg, d_input, self.d_output, d_gaussian, ksize, im_w, im_h, im_z)
-        k2 = self.ocl.call(self.program.vertical_convolution, self.grid, self.wg, self.d_output, self.d_tmp, d_gaussian, ksize, im_w, im_h, im_z)
+        passes = [("horizontal_convolution", d_input, d_output), ("vertical_convolution", d_output, d_tmp)]
         if self.ndim == 3:
-            k3 = self.ocl.call(self.program.depth_convolution, self.grid, self.wg, self.d_tmp, self.d_output, d_gaussian, ksize, im_w, im_h, im_z)
+            passes.append(("depth_convolution", d_tmp, d_output))
+        # Minimal memory traffic and operations count of each pass, reported by the Ocl tracer
+        npix = im_w * im_h * im_z
+        for (name, d_src, d_dst), d_gaussian in zip(passes, filters):
+            src_itemsize = input_dtype.itemsize if d_src is d_input else self.storage.itemsize
+            stats = {"nbytes": npix * (src_itemsize + self.storage.itemsize), "flops": 2 * npix * ksize}
+            if tiled:
+                kernel, wg = self.tiled_kernels(ksize, input_dtype)[name]
+                grid = self.ocl.calc_size((im_w, im_h, im_z), wg)
+                ev = self.ocl.call(kernel, grid, wg, d_src, d_dst, d_gaussian, im_w, im_h, im_z, wait_for=wait_for, queue=queue, **stats)
+            else:
+                ev = self.ocl.call(self.kernels[name], self.grid, self.wg, d_src, d_dst, d_gaussian, ksize, im_w, im_h, im_z, wait_for=wait_for, queue=queue, **stats)
+            wait_for = None # the next passes are ordered by the in-order queue
+        return passes[-1][2], ev
+
+
+    def gaussian_filter(self, image, sigma, order=0):
+        self.check_shape(image)
+        # Transfer the image
+        image = np.ascontiguousarray(image, dtype=self.input_dtype(image.dtype))
+        d_input = self.ocl.to_device(image, destbuf=self.d_input, flags="r")
+        d_res, ev = self.gaussian_filter_device(d_input, sigma, input_dtype=image.dtype, order=order)
+        # Event of the last pass, for chaining further operations on the result
+        return ev
+
+
+    def use_fft(self, sigma, input_dtype=np.float32):
+        """
+        Return True if the filter of standard deviation sigma is applied in the frequency domain (see the "fft" parameter).
+        The half and double precision inputs are always filtered by the direct convolution.
+        """
+        if np.dtype(input_dtype) not in CL_TYPES:
+            return False
+        if self.fft is None:
+            fft = use_fft(self.image_shape, 2 * int(4 * float(sigma) + 0.5) + 1, device=self.ocl.device)
+        else:
+            fft = self.fft
+        if fft and self.fft_conv is None:
+            self.fft_conv = FFTConvol(self.image_shape, ocl=self.ocl, program_path=self.fft_program_path)
+        return fft
+
+
+    def gaussian_filter_device(self, d_input, sigma, wait_for=None, input_dtype=None, order=0):
+        """
+        Filter an image/volume already on the device, for eg. the output of another kernel.
+        Returns the device buffer holding the result (see convolve()) and the event of the last pass.
+
+        @param d_input : device buffer of the shape given at initialization
+        @param sigma : standard deviation of the gaussian filter
+        @param wait_for : (optional) list of events to wait for, for eg. the event of the kernel producing d_input
+        @param input_dtype : (optional) data type of d_input. Default is given by the book-keeping of Ocl, or float32.
+        @param order : (optional) order of the derivative of Gaussian along each axis, as in scipy.ndimage.gaussian_filter :
+            an integer for all the axes, or a sequence with one order for each axis (for eg. (0, 1) for the gradient along x).
+            The derivatives are not available with fused=True.
+        """
+        if input_dtype is None:
+            input_dtype = self.ocl.book.get(d_input, (None, None))[1] or self.real_dtype
+        orders = [order] * self.ndim if np.isscalar(order) else list(order)
+        if len(orders) != self.ndim:
+            raise ValueError("Gpuconvol: expected %d derivative orders, got %d" % (self.ndim, len(orders)))
+        if not(any(orders)) and self.use_fft(sigma, input_dtype):
+            # Result in the same buffer as convolve()
+            d_res = self.d_output if self.ndim == 3 else self.d_tmp
+            return self.fft_conv.gaussian_filter_device(d_input, sigma, d_output=d_res, input_dtype=input_dtype, wait_for=wait_for)
+        # Filters of the passes along x, y (and z) : reversed order of the numpy axes
+        filters = [device_gaussian(self.ocl, sigma, order=o, dtype=self.real_dtype) for o in reversed(orders)]
+        ksize = filters[0][1]
+        d_gaussian = filters[0][0] if len(set(orders)) == 1 else [d_filter for d_filter, size in filters]
+        return self.convolve(d_input, self.d_output, self.d_tmp, d_gaussian, ksize, wait_for=wait_for, input_dtype=input_dtype)
+
+
+    def stream_slots(self, nbuffers):
+        """
+        Return nbuffers "slots" for the streaming mode. Each slot is a command queue
+        with its own input, output and temporary buffers. Slots are created once and then reused.
+        """
+        while len(self.streams) < nbuffers:
+            queue = self.ocl.create_queue()
+            d_input = self.ocl.create_buffer(self.image_shape, self.real_dtype, flags="r")
+            d_output = self.ocl.create_buffer(self.image_shape, self.storage)
+            d_tmp = self.ocl.create_buffer(self.image_shape, self.storage)
+            self.streams.append((queue, d_input, d_output, d_tmp))
+        return self.streams[:nbuffers]
+
+
+    def gaussian_filter_stream(self, frames, sigma, nbuffers=2):
+        """
+        Filter a stream of images/volumes, and yield the results in the same order.
+        The frames are distributed over nbuffers command queues, so that the upload of a frame,
+        the convolution of another one and the download of a third one can overlap.
+
+        @param frames : iterable of numpy arrays, all of the shape given at initialization
+        @param sigma : standard deviation of the gaussian filter
+        @param nbuffers : (optional) number of frames in flight : 2 for double buffering, 3 for triple buffering
+        """
+        d_gaussian, ksize = device_gaussian(self.ocl, sigma, dtype=self.real_dtype)
+        slots = self.stream_slots(nbuffers)
+        pending = deque()
+        try:
+            for i, frame in enumerate(frames):
+                if len(pending) == nbuffers:
+                    res, ev = pending.popleft()
+                    ev.wait()
+                    yield res
+                self.check_shape(frame)
+                queue, d_input, d_output, d_tmp = slots[i % nbuffers]
+                frame = np.ascontiguousarray(frame, dtype=self.input_dtype(frame.dtype))
+                d_input, ev = self.ocl.to_device(frame, destbuf=d_input, is_blocking=False, return_event=True, queue=queue)
+                d_res, ev = self.convolve(d_input, d_output, d_tmp, d_gaussian, ksize, queue=queue, wait_for=[ev], input_dtype=frame.dtype)
+                res, ev = self.ocl.fetch(d_res, dest=np.empty(self.image_shape, dtype=self.storage), return_event=True, wait_for=[ev], is_blocking=False, queue=queue)
+                queue.flush()
+                pending.append((res, ev))
+            while pending:
+                res, ev = pending.popleft()
+                ev.wait()
+                yield res
+        finally:
+            for slot in slots:
+                slot[0].finish()
 
-        # Free the memory for gaussian kernel
-        self.ocl.release_buffer(d_gaussian)
 
     def fetch_result(self):
         if self.ndim == 3:
@@ -112,6 +453,116 @@ class Gpuconvol:
         return res
 
 
+    def release(self):
+        """
+        Release the device buffers : input, output, temporary buffers and the buffers of the streaming slots.
+        The instance cannot be used afterwards.
+        """
+        for d_id in [self.d_input, self.d_output, self.d_tmp] + [d for slot in self.streams for d in slot[1:]]:
+            self.ocl.release_buffer(d_id)
+        self.d_input = self.d_output = self.d_tmp = None
+        self.streams = []
+        self.fft_conv = None
+
+
+
+
+class ChunkedGpuconvol:
+    """
+    Helper class for 3D convolution of volumes which do not fit in the device memory.
+    The volume is processed by slabs along Z. Each slab is extended by a halo of the filter half-width,
+    so that the stitched slabs are identical to the convolution of the whole volume.
+    The input can be any array-like object supporting slicing along the first axis (numpy array, np.memmap, HDF5 dataset).
+    """
+
+
+    def __init__(self, device=None, program_path=None, ocl=None, mem_fraction=0.5):
+        """
+        @param device : (optional) device in the format (0, 0)
+        @param program_path : (optional) path of the convolution program
+        @param ocl : (optional) existing Ocl instance
+        @param mem_fraction : (optional) fraction of the device global memory which can be used by the slabs
+        """
+        self.ocl = ocl if ocl is not None else Ocl(device=device)
+        if program_path is None:
+            program_path = "opencl/convolution.cl"
+        self.program = self.ocl.compile_file(program_path)
+        self.kernels = {}
+        for name in ["horizontal_convolution", "vertical_convolution", "depth_convolution"]:
+            self.kernels[name] = self.ocl.kernel(self.program, name)
+        self.mem_fraction = mem_fraction
+        self.wg = (4, 4, 4)
+
+
+    def slab_depth(self, shape, halo):
+        """
+        Compute the largest slab depth (without halo) such that the three slab buffers fit in the device memory.
+        """
+        im_z, im_h, im_w = shape
+        slice_bytes = im_h * im_w * 4
+        max_bytes = min(self.ocl.device.global_mem_size * self.mem_fraction / 3, self.ocl.device.max_mem_alloc_size)
+        max_slices = int(max_bytes // slice_bytes)
+        depth = max_slices - 2*halo
+        # The slab must be larger than the two halos : at least max(halo, 1) slices besides them
+        min_slices = 2*halo + max(halo, 1)
+        if max_slices < min_slices:
+            raise ValueError("ChunkedGpuconvol: the slabs need at least %d slices of %dx%d (more than twice the filter halo of %d slices), "
+                             "but only %d fit in the device memory" % (min_slices, im_h, im_w, halo, max_slices))
+        return min(depth, im_z)
+
+
+    def gaussian_filter(self, volume, sigma, output=None, output_file=None, slab_depth=None):
+        """
+        Filter a 3D volume by slabs.
+
+        @param volume : array-like of shape (im_z, im_h, im_w)
+        @param sigma : standard deviation of the gaussian filter
+        @param output : (optional) array-like of the same shape where the result is written, for eg. a np.memmap
+        @param output_file : (optional) if output is not provided, the result is written to a numpy memmap (.npy) file with this name.
+            If none is provided, the result is returned in a numpy array.
+        @param slab_depth : (optional) number of slices processed at once. Default is computed from the device memory.
+        @return the output array
+        """
+        im_z, im_h, im_w = volume.shape
+        d_gaussian, ksize = device_gaussian(self.ocl, sigma)
+        halo = ksize // 2
+        if slab_depth is None:
+            slab_depth = self.slab_depth(volume.shape, halo)
+        elif slab_depth < 1:
+            raise ValueError("ChunkedGpuconvol: slab_depth must be at least 1 slice (besides the halos of %d slices), got %d" % (halo, slab_depth))
+        if output is None:
+            if output_file is not None:
+                output = np.lib.format.open_memmap(output_file, mode="w+", dtype=np.float32, shape=(im_z, im_h, im_w))
+            else:
+                output = np.empty((im_z, im_h, im_w), dtype=np.float32)
+
+        max_shape = (min(slab_depth + 2*halo, im_z), im_h, im_w)
+        d_input = self.ocl.create_buffer(max_shape, np.float32, flags="r")
+        d_output = self.ocl.create_buffer(max_shape, np.float32)
+        d_tmp = self.ocl.create_buffer(max_shape, np.float32)
+        res = np.empty((slab_depth, im_h, im_w), dtype=np.float32)
+        try:
+            for z0 in range(0, im_z, slab_depth):
+                z1 = min(z0 + slab_depth, im_z)
+                # Slab extended by the halo, clipped to the volume
+                a0, a1 = max(z0 - halo, 0), min(z1 + halo, im_z)
+                self.ocl.to_device(np.asarray(volume[a0:a1], dtype=np.float32), destbuf=d_input)
+                depth = a1 - a0
+                grid = self.ocl.calc_size((im_w, im_h, depth), self.wg)
+                self.ocl.call(self.kernels["horizontal_convolution"], grid, self.wg, d_input, d_output, d_gaussian, ksize, im_w, im_h, depth)
+                self.ocl.call(self.kernels["vertical_convolution"], grid, self.wg, d_output, d_tmp, d_gaussian, ksize, im_w, im_h, depth)
+                self.ocl.call(self.kernels["depth_convolution"], grid, self.wg, d_tmp, d_output, d_gaussian, ksize, im_w, im_h, depth)
+                # Only keep the slices which are not in the halo
+                self.ocl.fetch(d_output, dest=res[:z1-z0], offset=(z0-a0)*im_h*im_w*4)
+                output[z0:z1] = res[:z1-z0]
+        finally:
+            for d_id in [d_input, d_output, d_tmp]:
+                self.ocl.release_buffer(d_id)
+        if hasattr(output, "flush"):
+            output.flush()
+        return output
+
+
 
 
 def main3():
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import weakref
+import pyopencl as cl
+from oclutils import Ocl, CL_TYPES
+
+
+# Generated kernels of each Ocl instance, by expression signature
+_kernels = weakref.WeakKeyDictionary()
+
+BINARY_OPS = {"+": "+", "-": "-", "*": "*", "/": "/"}
+FUNCTIONS = {"neg": "-", "abs": "fabs", "sqrt": "sqrt", "exp": "exp", "log": "log", "sin": "sin", "cos": "cos",
+             "pow": "pow", "minimum": "fmin", "maximum": "fmax"}
+
+
+class Expression:
+    """
+    Node of a lazy element-wise expression on device arrays.
+    Arithmetic operations on DeviceArray and Expression objects only record the expression ; evaluate()
+    generates a single kernel computing the whole expression, without intermediate buffers.
+    The computations are done in float, and the result is a float32 DeviceArray.
+
+    Example :
+        a, b, c, d = [DeviceArray.from_host(ocl, x) for x in [a_h, b_h, c_h, d_h]]
+        res = ((a - b) * c + d).get()
+    """
+
+    __array_priority__ = 100 # numpy scalars on the left of an operator give way to the Expression operators
+    __array_ufunc__ = None
+
+    def __init__(self, op, args):
+        """
+        @param op : operation : "scalar", "+", "-", "*", "/", or a function name of FUNCTIONS
+        @param args : operands (Expression objects), or the value of a scalar
+        """
+        self.op = op
+        self.args = args
+
+
+    @staticmethod
+    def wrap(x):
+        if isinstance(x, Expression):
+            return x
+        if np.isscalar(x) and not isinstance(x, (str, bytes)):
+            return Expression("scalar", float(x))
+        raise TypeError("Expression: unsupported operand %s" % str(type(x)))
+
+    def __add__(self, other): return Expression("+", (self, Expression.wrap(other)))
+    def __radd__(self, other): return Expression("+", (Expression.wrap(other), self))
+    def __sub__(self, other): return Expression("-", (self, Expression.wrap(other)))
+    def __rsub__(self, other): return Expression("-", (Expression.wrap(other), self))
+    def __mul__(self, other): return Expression("*", (self, Expression.wrap(other)))
+    def __rmul__(self, other): return Expression("*", (Expression.wrap(other), self))
+    def __truediv__(self, other): return Expression("/", (self, Expression.wrap(other)))
+    def __rtruediv__(self, other): return Expression("/", (Expression.wrap(other), self))
+    def __pow__(self, other): return Expression("pow", (self, Expression.wrap(other)))
+    def __neg__(self): return Expression("neg", (self,))
+    def __abs__(self): return Expression("abs", (self,))
+
+
+    def leaves(self):
+        """
+        Return the device arrays of the expression (each one once, in order of appearance)
+        """
+        res = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, DeviceArray):
+                if not any(node.buffer is leaf.buffer for leaf in res):
+                    res.append(node)
+            elif node.op != "scalar":
+                stack.extend(reversed(node.args))
+        return res
+
+
+    def generate(self, leaves, scalars):
+        """
+        Return the OpenCL code of the expression. The device arrays are referred to as in0, in1, ...
+        (in the order of leaves), and the scalars as s0, s1, ... (appended to scalars).
+        """
+        if isinstance(self, DeviceArray):
+            index = [leaf.buffer for leaf in leaves].index(self.buffer)
+            return "((float) in%d[i])" % index
+        if self.op == "scalar":
+            scalars.append(self.args)
+            return "s%d" % (len(scalars) - 1)
+        code = [arg.generate(leaves, scalars) for arg in self.args]
+        if self.op in BINARY_OPS:
+            return "(%s %s %s)" % (code[0], BINARY_OPS[self.op], code[1])
+        if self.op == "neg":
+            return "(-%s)" % code[0]
+        return "%s(%s)" % (FUNCTIONS[self.op], ", ".join(code))
+
+
+    def count_ops(self):
+        if isinstance(self, DeviceArray) or self.op == "scalar":
+            return 0
+        return 1 + sum(arg.count_ops() for arg in self.args)
+
+
+    @staticmethod
+    def kernel_source(code, leaves, n_scalars):
+        args = ["__global float * output"]
+        args += ["const __global %s * in%d" % (CL_TYPES[leaf.dtype], j) for j, leaf in enumerate(leaves)]
+        args += ["float s%d" % j for j in range(n_scalars)]
+        args += ["int n"]
+        return """
+__kernel void elementwise(%s)
+{
+    int i = (int) get_global_id(0);
+    if (i < n) output[i] = %s;
+}
+""" % (",\n    ".join(args), code)
+
+
+    def get_kernel(self, ocl, code, leaves, n_scalars):
+        """
+        Return the kernel of an expression. Kernels are generated and built once for each signature
+        (code of the expression and data types of the arrays), and reused for any value of the scalars.
+        """
+        signature = (code, tuple(leaf.dtype.str for leaf in leaves))
+        kernels = _kernels.setdefault(ocl, {})
+        if signature not in kernels:
+            program = ocl.build_program(Expression.kernel_source(code, leaves, n_scalars))
+            kernels[signature] = ocl.kernel(program, "elementwise")
+        return kernels[signature]
+
+
+    def evaluate(self, out=None, wait_for=None):
+        """
+        Compute the expression in a single kernel. Returns a float32 DeviceArray.
+
+        @param out : (optional) DeviceArray where the result is written. It can be one of the operands.
+        @param wait_for : (optional) list of events to wait for
+        """
+        leaves = self.leaves()
+        if not leaves:
+            raise ValueError("Expression: at least one operand has to be a device array")
+        ocl, shape = leaves[0].ocl, leaves[0].shape
+        for leaf in leaves[1:]:
+            if leaf.shape != shape:
+                raise ValueError("Expression: operands have different shapes: %s and %s" % (str(shape), str(leaf.shape)))
+            if leaf.ocl is not ocl:
+                raise ValueError("Expression: operands belong to different Ocl instances")
+        scalars = []
+        code = self.generate(leaves, scalars)
+        kernel = self.get_kernel(ocl, code, leaves, len(scalars))
+        if out is None:
+            out = DeviceArray(ocl, ocl.create_buffer(shape, np.float32))
+        elif out.shape != shape or out.dtype != np.float32:
+            raise ValueError("Expression: invalid output array %s" % repr(out))
+        n = int(np.prod(shape))
+        nbytes = n * (4 + sum(leaf.dtype.itemsize for leaf in leaves))
+        out.event = ocl.call(kernel, (n,), None, out.buffer, *([leaf.buffer for leaf in leaves] + [np.float32(s) for s in scalars] + [np.int32(n)]),
+                             wait_for=wait_for, nbytes=nbytes, flops=n*self.count_ops())
+        return out
+
+
+    def get(self):
+        """
+        Compute the expression and transfer the result to the host
+        """
+        res = self.evaluate()
+        arr = res.get()
+        if res is not self:
+            res.release()
+        return arr
+
+
+
+class DeviceArray(Expression):
+    """
+    Array on the device : a buffer with the shape and data type given by the book-keeping of Ocl (Ocl.book).
+    Arithmetic operations give lazy Expression objects (see Expression).
+    """
+
+
+    def __init__(self, ocl, buffer, shape=None, dtype=None):
+        """
+        @param ocl : Ocl instance owning the buffer
+        @param buffer : device buffer
+        @param shape : (optional) shape of the array. Default is given by Ocl.book.
+        @param dtype : (optional) data type of the array. Default is given by Ocl.book.
+        """
+        if shape is None or dtype is None:
+            shape2, dtype2 = ocl.buffer_type(buffer, "DeviceArray")
+            shape = shape2 if shape is None else shape
+            dtype = dtype2 if dtype is None else dtype
+        self.ocl = ocl
+        self.buffer = buffer
+        self.shape = tuple(shape) if hasattr(shape, "__len__") else (shape,)
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in CL_TYPES:
+            raise ValueError("DeviceArray: unsupported data type %s" % self.dtype)
+        self.event = None
+
+
+    @staticmethod
+    def from_host(ocl, arr):
+        """
+        Transfer a numpy array to the device. Integer types are transferred as they are.
+        """
+        arr = np.asarray(arr)
+        if arr.dtype not in CL_TYPES:
+            arr = Ocl.check_array(arr)
+        return DeviceArray(ocl, ocl.to_device(arr))
+
+
+    @staticmethod
+    def empty(ocl, shape, dtype=np.float32):
+        return DeviceArray(ocl, ocl.create_buffer(shape, dtype), shape, dtype)
+
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+
+    def evaluate(self, out=None, wait_for=None):
+        if out is None or out is self:
+            return self
+        return Expression.evaluate(self, out=out, wait_for=wait_for)
+
+
+    def get(self):
+        """
+        Transfer the array to the host
+        """
+        return self.ocl.fetch(self.buffer, dest=np.empty(self.shape, dtype=self.dtype))
+
+
+    def release(self):
+        self.ocl.release_buffer(self.buffer)
+        self.buffer = None
+
+
+    def __repr__(self):
+        return "DeviceArray(shape=%s, dtype=%s)" % (str(self.shape), self.dtype.name)
+
+
+
+def sqrt(x): return Expression("sqrt", (Expression.wrap(x),))
+def exp(x): return Expression("exp", (Expression.wrap(x),))
+def log(x): return Expression("log", (Expression.wrap(x),))
+def sin(x): return Expression("sin", (Expression.wrap(x),))
+def cos(x): return Expression("cos", (Expression.wrap(x),))
+def minimum(x, y): return Expression("minimum", (Expression.wrap(x), Expression.wrap(y)))
+def maximum(x, y): return Expression("maximum", (Expression.wrap(x), Expression.wrap(y)))
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import hashlib
+import pyopencl as cl
+from collections import OrderedDict
+from oclutils import Ocl, CL_TYPES
+from filters import gaussian_kernel
+
+# Relative costs of the FFT convolution, in multiply-adds of the direct convolution per element of the padded array :
+# one stage of the radix-2 FFT, and the padding, multiplication and cropping passes.
+# The crossover with the direct separable convolution of a 512x512 image is around sigma = 16-20.
+FFT_STAGE_COST = 2.0
+FFT_EXTRA_COST = 10.0
+
+
+def next_power_of_two(n):
+    return 1 << int(np.ceil(np.log2(max(int(n), 1))))
+
+
+def filter_sides(hlen):
+    """
+    Number of coefficients on the left and on the right of the center of a filter.
+    For an even filter size, the center is shifted to the left, as in the direct convolution kernels.
+    """
+    left = hlen//2 if (hlen & 1) else hlen//2 - 1
+    return left, hlen - 1 - left
+
+
+def padded_shape(shape, kshape):
+    """
+    Shape of the padded arrays for the FFT convolution of an image of shape "shape" by a filter of shape "kshape" :
+    large enough to avoid the circular wrap-around, rounded up to powers of two.
+    """
+    return tuple(next_power_of_two(n + h - 1) for n, h in zip(shape, kshape))
+
+
+def direct_cost(shape, ksize, separable=True):
+    """
+    Number of multiply-adds of the direct convolution by a filter of size ksize on each axis
+    """
+    npix = int(np.prod(shape))
+    return npix * (len(shape) * ksize if separable else ksize ** len(shape))
+
+
+def fft_cost(shape, ksize):
+    """
+    Estimated cost of the FFT convolution by a filter of size ksize on each axis, in the unit of direct_cost()
+    """
+    padded = padded_shape(shape, (ksize,) * len(shape))
+    stages = sum(int(np.log2(n)) for n in padded)
+    return int(np.prod(padded)) * (2 * stages * FFT_STAGE_COST + FFT_EXTRA_COST)
+
+
+def fft_bytes(shape, ksize):
+    """
+    Device memory used by the FFT convolution by a filter of size ksize on each axis : the two complex work buffers
+    and the spectrum of the filter, each of the padded shape. Returns the total and the size of the largest buffer.
+    """
+    padded = padded_shape(shape, (ksize,) * len(shape))
+    nbytes = int(np.prod(padded)) * np.dtype(np.complex64).itemsize
+    return 3 * nbytes, nbytes
+
+
+def fft_fits(shape, ksize, device, mem_fraction=0.5):
+    """
+    Return True if the buffers of the FFT convolution fit in the memory of the device :
+    at most mem_fraction of the global memory, and each buffer below the maximum allocation size.
+    """
+    total, largest = fft_bytes(shape, ksize)
+    return total <= device.global_mem_size * mem_fraction and largest <= device.max_mem_alloc_size
+
+
+def use_fft(shape, ksize, separable=True, device=None):
+    """
+    Return True if the FFT convolution is expected to be faster than the direct convolution.
+    If a device is given, the padded buffers must also fit in its memory (see fft_fits()).
+    """
+    if device is not None and not fft_fits(shape, ksize, device):
+        return False
+    return fft_cost(shape, ksize) < direct_cost(shape, ksize, separable)
+
+
+
+class FFTConvol:
+    """
+    Helper class for the convolution of 2D images or 3D volumes in the frequency domain, on GPU.
+    The cost does not depend on the filter size, which makes it faster than the direct convolution for large filters
+    (for eg. Gaussian filters with a large sigma, or arbitrary non-separable filters).
+
+    The images are padded with their symmetric extension, so that the results are the same as the direct convolution
+    kernels (and as scipy.ndimage with mode="reflect"). The spectra of the filters are computed once for each
+    filter and padded shape, and stay on the device.
+    """
+
+
+    def __init__(self, shape, device=None, program_path=None, ocl=None, max_spectra=8):
+        """
+        @param shape : shape of the images/volumes to be filtered
+        @param device : (optional) device in the format (0, 0)
+        @param program_path : (optional) path of the FFT program
+        @param ocl : (optional) existing Ocl instance
+        @param max_spectra : (optional) number of filter spectra kept on the device. The least recently used are released.
+        """
+        self.ocl = ocl if ocl is not None else Ocl(device=device)
+        self.shape = tuple(shape)
+        if len(self.shape) not in [2, 3]:
+            raise ValueError("FFTConvol: expected a 2D or 3D shape, got %s" % str(self.shape))
+        self.program_path = program_path if program_path is not None else "opencl/fft.cl"
+        program = self.ocl.compile_file(self.program_path)
+        self.kernels = {}
+        for name in ["fft_local", "fft_radix2", "fft_multiply", "fft_crop"]:
+            self.kernels[name] = self.ocl.kernel(program, name)
+        self.pad_kernels = {}
+        self.max_spectra = max_spectra
+        self.spectra = OrderedDict() # (padded shape, filter key) -> device buffer
+        self.work = {} # padded shape -> (buffer, buffer)
+        self.twiddles = {} # transform length -> device buffer
+        self.max_wg = min(256, self.ocl.device.max_work_group_size)
+        # Longest transform done in local memory by fft_local, which uses two float2 arrays of n elements besides its
+        # own local variables. Half of the local memory is left as headroom for the runtime.
+        static_local = self.kernels["fft_local"].get_work_group_info(cl.kernel_work_group_info.LOCAL_MEM_SIZE, self.ocl.device)
+        self.max_local_n = max(self.ocl.device.local_mem_size - static_local, 0) // 32
+
+
+    def get_pad_kernel(self, dtype):
+        dtype = np.dtype(dtype)
+        if dtype not in CL_TYPES:
+            raise ValueError("FFTConvol: unsupported data type %s" % dtype)
+        if dtype not in self.pad_kernels:
+            program = self.ocl.compile_file(self.program_path, defines={"DTYPE": CL_TYPES[dtype]})
+            self.pad_kernels[dtype] = self.ocl.kernel(program, "fft_pad")
+        return self.pad_kernels[dtype]
+
+
+    def work_buffers(self, padded):
+        """
+        Return the two complex buffers of the transforms for a padded shape. Only the last padded shape is kept.
+        """
+        if padded not in self.work:
+            for buffers in self.work.values():
+                for buf in buffers:
+                    self.ocl.release_buffer(buf)
+            self.work = {padded: tuple(self.ocl.create_buffer(padded, np.complex64) for i in range(2))}
+        return self.work[padded]
+
+
+    def get_twiddles(self, n):
+        """
+        Return the device buffer of the twiddle factors exp(-2*i*pi*j/n), j < n/2, of the transforms of length n
+        """
+        if n not in self.twiddles:
+            tw = np.exp(-2j * np.pi * np.arange(n//2) / n).astype(np.complex64)
+            self.twiddles[n] = self.ocl.to_device(tw.view(np.float32), flags="r")
+        return self.twiddles[n]
+
+
+    def spectrum(self, padded, key, compute):
+        """
+        Return the device buffer of the spectrum of a filter, computed by compute() if not already on the device
+        """
+        key = (padded, key)
+        if key in self.spectra:
+            self.spectra.move_to_end(key)
+            return self.spectra[key]
+        # Transferred as interleaved float32 : Ocl converts the 64 bits types
+        spec = np.ascontiguousarray(compute(), dtype=np.complex64).view(np.float32)
+        self.spectra[key] = self.ocl.to_device(spec, flags="r")
+        while len(self.spectra) > self.max_spectra:
+            old_key, d_old = self.spectra.popitem(last=False)
+            self.ocl.release_buffer(d_old)
+        return self.spectra[key]
+
+
+    @staticmethod
+    def filter_spectrum_1d(coeffs, n):
+        """
+        Spectrum (of size n) of a 1D filter, with the center of the filter at index 0
+        """
+        kern = np.zeros(n, dtype=np.float64)
+        kern[:len(coeffs)] = coeffs
+        return np.fft.fft(np.roll(kern, -filter_sides(len(coeffs))[1]))
+
+
+    def separable_spectrum(self, coeffs, padded):
+        """
+        Spectrum of the separable filter made of the 1D filter coeffs on each axis, normalized for the inverse transform
+        """
+        spec = np.ones((), dtype=np.complex128)
+        for n in padded:
+            spec = np.multiply.outer(spec, FFTConvol.filter_spectrum_1d(coeffs, n))
+        return spec / np.prod(padded)
+
+
+    @staticmethod
+    def kernel_spectrum(kernel, padded):
+        """
+        Spectrum of an arbitrary filter, normalized for the inverse transform
+        """
+        kern = np.zeros(padded, dtype=np.float64)
+        kern[tuple(slice(0, h) for h in kernel.shape)] = kernel
+        kern = np.roll(kern, tuple(-filter_sides(h)[1] for h in kernel.shape), axis=tuple(range(kernel.ndim)))
+        return np.fft.fftn(kern) / np.prod(padded)
+
+
+    def fft(self, d_src, d_dst, padded, sign, wait_for=None):
+        """
+        Enqueue the FFT of d_src along all the axes, using d_dst as the other buffer.
+        Returns the buffer holding the result (d_src or d_dst) and the event of the last launch.
+        """
+        total = int(np.prod(padded))
+        ev = None
+        for axis in range(len(padded)):
+            # Transforms of length n, with elements at distance "stride" ; the other axes give the batch
+            n, stride = padded[axis], int(np.prod(padded[axis+1:]))
+            n_batch = total // n
+            if n == 1:
+                continue
+            d_twiddles = self.get_twiddles(n)
+            stats = {"nbytes": total*16, "flops": 5*total*int(np.log2(n))}
+            if n <= self.max_local_n:
+                wg = min(n//2, self.max_wg)
+                ev = self.ocl.call(self.kernels["fft_local"], (wg, n_batch), (wg, 1), d_src, d_twiddles, n, stride, n_batch,
+                                   np.float32(sign), cl.LocalMemory(n*8), cl.LocalMemory(n*8), wait_for=wait_for, **stats)
+                wait_for = None # the next launches are ordered by the in-order queue
+                continue
+            p = 1
+            while p < n:
+                ev = self.ocl.call(self.kernels["fft_radix2"], (n//2, n_batch), None, d_src, d_dst, d_twiddles, n, stride,
+                                   p, n_batch, np.float32(sign), wait_for=wait_for, nbytes=total*16, flops=5*total)
+                wait_for = None
+                d_src, d_dst = d_dst, d_src
+                p *= 2
+        return d_src, ev
+
+
+    def convolve_spectrum(self, d_input, d_spectrum, kshape, padded, d_output=None, input_dtype=np.float32, wait_for=None):
+        """
+        Enqueue the convolution of d_input by the filter of spectrum d_spectrum.
+        Returns the float32 output device buffer and the event of the last kernel.
+        """
+        dims = (tuple(reversed(self.shape)) + (1,))[:3]
+        pdims = (tuple(reversed(padded)) + (1,))[:3]
+        offsets = (tuple(reversed([filter_sides(h)[0] for h in kshape])) + (0,))[:3]
+        if d_output is None:
+            d_output = self.ocl.create_buffer(self.shape, np.float32)
+        d_a, d_b = self.work_buffers(padded)
+        total = int(np.prod(padded))
+        npix = int(np.prod(self.shape))
+        self.ocl.call(self.get_pad_kernel(input_dtype), pdims, None, d_input, d_a, *(dims + pdims + offsets),
+                      wait_for=wait_for, nbytes=npix*np.dtype(input_dtype).itemsize + total*8)
+        d_freq, ev = self.fft(d_a, d_b, padded, 1)
+        self.ocl.call(self.kernels["fft_multiply"], (total,), None, d_freq, d_spectrum, total, nbytes=total*24, flops=6*total)
+        d_res, ev = self.fft(d_freq, d_b if d_freq is d_a else d_a, padded, -1)
+        ev = self.ocl.call(self.kernels["fft_crop"], dims, None, d_res, d_output, *(dims + pdims[:2] + offsets), nbytes=npix*12)
+        return d_output, ev
+
+
+    def gaussian_filter_device(self, d_input, sigma, d_output=None, input_dtype=np.float32, truncate=4, wait_for=None):
+        """
+        Gaussian filter of an image/volume already on the device.
+        Returns the float32 output device buffer and the event of the last kernel.
+
+        @param d_input : device buffer of the shape given at initialization
+        @param sigma : standard deviation of the Gaussian
+        @param d_output : (optional) output device buffer
+        @param input_dtype : (optional) data type of d_input
+        @param truncate : (optional) the filter is truncated at this number of standard deviations
+        @param wait_for : (optional) list of events to wait for
+        """
+        ksize = 2 * int(truncate * float(sigma) + 0.5) + 1
+        kshape = (ksize,) * len(self.shape)
+        padded = padded_shape(self.shape, kshape)
+        d_spectrum = self.spectrum(padded, ("gaussian", float(sigma), truncate),
+                                   lambda: self.separable_spectrum(gaussian_kernel(sigma, truncate), padded))
+        return self.convolve_spectrum(d_input, d_spectrum, kshape, padded, d_output=d_output, input_dtype=input_dtype, wait_for=wait_for)
+
+
+    def convolve_device(self, d_input, kernel, d_output=None, input_dtype=np.float32, wait_for=None):
+        """
+        Convolution of an image/volume already on the device by an arbitrary filter, with the same convention
+        as nonseparable_convolution. Returns the float32 output device buffer and the event of the last kernel.
+
+        @param d_input : device buffer of the shape given at initialization
+        @param kernel : numpy array of the filter, with the same number of dimensions as the images
+        @param d_output : (optional) output device buffer
+        @param input_dtype : (optional) data type of d_input
+        @param wait_for : (optional) list of events to wait for
+        """
+        kernel = np.asarray(kernel, dtype=np.float64)
+        if kernel.ndim != len(self.shape):
+            raise ValueError("FFTConvol: expected a %dD filter, got shape %s" % (len(self.shape), str(kernel.shape)))
+        padded = padded_shape(self.shape, kernel.shape)
+        key = ("kernel", kernel.shape, hashlib.md5(kernel.tobytes()).hexdigest())
+        d_spectrum = self.spectrum(padded, key, lambda: FFTConvol.kernel_spectrum(kernel, padded))
+        return self.convolve_spectrum(d_input, d_spectrum, kernel.shape, padded, d_output=d_output, input_dtype=input_dtype, wait_for=wait_for)
+
+
+    def run(self, image, func, *args):
+        image = np.asarray(image)
+        if image.shape != self.shape:
+            raise ValueError("FFTConvol: invalid image size: expected %s, got %s" % (str(self.shape), str(image.shape)))
+        if image.dtype not in CL_TYPES:
+            image = Ocl.check_array(image)
+        d_input = self.ocl.to_device(image, flags="r")
+        d_output, ev = func(d_input, *args, input_dtype=image.dtype)
+        res = self.ocl.fetch(d_output)
+        self.ocl.release_buffer(d_input)
+        self.ocl.release_buffer(d_output)
+        return res
+
+
+    def gaussian_filter(self, image, sigma):
+        """
+        Gaussian filter of an image/volume. Returns a float32 numpy array.
+        """
+        return self.run(image, self.gaussian_filter_device, sigma)
+
+
+    def convolve(self, image, kernel):
+        """
+        Convolution of an image/volume by an arbitrary filter. Returns a float32 numpy array.
+        """
+        return self.run(image, self.convolve_device, kernel)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import weakref
+from collections import OrderedDict
+
+
+def gaussian_kernel(sigma, truncate=4, order=0):
+    """
+    Coefficients of a 1D Gaussian filter, or of a derivative of Gaussian filter, as in scipy.ndimage.gaussian_filter1d.
+    The radius of the filter is truncate standard deviations. Returns a float64 array of 2*radius + 1 coefficients,
+    to be used by the convolution kernels as they are.
+
+    @param sigma : standard deviation of the Gaussian
+    @param truncate : (optional) radius of the filter, in standard deviations
+    @param order : (optional) order of the derivative : 0 for the Gaussian, 1 for the first derivative, ...
+    """
+    if order < 0:
+        raise ValueError("gaussian_kernel(): order must be non negative, got %d" % order)
+    sigma = float(sigma)
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    sigma2 = sigma * sigma
+    phi = np.exp(-0.5 / sigma2 * x * x)
+    phi /= phi.sum()
+    if order == 0:
+        return phi
+    # The derivative of order n is q_n(x) * phi(x), with q_0 = 1 and q_{n+1}(x) = q_n'(x) - q_n(x) * x / sigma^2 :
+    # q is represented by its polynomial coefficients
+    exponents = np.arange(order + 1)
+    q = np.zeros(order + 1)
+    q[0] = 1
+    derivative = np.diag(exponents[1:], 1) + np.diag(np.ones(order) / -sigma2, -1)
+    for i in range(order):
+        q = derivative.dot(q)
+    return (x[:, None] ** exponents).dot(q) * phi
+
+
+def comp_kern_scipy(sigma, truncate=4):
+    """
+    Coefficients of the 1D Gaussian filter of scipy.ndimage.gaussian_filter (see gaussian_kernel())
+    """
+    return gaussian_kernel(sigma, truncate)
+
+
+
+# Coefficient caches of each Ocl instance
+_caches = weakref.WeakKeyDictionary()
+
+
+class FilterCache:
+    """
+    Device buffers of filter coefficients, computed and transferred once for each (sigma, truncate, order, data type).
+    The least recently used buffers are released when the cache is full.
+    The buffers belong to the cache : they must not be released by the callers.
+    The cache only keeps a weak reference to its Ocl instance, which is the key of the cache in filter_cache().
+    """
+
+    def __init__(self, ocl, max_size=32):
+        """
+        @param ocl : Ocl instance
+        @param max_size : (optional) maximum number of buffers kept on the device
+        """
+        self.ocl_ref = weakref.ref(ocl)
+        self.max_size = max_size
+        self.buffers = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    @property
+    def ocl(self):
+        return self.ocl_ref()
+
+
+    def get(self, sigma, truncate=4, order=0, dtype=np.float32):
+        """
+        Return the device buffer of a Gaussian filter (see gaussian_kernel()) and its size
+        """
+        key = (float(sigma), float(truncate), int(order), np.dtype(dtype).str)
+        if key in self.buffers:
+            self.hits += 1
+            self.buffers.move_to_end(key)
+            return self.buffers[key]
+        self.misses += 1
+        coeffs = gaussian_kernel(sigma, truncate, order).astype(dtype)
+        self.buffers[key] = (self.ocl.to_device(coeffs, flags="r"), coeffs.shape[0])
+        while len(self.buffers) > self.max_size:
+            old_key, (d_old, size) = self.buffers.popitem(last=False)
+            self.ocl.release_buffer(d_old)
+        return self.buffers[key]
+
+
+    def clear(self):
+        ocl = self.ocl
+        if ocl is not None: # otherwise the buffers are released with the context
+            for d_id, size in self.buffers.values():
+                ocl.release_buffer(d_id)
+        self.buffers.clear()
+
+
+    def stats(self):
+        return {"entries": len(self.buffers), "hits": self.hits, "misses": self.misses}
+
+
+
+def filter_cache(ocl):
+    """
+    Return the FilterCache shared by all the users of an Ocl instance
+    """
+    if ocl not in _caches:
+        _caches[ocl] = FilterCache(ocl)
+    return _caches[ocl]
+
+
+def device_gaussian(ocl, sigma, truncate=4, order=0, dtype=np.float32):
+    """
+    Return the device buffer of a Gaussian filter and its size, from the FilterCache of ocl
+    """
+    return filter_cache(ocl).get(sigma, truncate, order, dtype)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from collections import deque
+from oclutils import Ocl, CL_TYPES
+
+
+def myflatfield(raw, dark, flat, take_log=False, eps=1e-6, invalid_value=0.0, log_min=1e-6):
+    """
+    Reference for FlatField
+    """
+    dark = np.asarray(dark, dtype=np.float32)
+    diff = np.asarray(flat, dtype=np.float32) - dark
+    valid = np.abs(diff) > eps
+    res = (np.asarray(raw, dtype=np.float32) - dark) / np.where(valid, diff, 1)
+    if take_log:
+        res = -np.log(np.maximum(res, log_min))
+    return np.where(valid, res, invalid_value).astype(np.float32)
+
+
+class FlatField:
+    """
+    Helper class for the flat-field correction (raw - dark) / (flat - dark) of frames on GPU.
+    The dark and flat fields are transferred once and stay on the device. The raw frames can be
+    integers (for eg. uint16 from the detector) : they are converted by the kernel.
+    The corrected frames can be used on the device by other kernels, for eg. :
+        d_corr, ev = ff.correct_device(d_raw, n_frames, np.uint16)
+        d_res, ev = conv.gaussian_filter_device(d_corr, sigma, wait_for=[ev])
+    """
+
+
+    def __init__(self, dark, flat, device=None, program_path=None, ocl=None, take_log=False, eps=1e-6, invalid_value=0.0, log_min=1e-6):
+        """
+        @param dark : dark field (Nr, Nc). A stack of dark fields (n, Nr, Nc) is averaged.
+        @param flat : flat field (Nr, Nc). A stack of flat fields (n, Nr, Nc) is averaged.
+        @param device : (optional) device in the format (0, 0)
+        @param program_path : (optional) path of the flat-field program
+        @param ocl : (optional) existing Ocl instance
+        @param take_log : (optional) if True, the result is -log() of the corrected frames
+        @param eps : (optional) pixels where |flat - dark| <= eps are considered invalid
+        @param invalid_value : (optional) value of the invalid pixels
+        @param log_min : (optional) with take_log, the corrected values are clipped to log_min before the log
+        """
+        self.ocl = ocl if ocl is not None else Ocl(device=device)
+        if program_path is None:
+            program_path = "opencl/flatfield.cl"
+        self.program_path = program_path
+        self.take_log = take_log
+        self.invalid_value = invalid_value
+        self.log_min = log_min
+        self.kernels = {}
+        self.streams = []
+
+        dark = np.asarray(dark, dtype=np.float32)
+        flat = np.asarray(flat, dtype=np.float32)
+        if dark.ndim == 3:
+            dark = dark.mean(axis=0)
+        if flat.ndim == 3:
+            flat = flat.mean(axis=0)
+        if dark.shape != flat.shape:
+            raise ValueError("FlatField: dark and flat have different shapes: %s and %s" % (str(dark.shape), str(flat.shape)))
+        self.shape = dark.shape
+        self.frame_size = dark.size
+
+        # Resident data : dark and gain = 1/(flat - dark)
+        self.d_dark = self.ocl.to_device(dark, flags="r")
+        d_flat = self.ocl.to_device(flat, flags="r")
+        self.d_gain = self.ocl.create_buffer(self.shape, np.float32)
+        program = self.ocl.compile_file(self.program_path)
+        self.ocl.call(self.ocl.kernel(program, "flatfield_gain"), (self.frame_size,), None,
+                      self.d_dark, d_flat, self.d_gain, self.frame_size, np.float32(eps)).wait()
+        self.ocl.release_buffer(d_flat)
+
+
+    def get_kernel(self, dtype):
+        """
+        Return the correction kernel for a data type of the raw frames. The program is built once for each data type.
+        """
+        dtype = np.dtype(dtype)
+        if dtype not in CL_TYPES:
+            raise ValueError("FlatField: unsupported data type %s" % dtype)
+        if dtype not in self.kernels:
+            program = self.ocl.compile_file(self.program_path, defines={"DTYPE": CL_TYPES[dtype]})
+            self.kernels[dtype] = self.ocl.kernel(program, "flatfield")
+        return self.kernels[dtype]
+
+
+    def correct_device(self, d_raw, n_frames, dtype, d_output=None, queue=None, wait_for=None):
+        """
+        Correct frames already on the device. Returns the float32 output device buffer and the event of the kernel.
+
+        @param d_raw : device buffer of n_frames raw frames
+        @param n_frames : number of frames in d_raw
+        @param dtype : data type of the raw frames
+        @param d_output : (optional) output device buffer, at least n_frames float32 frames
+        @param queue : (optional) command queue
+        @param wait_for : (optional) list of events to wait for
+        """
+        if d_output is None:
+            d_output = self.ocl.create_buffer((n_frames,) + self.shape, np.float32)
+        ev = self.ocl.call(self.get_kernel(dtype), (self.frame_size, n_frames), None,
+                           d_raw, d_output, self.d_dark, self.d_gain, self.frame_size, n_frames,
+                           np.float32(self.invalid_value), int(self.take_log), np.float32(self.log_min),
+                           queue=queue, wait_for=wait_for, nbytes=n_frames*self.frame_size*(np.dtype(dtype).itemsize + 4))
+        return d_output, ev
+
+
+    def check_frames(self, frames):
+        frames = np.asarray(frames)
+        if frames.dtype not in CL_TYPES:
+            frames = Ocl.check_array(frames)
+        if frames.shape[-2:] != self.shape:
+            raise ValueError("FlatField: invalid frame size: expected %s, got %s" % (str(self.shape), str(frames.shape[-2:])))
+        return frames
+
+
+    def correct(self, frames):
+        """
+        Correct a frame (Nr, Nc) or a batch of frames (n_frames, Nr, Nc). Returns a float32 array of the same shape.
+        """
+        frames = self.check_frames(frames)
+        n_frames = 1 if frames.ndim == 2 else frames.shape[0]
+        d_raw = self.ocl.to_device(frames, flags="r")
+        d_output, ev = self.correct_device(d_raw, n_frames, frames.dtype)
+        res = self.ocl.fetch(d_output, dest=np.empty(frames.shape, dtype=np.float32))
+        self.ocl.release_buffer(d_raw)
+        self.ocl.release_buffer(d_output)
+        return res
+
+
+    def stream_slots(self, nbuffers, nbytes_raw, nbytes_out):
+        """
+        Return nbuffers slots (command queue, raw buffer, output buffer) for the streaming mode.
+        Slots are created once and then reused ; their buffers are reallocated for larger batches.
+        """
+        while len(self.streams) < nbuffers:
+            self.streams.append([self.ocl.create_queue(), None, None])
+        for slot in self.streams[:nbuffers]:
+            for i, nbytes in [(1, nbytes_raw), (2, nbytes_out)]:
+                if slot[i] is None or slot[i].size < nbytes:
+                    if slot[i] is not None:
+                        self.ocl.release_buffer(slot[i])
+                    slot[i] = self.ocl.create_buffer(nbytes, np.uint8)
+        return self.streams[:nbuffers]
+
+
+    def correct_stream(self, batches, nbuffers=2):
+        """
+        Correct a stream of frames or batches of frames, and yield the results in the same order.
+        The upload of a batch, the correction of another one and the download of a third one can overlap.
+
+        @param batches : iterable of frames (Nr, Nc) or batches of frames (n_frames, Nr, Nc)
+        @param nbuffers : (optional) number of batches in flight
+        """
+        pending = deque()
+        slots = []
+        try:
+            for i, frames in enumerate(batches):
+                if len(pending) == nbuffers:
+                    res, ev = pending.popleft()
+                    ev.wait()
+                    yield res
+                frames = self.check_frames(frames)
+                n_frames = 1 if frames.ndim == 2 else frames.shape[0]
+                if not(slots) or slots[i % nbuffers][1].size < frames.nbytes or slots[i % nbuffers][2].size < frames.size * 4:
+                    # The buffers of the slot may be reallocated : wait for the batches in flight
+                    for slot in slots:
+                        slot[0].finish()
+                    slots = self.stream_slots(nbuffers, frames.nbytes, frames.size * 4)
+                queue, d_raw, d_output = slots[i % nbuffers]
+                d_raw, ev = self.ocl.to_device(frames, destbuf=d_raw, is_blocking=False, return_event=True, queue=queue)
+                d_output, ev = self.correct_device(d_raw, n_frames, frames.dtype, d_output=d_output, queue=queue, wait_for=[ev])
+                res, ev = self.ocl.fetch(d_output, dest=np.empty(frames.shape, dtype=np.float32), return_event=True, wait_for=[ev], is_blocking=False, queue=queue)
+                queue.flush()
+                pending.append((res, ev))
+            while pending:
+                res, ev = pending.popleft()
+                ev.wait()
+                yield res
+        finally:
+            for slot in slots:
+                slot[0].finish()
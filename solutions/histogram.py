@@ -1,6 +1,6 @@
 import numpy as np
+import pyopencl as cl
 from oclutils import Ocl
-import matplotlib.pyplot as plt
 
 
 def myhist256(img):
@@ -9,8 +9,120 @@ def myhist256(img):
     return h[0]
 
 
+def myhistogram(data, nbins, hist_range, weights=None):
+    """
+    Reference for Histogram : histogram of each frame of a stack (or of a single image)
+    """
+    if data.ndim < 3:
+        return np.histogram(data, bins=nbins, range=hist_range, weights=weights)[0]
+    res = []
+    for i in range(data.shape[0]):
+        res.append(np.histogram(data[i], bins=nbins, range=hist_range, weights=None if weights is None else weights[i])[0])
+    return np.array(res)
+
+
+class Histogram:
+    """
+    Helper class for histograms on GPU, with an arbitrary number of bins over a float range,
+    optional weights, and batches of frames.
+    Each work-group accumulates a private histogram in local memory before merging it into the result.
+    """
+
+    def __init__(self, nbins=256, hist_range=None, device=None, program_path=None, ocl=None, wg=256):
+        """
+        @param nbins : (optional) number of bins
+        @param hist_range : (optional) (vmin, vmax) range of the histogram. If not provided,
+            the range of the data is used (which requires the data on the host).
+        @param device : (optional) device in the format (0, 0)
+        @param program_path : (optional) path of the histogram program
+        @param ocl : (optional) existing Ocl instance
+        @param wg : (optional) work-group size
+        """
+        self.ocl = ocl if ocl is not None else Ocl(device=device)
+        if program_path is None:
+            program_path = "opencl/histogram.cl"
+        program = self.ocl.compile_file(program_path)
+        self.kernel = self.ocl.kernel(program, "histogram_local")
+        self.kernel_weighted = self.ocl.kernel(program, "histogram_local_weighted")
+        self.nbins = nbins
+        self.hist_range = hist_range
+        self.wg = min(wg, self.ocl.device.max_work_group_size)
+        if nbins * 4 > self.ocl.device.local_mem_size:
+            raise ValueError("Histogram: %d bins do not fit in the local memory of the device (%d bytes)" % (nbins, self.ocl.device.local_mem_size))
+
+
+    @staticmethod
+    def check_range(hist_range):
+        """
+        Return the (vmin, vmax) range as float32. As in np.histogram, an empty range (for eg. the range of a
+        constant image) is widened to (vmin - 0.5, vmax + 0.5), so that the bin width is not zero.
+        """
+        vmin, vmax = float(hist_range[0]), float(hist_range[1])
+        if vmin > vmax:
+            raise ValueError("Histogram: the range must be increasing, got (%g, %g)" % (vmin, vmax))
+        if vmin == vmax:
+            vmin, vmax = vmin - 0.5, vmax + 0.5
+        return np.float32(vmin), np.float32(vmax)
+
+
+    def compute_device(self, d_data, shape, weights=None, hist_range=None):
+        """
+        Compute the histogram of data already on the device.
+        Returns the device buffer of the histogram(s), of shape (nbins,) or (n_frames, nbins) for a 3D stack.
+
+        @param d_data : device buffer of float32 data
+        @param shape : shape of the data : (n_frames, Nr, Nc) for a stack of frames, otherwise a single frame
+        @param weights : (optional) device buffer or numpy array of float32 weights, of the same shape
+        @param hist_range : (optional) (vmin, vmax) range of the histogram. Default is the range given at initialization.
+        """
+        hist_range = hist_range or self.hist_range
+        if hist_range is None:
+            raise ValueError("Histogram: the range must be provided for data on the device")
+        n_frames = shape[0] if len(shape) == 3 else 1
+        n = int(np.prod(shape)) // n_frames
+        hist_shape = (n_frames, self.nbins) if len(shape) == 3 else (self.nbins,)
+        vmin, vmax = Histogram.check_range(hist_range)
+        # Enough work-groups to occupy the device, each of them looping over its part of the frame
+        n_groups = max(1, min((n + self.wg - 1) // self.wg, 4 * self.ocl.device.max_compute_units))
+        grid = (n_groups * self.wg, n_frames)
+        block = (self.wg, 1)
+        if weights is None:
+            d_hist = self.ocl.create_buffer_zeros(hist_shape, np.int32)
+            self.ocl.call(self.kernel, grid, block, d_data, d_hist, n, self.nbins, vmin, vmax,
+                          cl.LocalMemory(self.nbins * 4), nbytes=n*n_frames*4)
+        else:
+            d_weights = weights if isinstance(weights, cl.Buffer) else self.ocl.to_device(np.asarray(weights, dtype=np.float32))
+            d_hist = self.ocl.create_buffer_zeros(hist_shape, np.float32)
+            self.ocl.call(self.kernel_weighted, grid, block, d_data, d_weights, d_hist, n, self.nbins, vmin, vmax,
+                          cl.LocalMemory(self.nbins * 4), nbytes=2*n*n_frames*4)
+            if d_weights is not weights:
+                self.ocl.release_buffer(d_weights)
+        return d_hist
+
+
+    def compute(self, data, weights=None, hist_range=None):
+        """
+        Compute the histogram of an image, or of each frame of a 3D stack.
+        Returns a numpy array of shape (nbins,) or (n_frames, nbins). The histogram is int32 without weights,
+        float32 with weights.
+
+        @param data : numpy array (any numeric type)
+        @param weights : (optional) weights, of the same shape as data
+        @param hist_range : (optional) (vmin, vmax) range of the histogram.
+            Default is the range given at initialization, or the range of the data.
+        """
+        hist_range = hist_range or self.hist_range or (float(data.min()), float(data.max()))
+        d_data = self.ocl.to_device(np.asarray(data, dtype=np.float32), flags="r")
+        d_hist = self.compute_device(d_data, data.shape, weights=weights, hist_range=hist_range)
+        res = self.ocl.fetch(d_hist)
+        self.ocl.release_buffer(d_data)
+        self.ocl.release_buffer(d_hist)
+        return res
+
+
 if __name__ == "__main__":
 
+    import matplotlib.pyplot as plt
     from scipy.misc import lena
     img = lena().astype(np.int32) # !
 
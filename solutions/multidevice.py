@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import threading
+import time
+import pyopencl as cl
+from oclutils import Ocl, list_devices, select_device
+
+
+def split_device(device, n):
+    """
+    Partition a device (typically a CPU) into n sub-devices with the same number of compute units.
+    Returns the list of sub-devices, or [device] if the device cannot be partitioned.
+
+    @param device : pyopencl.Device
+    @param n : number of sub-devices
+    """
+    units = max(1, device.max_compute_units // n)
+    try:
+        return device.create_sub_devices([cl.device_partition_property.EQUALLY, units])[:n]
+    except (cl.LogicError, cl.RuntimeError, AttributeError):
+        return [device]
+
+
+def all_devices(device_type=None):
+    """
+    Return all the devices of all the platforms, optionally of a given type (for eg. cl.device_type.GPU)
+    """
+    return [dev for i_p, i_dev, dev in list_devices() if device_type is None or (dev.type & device_type)]
+
+
+def chunk_window(z0, z1, size, halo, n):
+    """
+    Window [a0, a1) of the data given to the processing of the chunk [z0, z1) by MultiOcl.map() : the chunk
+    extended by the halo on both sides, of length min(size + 2*halo, n) whatever the position of the chunk.
+    On the borders of the data (and for the last chunk, shorter than size), the window is shifted inside the data.
+    The result of the chunk is then the part [z0 - a0, z1 - a0) of the result of the window.
+
+    @param z0, z1 : first and last (excluded) items of the chunk
+    @param size : nominal size of the chunk (z1 - z0 <= size)
+    @param halo : number of items needed on both sides of the chunk
+    @param n : number of items of the data
+    """
+    length = min(size + 2*halo, n)
+    a0 = min(max(z0 - halo, 0), n - length)
+    return a0, a0 + length
+
+
+class MultiOcl:
+    """
+    Distribute the processing of a batch of frames, or of the slabs of a volume, over several devices.
+    Each device has its own Ocl instance and a host thread which takes chunks of the batch from a shared counter :
+    faster devices process more chunks. The size of the chunks taken by a device is also scaled by its
+    throughput measured on the previous chunks (chunk_size times a power of two, up to max_factor), so that each
+    device gets enough work to be kept busy. The results are gathered in the order of the batch.
+
+    Example : flat-field correction of frames on all the devices
+        multi = MultiOcl()
+        res = multi.map(lambda ff, chunk: ff.correct(chunk), frames, init=lambda ocl: FlatField(dark, flat, ocl=ocl), name="flatfield")
+    """
+
+
+    def __init__(self, devices=None, ocls=None, sub_devices=None, **ocl_options):
+        """
+        @param devices : (optional) list of devices in the format (0, 0) or pyopencl.Device. Default is all the devices.
+        @param ocls : (optional) list of existing Ocl instances, used instead of devices
+        @param sub_devices : (optional) if provided, each CPU device is partitioned into this number of sub-devices
+        @param ocl_options : (optional) other arguments given to Ocl(), for eg. pool_size
+        """
+        if ocls is None:
+            if devices is None:
+                devices = all_devices()
+            if sub_devices:
+                split = []
+                for dev in devices:
+                    if not isinstance(dev, cl.Device):
+                        dev = select_device({"index": tuple(dev)})[2]
+                    split += split_device(dev, sub_devices) if (dev.type & cl.device_type.CPU) else [dev]
+                devices = split
+            ocls = [Ocl(device=dev, **ocl_options) for dev in devices]
+        if not ocls:
+            raise ValueError("MultiOcl: no device")
+        self.ocls = list(ocls)
+        self.throughput = [None] * len(self.ocls) # items/s, measured on the previous chunks
+        self.processed = [0] * len(self.ocls)
+        self.ema = 0.5 # weight of the last measurement in the throughput estimate
+        self.states = {} # (device index, name) -> object created by the init function given to map()
+
+
+    def chunk_for(self, i, chunk_size, max_factor=4):
+        """
+        Number of items taken at once by device i : chunk_size times the power of two (up to max_factor)
+        closest to its relative throughput. The chunks have a few sizes only, for the helpers of fixed shape.
+        """
+        known = [t for t in self.throughput if t]
+        if not(self.throughput[i]) or not(known):
+            return chunk_size
+        ratio = self.throughput[i] / np.mean(known)
+        factor = 2 ** int(round(np.log2(min(max(ratio, 1), max_factor))))
+        return chunk_size * factor
+
+
+    def state(self, i, init, name=None, states=None):
+        """
+        Per-device object created by init(ocl), once for each device and each name
+        """
+        states = self.states if states is None else states
+        key = (i, name)
+        if key not in states:
+            states[key] = init(self.ocls[i])
+        return states[key]
+
+
+    def clear_states(self, name=None):
+        """
+        Forget the per-device objects created for a name, or all of them if name is None
+        """
+        for key in [k for k in self.states if name is None or k[1] == name]:
+            self.states.pop(key)
+
+
+    def map(self, func, data, init=None, halo=0, chunk_size=None, name=None, adaptive=True):
+        """
+        Process data by chunks along its first axis on all the devices, and return the concatenated results.
+
+        func is given windows of the data of a fixed length for each chunk size : the chunk extended by the halo
+        on both sides, shifted inside the data on its borders (and for the last chunk). With adaptive=False, all
+        the windows have the same length min(chunk_size + 2*halo, len(data)), so that func can use a helper
+        built for a fixed shape (for eg. a Gpuconvol). With adaptive=True, the length also depends on the chunk
+        size : chunk_size, 2*chunk_size, ... up to 4*chunk_size, plus the halos.
+
+        @param func : function func(state, window) returning the result of a window, as a numpy array with the same
+            first dimension as the window. state is init(ocl) if init is provided, otherwise the Ocl instance of the device.
+        @param data : array-like (numpy array, np.memmap, HDF5 dataset, ...) sliced along its first axis
+        @param init : (optional) function init(ocl) creating the per-device object (for eg. a Gpuconvol).
+            It is called once for each device in this call of map(), or once for each device and name.
+        @param halo : (optional) number of items added on both sides of the chunks (for eg. the half-width of a filter
+            for the slabs of a volume). The results of the halo are discarded.
+        @param chunk_size : (optional) number of items per chunk. Default is a quarter of the items per device.
+        @param name : (optional) name of the per-device objects : they are kept, and reused by the next calls of map()
+            with the same name (see clear_states())
+        @param adaptive : (optional) if False, all the devices take chunks of chunk_size items
+        @return the concatenated results. An empty data gives an empty array of the shape and type of data.
+        """
+        n = len(data)
+        if n == 0:
+            return np.empty((0,) + tuple(np.shape(data)[1:]), dtype=getattr(data, "dtype", np.float32))
+        n_dev = len(self.ocls)
+        if chunk_size is None:
+            chunk_size = max(1, n // (4 * n_dev))
+        states = self.states if name is not None else {}
+        results = {}
+        errors = []
+        counter = [0]
+        lock = threading.Lock()
+
+        def worker(i):
+            try:
+                state = self.state(i, init, name, states) if init is not None else self.ocls[i]
+                while not(errors):
+                    with lock:
+                        z0 = counter[0]
+                        if z0 >= n:
+                            return
+                        size = self.chunk_for(i, chunk_size) if adaptive else chunk_size
+                        z1 = min(z0 + size, n)
+                        counter[0] = z1
+                    t0 = time.time()
+                    a0, a1 = chunk_window(z0, z1, size, halo, n)
+                    res = np.asarray(func(state, data[a0:a1]))
+                    results[z0] = res[z0-a0:z0-a0 + (z1-z0)]
+                    t = (z1 - z0) / max(time.time() - t0, 1e-9)
+                    with lock:
+                        self.processed[i] += z1 - z0
+                        self.throughput[i] = t if not(self.throughput[i]) else self.ema * t + (1 - self.ema) * self.throughput[i]
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_dev)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return np.concatenate([results[z0] for z0 in sorted(results.keys())])
+
+
+    def stats(self):
+        """
+        Number of items processed and measured throughput (items/s) of each device
+        """
+        return [{"device": ocl.devicename, "processed": p, "throughput": t} for ocl, p, t in zip(self.ocls, self.processed, self.throughput)]
@@ -31,6 +31,12 @@
 
 import numpy as np
 import os
+import hashlib
+import json
+import tempfile
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 import pyopencl as cl
 import pyopencl.array as parray
 
@@ -47,6 +53,627 @@ def next32(i):
 
 
 
+class BinaryCache:
+    """
+    Persistent on-disk cache of compiled OpenCL programs.
+    The binaries are content-addressed : the key is a hash of the source code,
+    the build options, the device name and the driver version.
+    When the total size of the cache exceeds max_size, the least recently used
+    binaries are evicted.
+    """
+
+    def __init__(self, path, max_size=256*1024**2):
+        """
+        @param path : directory where the binaries are stored. It is created if needed.
+        @param max_size : (optional) maximum size of the cache, in bytes
+        """
+        if not(os.path.isdir(path)):
+            os.makedirs(path)
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    @staticmethod
+    def key(src, options, device):
+        """
+        Compute the key of a program.
+
+        @param src : source code of the program
+        @param options : list of build options
+        @param device : pyopencl.Device the program is built for
+        """
+        h = hashlib.sha1()
+        for item in [src, " ".join(options), device.platform.name, device.name, device.driver_version, cl.VERSION_TEXT]:
+            h.update(item.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+
+    def fname(self, key):
+        return os.path.join(self.path, key + ".bin")
+
+
+    def load(self, key):
+        """
+        Return the binary associated to a key, or None if it is not in the cache.
+        """
+        fname = self.fname(key)
+        try:
+            with open(fname, "rb") as fid:
+                binary = fid.read()
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        os.utime(fname, None) # mark as recently used
+        self.hits += 1
+        return binary
+
+
+    def store(self, key, binary):
+        """
+        Store a binary in the cache, and evict old entries if the cache is full.
+        The file is first written to a temporary location, so that concurrent
+        processes never read a partially written binary.
+        """
+        fd, tmpname = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fid:
+            fid.write(binary)
+        os.replace(tmpname, self.fname(key))
+        self.trim()
+
+
+    def discard(self, key):
+        """
+        Remove an entry from the cache (for eg. a binary rejected by the driver).
+        """
+        try:
+            os.remove(self.fname(key))
+        except OSError:
+            pass
+
+
+    def entries(self):
+        """
+        Return a list of (mtime, size, file name) of the cached binaries, the oldest first.
+        """
+        res = []
+        for f in os.listdir(self.path):
+            if not(f.endswith(".bin")): continue
+            fname = os.path.join(self.path, f)
+            try:
+                st = os.stat(fname)
+            except OSError: # removed by another process
+                continue
+            res.append((st.st_mtime, st.st_size, fname))
+        return sorted(res)
+
+
+    def trim(self):
+        """
+        Evict the least recently used binaries until the cache size is below max_size.
+        """
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for mtime, size, fname in entries:
+            if total <= self.max_size: break
+            try:
+                os.remove(fname)
+                self.evictions += 1
+            except OSError:
+                pass
+            total -= size
+
+
+    def clear(self):
+        for mtime, size, fname in self.entries():
+            os.remove(fname)
+
+
+    def stats(self):
+        """
+        Return a dictionary with the cache statistics.
+        """
+        entries = self.entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "size": sum(e[1] for e in entries),
+            "max_size": self.max_size,
+        }
+
+
+
+
+class BufferPool:
+    """
+    Pool of device buffers, avoiding an allocation each time a buffer is needed.
+    The buffers are allocated by size classes (powers of two). A released buffer is kept
+    in the pool, and can be handed back to a later request of the same size class and flags.
+    When the idle buffers exceed max_size bytes, the least recently released are freed.
+    A buffer can be released while commands using it are still queued (for eg. on another queue) : the events of
+    these commands are recorded by track(), and a released buffer is only handed back once they are complete.
+    """
+
+    def __init__(self, ctx, max_size=512*1024**2):
+        """
+        @param ctx : pyopencl.Context
+        @param max_size : (optional) maximum amount of memory, in bytes, kept by the idle buffers
+        """
+        self.ctx = ctx
+        self.max_size = max_size
+        self.owned = {}         # buffer id -> (flags, size class)
+        self.free = {}          # (flags, size class) -> list of idle buffers ids
+        self.idle = OrderedDict() # idle buffers, the least recently used first : buffer id -> buffer
+        self.events = {}        # buffer id -> events of the commands using the buffer, possibly not complete
+        self.idle_bytes = 0
+        self.used_bytes = 0
+        self.peak_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    @staticmethod
+    def size_class(nbytes):
+        """
+        Round a number of bytes up to the next power of two
+        """
+        size = 1
+        while size < nbytes:
+            size <<= 1
+        return size
+
+
+    def owns(self, buf):
+        return buf.int_ptr in self.owned
+
+
+    def track(self, buf, event):
+        """
+        Record the event of a command using a buffer of the pool
+        """
+        if event is None or buf.int_ptr not in self.owned:
+            return
+        complete = cl.command_execution_status.COMPLETE
+        pending = [ev for ev in self.events.get(buf.int_ptr, []) if ev.command_execution_status != complete]
+        pending.append(event)
+        self.events[buf.int_ptr] = pending
+
+
+    def allocate(self, nbytes, flags):
+        """
+        Get a buffer of at least nbytes bytes from the pool.
+
+        @param nbytes : requested size in bytes
+        @param flags : OpenCL memory flags of the buffer
+        """
+        key = (int(flags), BufferPool.size_class(max(nbytes, 1)))
+        ids = self.free.get(key)
+        if ids:
+            buf = self.idle.pop(ids.pop())
+            self.idle_bytes -= key[1]
+            self.hits += 1
+            # The commands enqueued before the release must be complete before the buffer is reused
+            pending = self.events.pop(buf.int_ptr, None)
+            if pending:
+                cl.wait_for_events(pending)
+        else:
+            try:
+                buf = cl.Buffer(self.ctx, flags, key[1])
+            except cl.MemoryError:
+                # Give back the idle memory to the device, and try again
+                self.trim(0)
+                buf = cl.Buffer(self.ctx, flags, key[1])
+            self.owned[buf.int_ptr] = key
+            self.misses += 1
+        self.used_bytes += key[1]
+        self.peak_bytes = max(self.peak_bytes, self.used_bytes)
+        return buf
+
+
+    def release(self, buf, wait_for=None):
+        """
+        Give back a buffer to the pool.
+        Returns False if the buffer was not allocated by the pool.
+
+        @param wait_for : (optional) events of commands using the buffer which were not recorded by track()
+        """
+        key = self.owned.get(buf.int_ptr)
+        if key is None:
+            return False
+        for ev in (wait_for or []):
+            self.track(buf, ev)
+        if buf.int_ptr in self.idle:
+            return True
+        self.used_bytes -= key[1]
+        self.free.setdefault(key, []).append(buf.int_ptr)
+        self.idle[buf.int_ptr] = buf
+        self.idle_bytes += key[1]
+        self.trim()
+        return True
+
+
+    def trim(self, max_size=None):
+        """
+        Free the least recently used idle buffers until the idle memory is below max_size bytes.
+
+        @param max_size : (optional) target size. Default is the pool max_size.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        while self.idle_bytes > max_size:
+            buf_id, buf = self.idle.popitem(last=False)
+            key = self.owned.pop(buf_id)
+            self.events.pop(buf_id, None) # the OpenCL runtime keeps the memory until the commands using it are complete
+            self.free[key].remove(buf_id)
+            self.idle_bytes -= key[1]
+            self.evictions += 1
+            buf.release()
+
+
+    def stats(self):
+        """
+        Return a dictionary with the pool statistics.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "used_bytes": self.used_bytes,
+            "idle_bytes": self.idle_bytes,
+            "peak_bytes": self.peak_bytes,
+            "max_size": self.max_size,
+        }
+
+
+
+
+class OclFuture:
+    """
+    Result of an asynchronous operation : an OpenCL event, and the value which is valid once the event is complete.
+    The result can be waited for with result(), or awaited in an asyncio coroutine :
+
+        res = await ocl.fetch_async(d_id)
+    """
+
+    def __init__(self, event, value=None):
+        self.event = event
+        self.value = value
+
+
+    def done(self):
+        return self.event.command_execution_status == cl.command_execution_status.COMPLETE
+
+
+    def result(self):
+        """
+        Wait for the completion of the event, and return the value.
+        """
+        self.event.wait()
+        return self.value
+
+
+    def __await__(self):
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        def callback(status):
+            loop.call_soon_threadsafe(lambda: fut.done() or fut.set_result(status))
+        try:
+            self.event.set_callback(cl.command_execution_status.COMPLETE, callback)
+        except (cl.LogicError, cl.RuntimeError, AttributeError):
+            # Event callbacks not supported (OpenCL < 1.1) : wait in a thread instead
+            fut = loop.run_in_executor(None, self.event.wait)
+        yield from fut.__await__()
+        return self.value
+
+
+
+
+class Tracer:
+    """
+    Record of the OpenCL commands (kernels and transfers) enqueued by an Ocl instance.
+    Recording only keeps a reference to the event : the timestamps are read when the records are queried.
+    Only the last max_records commands are kept, so that a long running program does not hold all its events.
+    """
+
+    def __init__(self, max_records=100000):
+        """
+        @param max_records : (optional) maximum number of recorded commands. The oldest records are dropped first.
+        """
+        self.events = deque(maxlen=max_records)
+        self.queues = {}
+        self.dropped = 0
+
+
+    def record(self, name, event, kind="kernel", queue=None, global_size=None, local_size=None, nbytes=0, flops=0):
+        """
+        Record an event.
+
+        @param name : name of the command, for eg. the kernel name
+        @param event : pyopencl.Event of the command
+        @param kind : (optional) "kernel", "to_device", "fetch" or "copy" (copies between device objects)
+        @param queue : (optional) command queue of the command
+        @param global_size : (optional) grid size of a kernel
+        @param local_size : (optional) work-group size of a kernel
+        @param nbytes : (optional) number of bytes moved by the command
+        @param flops : (optional) number of floating point operations done by the command
+        """
+        qid = self.queues.setdefault(queue.int_ptr if queue is not None else 0, len(self.queues))
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append((name, event, kind, qid, global_size, local_size, nbytes, flops))
+
+
+    def records(self):
+        """
+        Return the list of records as dictionaries, with the timestamps (in ns) queued, submit, start and end.
+        This waits for the completion of the recorded commands.
+        """
+        res = []
+        for name, event, kind, qid, global_size, local_size, nbytes, flops in self.events:
+            event.wait()
+            res.append({
+                "name": name, "kind": kind, "queue": qid,
+                "global_size": global_size, "local_size": local_size,
+                "nbytes": nbytes, "flops": flops,
+                "queued": event.profile.queued, "submit": event.profile.submit,
+                "start": event.profile.start, "end": event.profile.end,
+            })
+        return res
+
+
+    def stats(self):
+        """
+        Return aggregate statistics for each command name : number of calls, total/mean/min/max execution time (ms),
+        bytes moved, effective bandwidth (GB/s) and throughput (GFLOP/s).
+        """
+        res = {}
+        for r in self.records():
+            t = (r["end"] - r["start"]) * 1e-6
+            st = res.setdefault(r["name"], {"kind": r["kind"], "calls": 0, "total_ms": 0., "min_ms": t, "max_ms": t, "nbytes": 0, "flops": 0})
+            st["calls"] += 1
+            st["total_ms"] += t
+            st["min_ms"] = min(st["min_ms"], t)
+            st["max_ms"] = max(st["max_ms"], t)
+            st["nbytes"] += r["nbytes"]
+            st["flops"] += r["flops"]
+        for st in res.values():
+            st["mean_ms"] = st["total_ms"] / st["calls"]
+            seconds = st["total_ms"] * 1e-3
+            st["GB/s"] = st["nbytes"] / seconds * 1e-9 if seconds > 0 else 0.
+            st["GFLOP/s"] = st["flops"] / seconds * 1e-9 if seconds > 0 else 0.
+        return res
+
+
+    def summary(self):
+        """
+        Return the statistics as a printable table
+        """
+        lines = ["%-32s %8s %6s %10s %10s %10s %10s" % ("name", "kind", "calls", "total(ms)", "mean(ms)", "GB/s", "GFLOP/s")]
+        stats = self.stats()
+        for name in sorted(stats, key=lambda n: -stats[n]["total_ms"]):
+            st = stats[name]
+            lines.append("%-32s %8s %6d %10.3f %10.3f %10.2f %10.2f" % (name[:32], st["kind"], st["calls"], st["total_ms"], st["mean_ms"], st["GB/s"], st["GFLOP/s"]))
+        return "\n".join(lines)
+
+
+    def to_chrome_trace(self, fname):
+        """
+        Export the records to the Chrome trace format (chrome://tracing, Perfetto).
+        Each command queue is displayed as a thread.
+        """
+        records = self.records()
+        t0 = min([r["queued"] for r in records]) if records else 0
+        trace = []
+        for r in records:
+            trace.append({
+                "name": r["name"], "cat": r["kind"], "ph": "X", "pid": 0, "tid": r["queue"],
+                "ts": (r["start"] - t0) * 1e-3, "dur": (r["end"] - r["start"]) * 1e-3,
+                "args": {
+                    "global_size": r["global_size"], "local_size": r["local_size"],
+                    "nbytes": r["nbytes"], "flops": r["flops"],
+                    "queued_to_start_us": (r["start"] - r["queued"]) * 1e-3,
+                },
+            })
+        with open(fname, "w") as fid:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, fid)
+
+
+    def clear(self):
+        self.events.clear()
+        self.dropped = 0
+
+
+
+
+# Enumeration of the platforms and devices, done once per process (see list_devices())
+_devices = None
+_platforms = None
+
+DEVICE_TYPES = {
+    "CPU": cl.device_type.CPU,
+    "GPU": cl.device_type.GPU,
+    "ACCELERATOR": cl.device_type.ACCELERATOR,
+}
+
+
+def list_devices(refresh=False):
+    """
+    Return the list of (platform_index, device_index, device) of all the OpenCL devices.
+    The enumeration is done once, then cached for the process, unless refresh is True.
+    """
+    global _devices, _platforms
+    if _devices is None or refresh:
+        _devices = []
+        _platforms = cl.get_platforms()
+        for i_p, p in enumerate(_platforms):
+            try:
+                devices = p.get_devices()
+            except cl.RuntimeError: # platform without device
+                devices = []
+            for i_dev, dev in enumerate(devices):
+                _devices.append((i_p, i_dev, dev))
+    return _devices
+
+
+def list_platforms(refresh=False):
+    """
+    Return the list of the OpenCL platforms, enumerated along with the devices (see list_devices())
+    """
+    list_devices(refresh)
+    return _platforms
+
+
+def parse_size(value):
+    """
+    Convert a size with an optional unit to bytes, for eg. "4G" -> 4*1024**3
+    """
+    value = str(value).strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+
+def parse_device_spec(spec):
+    """
+    Parse a device selection rule. The rule is either :
+        - a dictionary, returned unchanged
+        - a string "platform_index,device_index", for eg. "0,1"
+        - a string of comma-separated filters key=value, for eg. "type=CPU, min_mem=4G". The keys are :
+            type (CPU, GPU, ACCELERATOR), platform, name, vendor (case-insensitive substrings),
+            min_mem, min_local_mem (sizes with an optional K/M/G unit), min_units (compute units),
+            double, image (1 if the device has to support double precision / images).
+            A device type alone is a shortcut for type=..., for eg. "gpu" or "gpu, min_mem=4G".
+    """
+    if spec is None or isinstance(spec, dict):
+        return dict(spec or {})
+    parts = [part.strip() for part in str(spec).split(",") if part.strip()]
+    if len(parts) == 2 and all(part.isdigit() for part in parts):
+        return {"index": (int(parts[0]), int(parts[1]))}
+    rules = {}
+    for part in parts:
+        if "=" not in part and part.upper() in DEVICE_TYPES:
+            rules["type"] = part.upper()
+            continue
+        if "=" not in part:
+            raise ValueError("parse_device_spec(): invalid rule %s in %s (expected key=value)" % (part, spec))
+        key, val = [x.strip() for x in part.split("=", 1)]
+        rules[key.lower()] = val
+    return rules
+
+
+def device_has_double(dev):
+    return "cl_khr_fp64" in dev.extensions or "cl_amd_fp64" in dev.extensions
+
+
+def device_score(dev):
+    """
+    Score of a device, higher is better : peak processing power (compute units x clock, GPUs and accelerators
+    having much wider compute units than CPUs), scaled up by the global memory, the local memory,
+    and the support of images and double precision.
+    """
+    type_weight = 1.
+    if dev.type & cl.device_type.GPU:
+        type_weight = 8.
+    elif dev.type & cl.device_type.ACCELERATOR:
+        type_weight = 4.
+    score = type_weight * dev.max_compute_units * max(dev.max_clock_frequency, 1)
+    score *= 1 + np.log2(1 + dev.global_mem_size / 1024.**3) / 4
+    score *= 1 + np.log2(1 + dev.local_mem_size / 1024.) / 16
+    if dev.image_support:
+        score *= 1.05
+    if device_has_double(dev):
+        score *= 1.05
+    return float(score)
+
+
+def device_matches(dev, platform, rules):
+    """
+    Check that a device satisfies the filters of parse_device_spec()
+    """
+    for key, val in rules.items():
+        if key == "type":
+            if val.upper() not in DEVICE_TYPES:
+                raise ValueError("device type should be one of %s, got %s" % (", ".join(DEVICE_TYPES.keys()), val))
+            if not(dev.type & DEVICE_TYPES[val.upper()]):
+                return False
+        elif key == "platform":
+            if val.lower() not in platform.name.lower():
+                return False
+        elif key == "name":
+            if val.lower() not in dev.name.lower():
+                return False
+        elif key == "vendor":
+            if val.lower() not in dev.vendor.lower():
+                return False
+        elif key == "min_mem":
+            if dev.global_mem_size < parse_size(val):
+                return False
+        elif key == "min_local_mem":
+            if dev.local_mem_size < parse_size(val):
+                return False
+        elif key == "min_units":
+            if dev.max_compute_units < int(val):
+                return False
+        elif key == "double":
+            if str(val).lower() in ["1", "true", "yes"] and not(device_has_double(dev)):
+                return False
+        elif key == "image":
+            if str(val).lower() in ["1", "true", "yes"] and not(dev.image_support):
+                return False
+        elif key != "index":
+            raise ValueError("unknown device selection rule: %s" % key)
+    return True
+
+
+def select_device(spec=None):
+    """
+    Select the device with the best score (see device_score()) among the devices satisfying a rule.
+    No interactive prompt is ever shown : an error is raised if no device matches.
+    Ties are broken by the platform and device indices, so that the selection is deterministic.
+
+    @param spec : (optional) selection rule, see parse_device_spec(). If not provided,
+        the environment variable OCL_DEVICE is used. If none is set, all the devices are candidates.
+    @return (platform_index, device_index, device)
+    """
+    if spec is None:
+        spec = os.environ.get("OCL_DEVICE", None)
+    rules = parse_device_spec(spec)
+    all_devices = list_devices()
+    platforms = list_platforms()
+    devices = all_devices
+    if "index" in rules:
+        index = tuple(rules["index"])
+        devices = [d for d in devices if (d[0], d[1]) == index]
+    candidates = [d for d in devices if device_matches(d[2], platforms[d[0]], rules)]
+    if not candidates:
+        raise RuntimeError("select_device(): no OpenCL device matching %s among %s" % (str(spec), ", ".join(d[2].name for d in all_devices) or "no device"))
+    return max(candidates, key=lambda d: (device_score(d[2]), -d[0], -d[1]))
+
+
+
+# numpy data type -> OpenCL type of the data given to the kernels built for several input types (DTYPE, INPUT_T, ...).
+# These are the types transferred as they are by to_device() (see Ocl.target_dtype()), except float64 and float16
+# which need a device extension.
+CL_TYPES = {
+    np.dtype(np.float32): "float",
+    np.dtype(np.int32): "int",
+    np.dtype(np.uint32): "uint",
+    np.dtype(np.int16): "short",
+    np.dtype(np.uint16): "ushort",
+    np.dtype(np.int8): "char",
+    np.dtype(np.uint8): "uchar",
+}
+
+
+
+
 class Ocl:
     """
     Simple wrapper for OpenCL, providing :
@@ -58,75 +685,127 @@ class Ocl:
     """
 
 
-    def __init__(self, profile=False, device=None, manual=False):
+    def __init__(self, profile=False, device=None, manual=False, cache_dir=None, cache_size=256*1024**2, pool_size=None, tune_file=None, autotune=False, trace=False, double=False):
         """
         Initialize a device, a context and a queue.
-        The preferred device is a NVIDIA GPU with maximum compute capability.
+        By default, the device is the one with the best score (see select_device()) among the devices
+        satisfying the rule of the environment variable OCL_DEVICE, for eg. OCL_DEVICE="type=GPU, min_mem=4G".
 
         @param profile : (optional) if True, enable profiling of the OpenCL events
-        @param device : (optional) device in the format (0, 0)
+        @param device : (optional) device in the format (0, 0), a pyopencl.Device (for eg. a sub-device),
+            or a selection rule (string or dictionary, see parse_device_spec()), for eg. "type=CPU, min_mem=4G"
         @param manual : (optional) if True, choose manually a device from the PyOpenCL prompt.
+        @param cache_dir : (optional) directory of the persistent program binary cache.
+            If not provided, the environment variable OCL_CACHE_DIR is used. If none is set, programs are always built from source.
+        @param cache_size : (optional) maximum size in bytes of the program binary cache
+        @param pool_size : (optional) if provided, device buffers are drawn from a BufferPool
+            keeping at most pool_size bytes of idle buffers. By default, buffers are allocated and freed directly.
+        @param tune_file : (optional) JSON file where the work-group sizes found by autotune() are saved.
+            If not provided, the environment variable OCL_TUNE_FILE is used. If none is set, the results are only kept in memory.
+        @param autotune : (optional) if True, call() with block="auto" runs autotune() the first time a kernel is launched
+            on a given shape class. The kernel is then run several times, so this is only valid for kernels which do not
+            accumulate into their output.
+        @param trace : (optional) if True, the kernels and transfers are recorded in self.tracer (see Tracer).
+            An integer sets the maximum number of records.
+            This implies profile=True.
+        @param double : (optional) if True and the device supports double precision, float64 arrays are transferred
+            as they are by to_device(). By default, they are converted to float32.
         """
-        platforms = cl.get_platforms()
-
         if manual:
             self.ctx = cl.create_some_context()
-            self.device = ctx.devices[0]
+            self.device = self.ctx.devices[0]
 
-        elif device:
-            self.device = platforms[device[0]].get_devices()[device[1]]
+        elif isinstance(device, cl.Device):
+            self.device = device
             self.ctx = cl.Context([self.device])
 
         else:
-            # Try to choose a NVIDIA card with best compute capability
-            cc_max = -1
-            cc_argmax = (0, 0)
-            for i_p, p in enumerate(platforms):
-                for i_dev, dev in enumerate(p.get_devices()):
-                    try:
-                        cc = dev.compute_capability_major_nv + 0.1 * dev.compute_capability_minor_nv
-                        if cc > cc_max:
-                            cc_max = cc
-                            cc_argmax = (i_p, i_dev)
-                    except:
-                        pass
-            if cc_max == -1:
-                print("Warning: could not find a NVIDIA card. Please pick up manually the target device")
-                self.ctx = cl.create_some_context()
-                self.device = ctx.devices[0]
-            else:
-                self.device = platforms[cc_argmax[0]].get_devices()[cc_argmax[1]]
-                self.ctx = cl.Context([self.device])
-            # ------------
+            if isinstance(device, (tuple, list)):
+                device = {"index": tuple(device)}
+            self.device = select_device(device)[2]
+            self.ctx = cl.Context([self.device])
+
         self.devicename = self.device.name
-        if profile:
+        self.double = bool(double) and device_has_double(self.device)
+        if profile or trace:
             self.queue = cl.CommandQueue(self.ctx, properties=cl.command_queue_properties.PROFILING_ENABLE)
         else:
             self.queue = cl.CommandQueue(self.ctx)
         self.mf = cl.mem_flags
         self.path = []
         self.book = {}
+        self.programs = {}
+        self.kernels = {}
+        if cache_dir is None:
+            cache_dir = os.environ.get("OCL_CACHE_DIR", None)
+        self.cache = BinaryCache(cache_dir, cache_size) if cache_dir else None
+        self.pool = BufferPool(self.ctx, pool_size) if pool_size is not None else None
+        self.staging = {}
+        self.tune_file = tune_file if tune_file is not None else os.environ.get("OCL_TUNE_FILE", None)
+        self.autotune_on_call = autotune
+        self.tuning = None
+        self.profile_queue = None
+        if trace:
+            self.tracer = Tracer() if trace is True else Tracer(max_records=int(trace))
+        else:
+            self.tracer = None
+
+
+    def create_queue(self):
+        """
+        Create an additional command queue on the device, with the same properties as the default queue.
+        Commands enqueued on distinct queues can be executed concurrently.
+        """
+        return cl.CommandQueue(self.ctx, self.device, properties=self.queue.properties)
 
 
     @staticmethod
-    def check_array(arr):
+    def target_dtype(dtype, double=False):
+        """
+        Data type of an array once transferred to the device.
+        64b types are converted to 32b (float64 is kept if double is True), bool is converted to uint8.
+        The narrow types (8 and 16 bits integers, float16) are kept as they are : the kernels convert them
+        when loading the values, which saves transfer time and device memory.
+
+        @param dtype : data type of the host array
+        @param double : (optional) if True, float64 is kept
+        """
+        dtype = np.dtype(dtype)
+        if dtype == np.float64:
+            target_type = np.float64 if double else np.float32
+        elif dtype == np.int64 or dtype == np.int32:
+            target_type = np.int32
+        elif dtype == np.uint64:
+            target_type = np.uint32
+        elif dtype == np.bool_:
+            target_type = np.uint8
+        # Other 64 bits types
+        elif dtype.itemsize == 8:
+            target_type = np.float32
+        else:
+            target_type = dtype
+        return np.dtype(target_type)
+
+
+    @staticmethod
+    def check_array(arr, double=False):
         """
         Check an array before sending to the GPU :
-            - data type (64b is converted to 32b)
+            - data type (see target_dtype())
             - memory layout (contiguous)
             - C order
+        The array is returned as is (without copy) if it already fulfills these conditions.
         @param arr : numpy ndarray
+        @param double : (optional) if True, float64 is kept
         """
-        if (arr.dtype == np.float32) or (arr.dtype == np.float64):
-            target_type = np.float32
-        elif arr.dtype == np.int64 or arr.dtype == np.int32:
-            target_type = np.int32
-        # Other 64 bits types
-        elif arr.nbytes/arr.size == 8:
-            target_type = np.float32
-        else: # TODO : what to do in that case ?
-            target_type = a.dtype
-        return arr.astype(target_type) if arr.flags['C_CONTIGUOUS'] else np.ascontiguousarray(arr.astype(target_type))
+        return np.ascontiguousarray(arr, dtype=Ocl.target_dtype(arr.dtype, double))
+
+
+    def device_dtype(self, dtype):
+        """
+        Data type of an array once transferred to the device of this instance (see target_dtype())
+        """
+        return Ocl.target_dtype(dtype, self.double)
 
 
     @staticmethod
@@ -170,33 +849,78 @@ class Ocl:
         self.book[d_id] = (data_size, data_type)
 
 
-    def to_device(self, arr, destbuf=None, flags=None):
+    def to_device(self, arr, destbuf=None, flags=None, zero_copy=False, staging=False, wait_for=None, is_blocking=True, return_event=False, queue=None):
         """
         Transfer a numpy array to device.
         Returns the id of the device array.
 
         @param arr : numpy ndarray
-        @param destbuf : (optional) destination buffer on device, already allocated
+        @param destbuf : (optional) destination buffer on device, already allocated. It can be larger than the array.
         @param flags : (optional) memory flags : "r", "w", "rw".
+        @param zero_copy : (optional) if True and destbuf is not provided, the device buffer is created on top of the host memory (USE_HOST_PTR).
+            On devices sharing the memory with the host (CPU, integrated GPU), no copy is done at all.
+            The array must then be left untouched as long as the buffer is in use.
+        @param staging : (optional) if True, the array is first converted into a pinned host array (see staging_array()),
+            which is faster to transfer from on discrete GPUs.
+        @param wait_for : (optional) list of events the transfer has to wait for
+        @param is_blocking : (optional) if False, the function returns as soon as the transfer is enqueued.
+            The host array must then be left untouched until the transfer is complete.
+        @param return_event : (optional) if True, return (d_id, event) where event is the OpenCL event of the transfer
+        @param queue : (optional) command queue of the transfer. Default is the queue of this instance.
         """
+        queue = queue or self.queue
 
-        clflags = self.oclflags(self.mf.COPY_HOST_PTR, flags)
-        arr_c = Ocl.check_array(arr)
-        if destbuf is None:
+        if staging:
+            arr_c = self.staging_array(arr.shape, self.device_dtype(arr.dtype))
+            arr_c[...] = arr # type conversion and copy in one pass
+        else:
+            arr_c = Ocl.check_array(arr, self.double)
+        ev = None
+        # Buffer creation with COPY_HOST_PTR has no event : not used when tracing
+        synchronous = is_blocking and not(wait_for) and self.tracer is None
+        if destbuf is None and zero_copy:
+            d_id = cl.Buffer(self.ctx, self.oclflags(self.mf.USE_HOST_PTR, flags), hostbuf=arr_c)
+        elif destbuf is None and self.pool is None and synchronous:
+            clflags = self.oclflags(self.mf.COPY_HOST_PTR, flags)
             d_id =  cl.Buffer(self.ctx, clflags, hostbuf=arr_c)
         else:
-            if destbuf.size != arr_c.nbytes: # TODO : only throw error for destbuf.size < arr.nbytes ? But what would be the behavior ?
+            if destbuf is None:
+                if self.pool is not None:
+                    destbuf = self.pool.allocate(arr_c.nbytes, self.oclflags(self.mf.ALLOC_HOST_PTR, flags))
+                else:
+                    destbuf = cl.Buffer(self.ctx, self.oclflags(self.mf.ALLOC_HOST_PTR, flags), arr_c.nbytes)
+            # The destination buffer can be larger than the array (for eg. buffers of the pool) : only its beginning is written
+            if destbuf.size < arr_c.nbytes:
                 raise ValueError("ERROR: to_device(): requested to transfer an array of %d bytes, when the device buffer is %d bytes" % (arr.nbytes, destbuf.size))
             try:
-                ev = cl.enqueue_copy(self.queue, destbuf, arr_c)
+                ev = cl.enqueue_copy(queue, destbuf, arr_c, wait_for=wait_for, is_blocking=is_blocking)
                 # check ev against  cl.command_execution_status.{COMPLETE, SUBMITTED, RUNNING, QUEUED}
                 d_id = destbuf
             except cl.LogicError:
                 raise RuntimeError("ERROR: to_device(): failed to transfer array of shape %s (dtype=%s)" % (str(arr.shape), str(arr.dtype)))
         self.book_keep(d_id, arr_c.shape, arr_c.dtype)
+        if self.pool is not None:
+            self.pool.track(d_id, ev)
+        if self.tracer is not None and ev is not None:
+            self.tracer.record("to_device", ev, "to_device", queue=queue, nbytes=arr_c.nbytes)
+        if return_event:
+            if ev is None: # the data was transferred at buffer creation
+                ev = cl.enqueue_marker(queue)
+            return d_id, ev
         return d_id
 
 
+    def to_device_async(self, arr, destbuf=None, flags=None, wait_for=None):
+        """
+        Non-blocking version of to_device().
+        Returns an OclFuture whose result is the id of the device array.
+        The host array must be left untouched until the future is done.
+        """
+        d_id, ev = self.to_device(arr, destbuf=destbuf, flags=flags, wait_for=wait_for, is_blocking=False, return_event=True)
+        self.queue.flush()
+        return OclFuture(ev, d_id)
+
+
     def create_buffer(self, shape, dtype, flags=None):
         """
         Allocate a buffer on the device.
@@ -206,14 +930,17 @@ class Ocl:
         @param flags : memory access flags : "r", "w", "rw"
         """
         clflags = self.oclflags(self.mf.ALLOC_HOST_PTR, flags)
-        nbytes = np.empty(shape, dtype=dtype).nbytes
-        d_id = cl.Buffer(self.ctx, clflags, nbytes)
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if self.pool is not None:
+            d_id = self.pool.allocate(nbytes, clflags)
+        else:
+            d_id = cl.Buffer(self.ctx, clflags, nbytes)
         self.book_keep(d_id, shape, dtype) # possibly unknown data type
         return d_id
 
 
     def create_buffer_like(self, arr, flags=None):
-        arr_c = Ocl.check_array(arr)
+        arr_c = Ocl.check_array(arr, self.double)
         size = arr_c.nbytes
         d_id = self.create_buffer(arr_c.shape, arr_c.dtype, flags)
         self.book_keep(d_id, arr_c.shape, arr_c.dtype)
@@ -231,12 +958,15 @@ class Ocl:
         raise NotImplementedError("Not Implemented yet !")
 
 
-    def release_buffer(self, d_id):
+    def release_buffer(self, d_id, wait_for=None):
         """
         Release a buffer from GPU memory.
+        If the buffer pool is enabled, buffers allocated by the pool are given back to the pool instead.
+        The pool hands them back once the commands enqueued by call(), to_device() and fetch() are complete.
 
         @param d_id: id of the device buffer, preferably created with
         create_buffer(), create_buffer_like(), create_buffer_zeros(), create_buffer_zero_like() or to_device().
+        @param wait_for : (optional) events of other commands using the buffer (for eg. enqueued with pyopencl directly)
         """
 
         if d_id is None:
@@ -244,6 +974,8 @@ class Ocl:
         else:
             if d_id in self.book.keys():
                 _ = self.book.pop(d_id)
+            if self.pool is not None and self.pool.release(d_id, wait_for=wait_for):
+                return
             try:
                 d_id.release()
                 #~ d_id = None
@@ -260,23 +992,166 @@ class Ocl:
             raise ValueError("ERROR: Ocl.add_program_path(): %s no such directory" % path)
 
 
-    def compile_file(self, fname):
-        found = 0
-        if os.path.isfile(fname): found = 1
+    @staticmethod
+    def build_options(options=None, defines=None):
+        """
+        Assemble the list of build options passed to the OpenCL compiler.
+
+        @param options : (optional) list of compiler options, for eg. ["-cl-fast-relaxed-math"]
+        @param defines : (optional) dictionary of preprocessor macros. {"N": 16, "USE_X": None} gives ["-DN=16", "-DUSE_X"]
+        """
+        opts = list(options) if options else []
+        if defines:
+            for name in sorted(defines.keys()):
+                val = defines[name]
+                opts.append("-D%s" % name if val is None else "-D%s=%s" % (name, str(val)))
+        return opts
+
+
+    def find_file(self, fname):
+        """
+        Return the path of a program file, looking in the paths added with add_program_path()
+        if the file is not directly found.
+        """
+        if os.path.isfile(fname):
+            return fname
         # File not directly found, relative file name
-        elif not(os.path.isabs(fname)):
+        if not(os.path.isabs(fname)):
             for d in self.path:
                 fname2 = os.path.join(d, fname)
                 if os.path.isfile(fname2):
-                    fname = fname2
-                    found = 1
-        if found == 0:
-            raise ValueError("ERROR: Ocl.compile_file() : %s not found" % fname)
-        src = open(fname).read()
-        return cl.Program(self.ctx, src).build()
+                    return fname2
+        raise ValueError("ERROR: Ocl.compile_file() : %s not found" % fname)
+
 
+    def compile_file(self, fname, options=None, defines=None, header=None):
+        """
+        Compile an OpenCL program file.
+        Programs are memoized : compiling again the same file (with unchanged modification time)
+        with the same options returns the same pyopencl.Program.
 
-    def fetch(self, d_id, dest=None, return_event=False):
+        @param fname : file name, either absolute or relative to the current directory or to a path added with add_program_path()
+        @param options : (optional) list of compiler options
+        @param defines : (optional) dictionary of preprocessor macros, see build_options()
+        @param header : (optional) source code prepended to the file, for eg. function-like macros which cannot be passed as options
+        """
+        fname = os.path.abspath(self.find_file(fname))
+        opts = Ocl.build_options(options, defines)
+        key = (fname, os.path.getmtime(fname), tuple(opts), header)
+        if key in self.programs:
+            return self.programs[key]
+        with open(fname) as fid:
+            src = fid.read()
+        if header:
+            src = header + "\n" + src
+        program = self.build_program(src, opts)
+        self.programs[key] = program
+        return program
+
+
+    def kernel(self, program, name):
+        """
+        Return a kernel of a program.
+        Contrarily to program.kernel_name, the kernel object is created once and then reused.
+
+        @param program : pyopencl.Program, for eg. returned by compile_file()
+        @param name : name of the kernel
+        """
+        key = (program.int_ptr, name)
+        if key not in self.kernels:
+            self.kernels[key] = cl.Kernel(program, name)
+        return self.kernels[key]
+
+
+    def build_program(self, src, options=None):
+        """
+        Build a program from its source code.
+        If the binary cache is enabled, the program binary is loaded from the cache when available,
+        otherwise the program is built and its binary is stored in the cache.
+
+        @param src : source code of the program
+        @param options : (optional) list of build options
+        """
+        options = list(options) if options else []
+        if self.cache is None:
+            return cl.Program(self.ctx, src).build(options=options)
+        key = self.cache.key(src, options, self.device)
+        binary = self.cache.load(key)
+        if binary is not None:
+            try:
+                return cl.Program(self.ctx, [self.device], [binary]).build(options=options)
+            except (cl.LogicError, cl.RuntimeError):
+                # Binary rejected by the driver : rebuild from source
+                self.cache.discard(key)
+        program = cl.Program(self.ctx, src).build(options=options)
+        self.cache.store(key, program.get_info(cl.program_info.BINARIES)[0])
+        return program
+
+
+    def staging_array(self, shape, dtype):
+        """
+        Return a host array in pinned (page-locked) memory, allocated with ALLOC_HOST_PTR and mapped once for all.
+        Transfers from/to pinned memory avoid an intermediate copy in the driver.
+        There is one staging array per (shape, dtype), which is reused : its content is overwritten
+        by the next transfer using it.
+
+        @param shape : shape of the array
+        @param dtype : data type of the array
+        """
+        shape = tuple(shape) if hasattr(shape, "__len__") else (shape,)
+        dtype = np.dtype(dtype)
+        key = (shape, dtype)
+        if key not in self.staging:
+            nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+            buf = cl.Buffer(self.ctx, self.mf.ALLOC_HOST_PTR | self.mf.READ_WRITE, nbytes)
+            arr, ev = cl.enqueue_map_buffer(self.queue, buf, cl.map_flags.READ | cl.map_flags.WRITE, 0, shape, dtype)
+            self.staging[key] = (buf, arr)
+        return self.staging[key][1]
+
+
+    def buffer_type(self, d_id, caller="buffer_type"):
+        """
+        Return the (shape, dtype) of a buffer, from the book-keeping structure.
+        """
+        if d_id in self.book.keys(): # The buffer is known in the book-keeping structure
+            size, dtype = self.book[d_id]
+            if dtype is None: # Unknown data type : the buffer is a "bag of bytes". Nothing can be further done
+                raise RuntimeError("ERROR: Ocl.%s(): the data type of buffer %s is unknown. Please use the 'dest' keyword to specify a target numpy array." % (caller, d_id))
+            return size, dtype
+        else: # Unknown buffer : a proper "dest" numpy array must be specified
+            raise ValueError("ERROR: Ocl.%s(): unknown buffer %s. Please specify a target buffer for the transfer using the 'dest' keyword" % (caller, d_id))
+
+
+    @contextmanager
+    def mapped(self, d_id, flags="r", shape=None, dtype=None):
+        """
+        Map a device buffer in the host memory, for eg.
+
+            with ocl.mapped(d_id) as arr:
+                print(arr.mean())
+
+        On devices sharing the memory with the host, the buffer is accessed without any copy.
+        The buffer is unmapped when leaving the "with" block.
+
+        @param d_id : pyopencl.Buffer
+        @param flags : (optional) "r" for reading the buffer, "w" for writing it, "rw" for both
+        @param shape : (optional) shape of the mapped array. Default is guessed from the book-keeping structure.
+        @param dtype : (optional) data type of the mapped array. Default is guessed from the book-keeping structure.
+        """
+        if shape is None or dtype is None:
+            size, dtype2 = self.buffer_type(d_id, "mapped")
+            shape = size if shape is None else shape
+            dtype = dtype2 if dtype is None else dtype
+        shape = tuple(shape) if hasattr(shape, "__len__") else (shape,)
+        mapflags = {"r": cl.map_flags.READ, "w": cl.map_flags.WRITE_INVALIDATE_REGION}.get(flags.lower(), cl.map_flags.READ | cl.map_flags.WRITE)
+        arr, ev = cl.enqueue_map_buffer(self.queue, d_id, mapflags, 0, shape, dtype)
+        try:
+            yield arr
+        finally:
+            arr.base.release(self.queue)
+
+
+    def fetch(self, d_id, dest=None, return_event=False, staging=False, wait_for=None, is_blocking=True, queue=None, offset=0):
         """
         Fetch a buffer from the device and returns a numpy array.
         The data type is guessed from the book-keeping structure of this class.
@@ -285,36 +1160,217 @@ class Ocl:
         @param d_id: pyopen.Buffer object, preferably created with Ocl.to_device, Ocl.create_buffer_like or Ocl.create_buffer.
         @param dest: optional, target numpy array
         @param return_event : optional, set to True if you want the OpenCL event in the return value
+        @param staging : optional, if True and dest is not provided, the target is the pinned staging array of this shape and type
+            (see staging_array()). No host memory is allocated, but the result is overwritten by the next transfer using this staging array.
+        @param wait_for : optional, list of events the transfer has to wait for
+        @param is_blocking : optional, if False, the function returns as soon as the transfer is enqueued.
+            The content of the target array is then valid once the event is complete.
+        @param queue : optional, command queue of the transfer. Default is the queue of this instance.
+        @param offset : optional, offset (in bytes) in the device buffer where the transfer starts
         @return: dest, event_res : if return_event is True : the target numpy array, and the pyopencl event associated to the transfer,
             otherwise the target numpy array.
         """
         if dest is None: # Unspecified target numpy array : have to guess the data type and shape
-            if d_id in self.book.keys(): # The buffer is known in the book-keeping structure
-                size, dtype = self.book[d_id]
-                if dtype is None: # Unknown data type : the buffer is a "bag of bytes". Nothing can be further done
-                    raise RuntimeError("ERROR: Ocl.fetch(): the data type of buffer %s is unknown. Please use the 'dest' keyword to specify a target numpy array." % d_id)
-                dest = np.zeros(size, dtype=dtype)
-            else: # Unknown buffer : a proper "dest" numpy array must be specified
-                    raise ValueError("ERROR: Ocl.fetch(): unknown buffer %s. Please specify a target buffer for the transfer using the 'dest' keyword" % d_id)
-
-        event_res = cl.enqueue_copy(self.queue, dest, d_id)
+            size, dtype = self.buffer_type(d_id, "fetch")
+            if staging:
+                dest = self.staging_array(size, dtype)
+            else:
+                dest = np.empty(size, dtype=dtype)
+
+        queue = queue or self.queue
+        event_res = cl.enqueue_copy(queue, dest, d_id, device_offset=offset, wait_for=wait_for, is_blocking=is_blocking)
+        if self.pool is not None:
+            self.pool.track(d_id, event_res)
+        if self.tracer is not None:
+            self.tracer.record("fetch", event_res, "fetch", queue=queue, nbytes=dest.nbytes)
         if return_event:
             return dest, event_res
         else:
             return dest
 
 
-    def call(self, kernel, grid, block, *args):
+    def fetch_async(self, d_id, dest=None, wait_for=None):
+        """
+        Non-blocking version of fetch().
+        Returns an OclFuture whose result is the target numpy array.
+        """
+        dest, ev = self.fetch(d_id, dest=dest, return_event=True, wait_for=wait_for, is_blocking=False)
+        self.queue.flush()
+        return OclFuture(ev, dest)
+
+
+    def copy_to_image(self, img, d_src, region, wait_for=None, queue=None):
+        """
+        Enqueue the copy of a buffer into an image object, for eg. to sample it with the texture units.
+        Returns the event of the copy, which is recorded by the tracer like the kernels and transfers.
+
+        @param img : pyopencl.Image
+        @param d_src : device buffer, starting with the pixels of the region
+        @param region : size (width, height[, depth]) of the copied region, in pixels
+        @param wait_for : (optional) list of events the copy has to wait for
+        @param queue : (optional) command queue of the copy. Default is the queue of this instance.
+        """
+        queue = queue or self.queue
+        ev = cl.enqueue_copy(queue, img, d_src, offset=0, origin=(0,)*len(region), region=tuple(region), wait_for=wait_for)
+        if self.pool is not None:
+            self.pool.track(d_src, ev)
+        if self.tracer is not None:
+            nbytes = 2 * int(np.prod(region)) * img.get_image_info(cl.image_info.ELEMENT_SIZE)
+            self.tracer.record("copy_to_image", ev, "copy", queue=queue, nbytes=nbytes)
+        return ev
+
+
+    def tuning_key(self, kernel, grid):
+        """
+        Key of the tuning results : device, kernel name and shape class.
+        The shape class is the grid size rounded up to the next power of two in each dimension.
+        """
+        shape_class = "x".join(str(BufferPool.size_class(int(g))) for g in grid)
+        return "%s|%s|%s|%s" % (self.device.name, self.device.driver_version, kernel.function_name, shape_class)
+
+
+    def load_tuning(self):
+        """
+        Load the saved work-group sizes, once for all.
+        """
+        if self.tuning is None:
+            self.tuning = {}
+            if self.tune_file and os.path.isfile(self.tune_file):
+                with open(self.tune_file) as fid:
+                    self.tuning = json.load(fid)
+        return self.tuning
+
+
+    def save_tuning(self):
+        if not(self.tune_file):
+            return
+        # Merge with results saved meanwhile by other processes
+        tuning = {}
+        if os.path.isfile(self.tune_file):
+            with open(self.tune_file) as fid:
+                tuning = json.load(fid)
+        tuning.update(self.tuning)
+        dirname = os.path.dirname(os.path.abspath(self.tune_file))
+        fd, tmpname = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        with os.fdopen(fd, "w") as fid:
+            json.dump(tuning, fid, indent=1, sort_keys=True)
+        os.replace(tmpname, self.tune_file)
+
+
+    def workgroup_candidates(self, kernel, grid, max_size=1024):
+        """
+        List the candidate work-group sizes for a kernel : powers of two in each dimension, not larger than the grid,
+        within the limits of the device and of the kernel.
+        To keep the search short, the candidates have at least 16 work-items along the fast dimension (for coalesced accesses),
+        do not grow along the slow dimensions, and are multiple of the preferred work-group size multiple.
+
+        @param max_size : (optional) maximum number of work-items of a work-group
+        """
+        max_wg = min(self.device.max_work_group_size, kernel.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, self.device), max_size)
+        preferred = kernel.get_work_group_info(cl.kernel_work_group_info.PREFERRED_WORK_GROUP_SIZE_MULTIPLE, self.device)
+        candidates = [()]
+        for dim, g in enumerate(grid):
+            sizes = []
+            size = 1
+            while size <= min(BufferPool.size_class(int(g)), self.device.max_work_item_sizes[dim]):
+                sizes.append(size)
+                size <<= 1
+            candidates = [c + (size,) for c in candidates for size in sizes if np.prod(c + (size,)) <= max_wg]
+        largest = max(int(np.prod(c)) for c in candidates)
+        min_wg = min(largest, max(preferred, 32))
+        min_x = min(16, BufferPool.size_class(int(grid[0])))
+        res = []
+        for c in candidates:
+            n = int(np.prod(c))
+            if n < min_wg or c[0] < min_x or any(c[i] > c[i-1] for i in range(2, len(c))):
+                continue
+            if n % preferred == 0 or n == largest:
+                res.append(c)
+        return res
+
+
+    def autotune(self, kernel, grid, *args, n_iter=3, candidates=None):
+        """
+        Find the fastest work-group size for a kernel and a grid size, by timing the kernel with profiling events.
+        The result is saved for the device, the kernel and the shape class of the grid (see tuning_key()),
+        and used by call() when block="auto".
+        The kernel is run several times with the given arguments.
+
+        @param kernel : pyopencl.Kernel
+        @param grid : the grid size (number of thread per dimensions)
+        @param args : the arguments passed to the kernel
+        @param n_iter : (optional, keyword only) number of timed runs for each candidate
+        @param candidates : (optional, keyword only) list of work-group sizes to try. Default is given by workgroup_candidates().
+        @return the best work-group size
+        """
+        tuning = self.load_tuning()
+        key = self.tuning_key(kernel, grid)
+        # Kernels compiled with reqd_work_group_size have no choice
+        required = tuple(kernel.get_work_group_info(cl.kernel_work_group_info.COMPILE_WORK_GROUP_SIZE, self.device))
+        if any(required):
+            best = required[:len(grid)]
+        else:
+            if self.queue.properties & cl.command_queue_properties.PROFILING_ENABLE:
+                queue = self.queue
+            else:
+                if self.profile_queue is None:
+                    self.profile_queue = cl.CommandQueue(self.ctx, self.device, properties=cl.command_queue_properties.PROFILING_ENABLE)
+                queue = self.profile_queue
+            if candidates is None:
+                candidates = self.workgroup_candidates(kernel, grid)
+            best, best_time = None, None
+            for block in candidates:
+                try:
+                    self.call(kernel, grid, block, *args, queue=queue).wait() # warm-up
+                    times = []
+                    for i in range(n_iter):
+                        ev = self.call(kernel, grid, block, *args, queue=queue)
+                        ev.wait()
+                        times.append(ev.profile.end - ev.profile.start)
+                except (cl.LogicError, cl.RuntimeError): # for eg. out of resources
+                    continue
+                t = np.median(times)
+                if best_time is None or t < best_time:
+                    best, best_time = block, t
+            if best is None:
+                raise RuntimeError("ERROR: Ocl.autotune(): no valid work-group size found for kernel %s" % kernel.function_name)
+        tuning[key] = list(best)
+        self.save_tuning()
+        return tuple(best)
+
+
+    def tuned_block(self, kernel, grid, *args):
+        """
+        Return the saved work-group size for a kernel and a grid size.
+        If none is saved, autotune() is run if autotuning is enabled ; otherwise None is returned
+        (the work-group size is chosen by the OpenCL implementation).
+        """
+        block = self.load_tuning().get(self.tuning_key(kernel, grid))
+        if block is not None:
+            return tuple(block)
+        if self.autotune_on_call:
+            return self.autotune(kernel, grid, *args)
+        return None
+
+
+    def call(self, kernel, grid, block, *args, wait_for=None, queue=None, nbytes=0, flops=0):
         """
         Helper to call a kernel :
             - Computes the grid size/block size according to the block, if provided
             - Makes sure that the arguments are passed as 32 bits (for eg xx.shape[y])
+        The kernel launch is always non-blocking : the returned event tells when it is complete.
 
         @param kernel: a kernel associated to a compiled program : program.kernel_name
         @param grid : the grid size (number of thread per dimensions)
-        @param block : the block size. Set to None if not relevant.
+        @param block : the block size. Set to None if not relevant, or to "auto" to use the block size found by autotune().
         @param args: the arguments passed to the kernel
+        @param wait_for : (optional, keyword only) list of events the kernel has to wait for
+        @param queue : (optional, keyword only) command queue of the launch. Default is the queue of this instance.
+        @param nbytes : (optional, keyword only) number of bytes read and written by the kernel, for the effective bandwidth reported by the tracer
+        @param flops : (optional, keyword only) number of floating point operations done by the kernel, reported by the tracer
         """
+        if isinstance(block, str) and block == "auto":
+            block = self.tuned_block(kernel, grid, *args)
         if block:
             grid = Ocl.calc_size(grid, block)
         # Modifies the arguments to clean all 64b types
@@ -324,7 +1380,27 @@ class Ocl:
                 args_list[i] = np.int32(arg)
         newargs = tuple(args_list)
         # Call the kernel
-        return kernel(self.queue, grid, block, *newargs)
+        queue = queue or self.queue
+        ev = kernel(queue, grid, block, *newargs, wait_for=wait_for)
+        if self.pool is not None:
+            # Buffers of the pool are not reused before the kernel is complete
+            for arg in newargs:
+                if isinstance(arg, cl.Buffer):
+                    self.pool.track(arg, ev)
+        if self.tracer is not None:
+            self.tracer.record(kernel.function_name, ev, "kernel", queue=queue, global_size=tuple(grid), local_size=tuple(block) if block else None, nbytes=nbytes, flops=flops)
+        return ev
+
+
+    def call_async(self, kernel, grid, block, *args, wait_for=None, result=None):
+        """
+        Same as call(), but returns an OclFuture.
+
+        @param result : (optional, keyword only) value of the future once the kernel is complete, for eg. the output buffer
+        """
+        ev = self.call(kernel, grid, block, *args, wait_for=wait_for)
+        self.queue.flush()
+        return OclFuture(ev, result)
 
 
 
@@ -21,3 +21,76 @@ __kernel void binning2(
         output[gidy*Nc + gidx] = 0.25*(a+b+c+d);
     }
 }
+
+
+///
+/// 2x2 binning of a stack of frames : the third grid dimension is the frame index
+///
+
+__kernel void binning2_batched(
+    __global float * input,
+    __global float * output,
+    int Nr,
+    int Nc,
+    int n_frames)
+{
+    int gidx = (int) get_global_id(0); // fast dim
+    int gidy = (int) get_global_id(1);
+    int k = (int) get_global_id(2); // frame index
+
+    if (gidy < Nr && gidx < Nc && k < n_frames) {
+        int Nc2 = Nc*2;
+        __global float * frame = input + k*(4*Nr*Nc);
+        float a = frame[(gidy*2)*Nc2 + (gidx*2)];
+        float b = frame[(gidy*2)*Nc2 + (gidx*2+1)];
+        float c = frame[(gidy*2+1)*Nc2 + (gidx*2)];
+        float d = frame[(gidy*2+1)*Nc2 + (gidx*2+1)];
+        output[(k*Nr + gidy)*Nc + gidx] = 0.25f*(a+b+c+d);
+    }
+}
+
+
+///
+/// Binning by arbitrary factors (fx, fy, fz) of a 2D image or 3D volume (in_z = 1 for 2D).
+/// A stack of frames is binned frame by frame with fz = 1.
+/// The input type DTYPE is defined at build time : the values are converted and accumulated in float.
+/// If the output size is rounded up, the bins on the edges are averaged over the available pixels.
+///
+
+#ifndef DTYPE
+    #define DTYPE float
+#endif
+
+__kernel void binning_nd(
+    const __global DTYPE * input,
+    __global float * output,
+    int in_w,
+    int in_h,
+    int in_z,
+    int out_w,
+    int out_h,
+    int out_z,
+    int fx,
+    int fy,
+    int fz)
+{
+    int gidx = (int) get_global_id(0); // fast dim
+    int gidy = (int) get_global_id(1);
+    int gidz = (int) get_global_id(2); // slow dim
+
+    if (gidx < out_w && gidy < out_h && gidz < out_z) {
+        int x0 = gidx*fx, x1 = min(x0 + fx, in_w);
+        int y0 = gidy*fy, y1 = min(y0 + fy, in_h);
+        int z0 = gidz*fz, z1 = min(z0 + fz, in_z);
+        float sum = 0.0f;
+        for (int z = z0; z < z1; z++) {
+            for (int y = y0; y < y1; y++) {
+                const __global DTYPE * line = input + (z*in_h + y)*in_w;
+                for (int x = x0; x < x1; x++) {
+                    sum += (float) line[x];
+                }
+            }
+        }
+        output[(gidz*out_h + gidy)*out_w + gidx] = sum / ((x1-x0)*(y1-y0)*(z1-z0));
+    }
+}
@@ -0,0 +1,238 @@
+///
+/// Fused separable convolutions : the passes of the separable convolution are done in a single kernel,
+/// the intermediate results are kept in local memory. The image is read once and the result written once.
+///
+/// These kernels are specialized at build time :
+///   - HLEN : filter size
+///   - BLOCK_X, BLOCK_Y : work-group size of separable_convolution_2d_fused ((BLOCK_X, BLOCK_Y, 1))
+///     and of depth_convolution_post ((BLOCK_X, 1, BLOCK_Y))
+///   - FUSED_3D : if defined, separable_convolution_3d_fused is built with (BLOCK3_X, BLOCK3_Y, BLOCK3_Z) work-groups.
+///     Its tile must fit in local memory.
+///   - PRE_OP(x, i), POST_OP(x, i) : (optional) element-wise operations applied to the input values
+///     and to the result. x is the value, i the index of the pixel in the volume. The expressions can use
+///     the optional arrays a and b (for eg. dark and flat fields) and IMAGE_W, IMAGE_H, IMAGE_Z.
+/// The boundaries are handled by mirroring, as in convolution.cl
+///
+
+#ifndef HLEN
+    #error "HLEN (filter size) must be defined at build time"
+#endif
+#ifndef BLOCK_X
+    #define BLOCK_X 16
+#endif
+#ifndef BLOCK_Y
+    #define BLOCK_Y 8
+#endif
+#ifndef PRE_OP
+    #define PRE_OP(x, i) (x)
+#endif
+#ifndef POST_OP
+    #define POST_OP(x, i) (x)
+#endif
+
+// Center of the filter : for an even filter size, the center is shifted to the left
+#define HL ((HLEN & 1) ? (HLEN/2) : (HLEN/2 - 1))
+
+
+static inline int mirror(int i, int n) {
+    if (i < 0) i = -i - 1;
+    if (i >= n) i = 2*n - i - 1;
+    return clamp(i, 0, n - 1);
+}
+
+
+///
+/// Horizontal and vertical convolutions of each slice of the volume (or of the image if IMAGE_Z = 1).
+/// If apply_post is 0, POST_OP is not applied (the depth pass is done afterwards).
+///
+
+__kernel __attribute__((reqd_work_group_size(BLOCK_X, BLOCK_Y, 1)))
+void separable_convolution_2d_fused(
+    const __global float * input,
+    __global float * output,
+    __constant float * filter,
+    int IMAGE_W,
+    int IMAGE_H,
+    int IMAGE_Z,
+    const __global float * a,
+    const __global float * b,
+    int apply_post)
+{
+    __local float tile[BLOCK_Y + HLEN - 1][BLOCK_X + HLEN - 1];
+    __local float tmp[BLOCK_Y + HLEN - 1][BLOCK_X];
+
+    int gidz = (int) get_global_id(2); // slow dim
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+    int lidy = (int) get_local_id(1);
+    int lidx = (int) get_local_id(0);
+
+    // Load the tile extended by the filter half-width in both directions
+    int x0 = (int) get_group_id(0) * BLOCK_X - HL;
+    int y0 = (int) get_group_id(1) * BLOCK_Y - HL;
+    int slice = min(gidz, IMAGE_Z-1)*IMAGE_H*IMAGE_W;
+    for (int i = lidy; i < BLOCK_Y + HLEN - 1; i += BLOCK_Y) {
+        int line = slice + mirror(y0 + i, IMAGE_H)*IMAGE_W;
+        for (int j = lidx; j < BLOCK_X + HLEN - 1; j += BLOCK_X) {
+            int idx = line + mirror(x0 + j, IMAGE_W);
+            float x = input[idx];
+            tile[i][j] = PRE_OP(x, idx);
+        }
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    // Horizontal pass on all the lines of the tile, including the halo
+    for (int i = lidy; i < BLOCK_Y + HLEN - 1; i += BLOCK_Y) {
+        float sum = 0.0f;
+        #pragma unroll
+        for (int j = 0; j < HLEN; j++) {
+            sum += tile[i][lidx + j] * filter[HLEN-1 - j];
+        }
+        tmp[i][lidx] = sum;
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    // Vertical pass
+    if (gidy < IMAGE_H && gidx < IMAGE_W && gidz < IMAGE_Z) {
+        float sum = 0.0f;
+        #pragma unroll
+        for (int j = 0; j < HLEN; j++) {
+            sum += tmp[lidy + j][lidx] * filter[HLEN-1 - j];
+        }
+        int idx = (gidz*IMAGE_H + gidy)*IMAGE_W + gidx;
+        output[idx] = (apply_post) ? POST_OP(sum, idx) : sum;
+    }
+}
+
+
+///
+/// Depth convolution followed by POST_OP, completing separable_convolution_2d_fused for volumes
+/// when separable_convolution_3d_fused is not available.
+///
+
+__kernel __attribute__((reqd_work_group_size(BLOCK_X, 1, BLOCK_Y)))
+void depth_convolution_post(
+    const __global float * input,
+    __global float * output,
+    __constant float * filter,
+    int IMAGE_W,
+    int IMAGE_H,
+    int IMAGE_Z,
+    const __global float * a,
+    const __global float * b)
+{
+    __local float tile[BLOCK_Y + HLEN - 1][BLOCK_X];
+
+    int gidz = (int) get_global_id(2); // slow dim
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+    int lidz = (int) get_local_id(2);
+    int lidx = (int) get_local_id(0);
+
+    int z0 = (int) get_group_id(2) * BLOCK_Y - HL;
+    int x = min(gidx, IMAGE_W-1);
+    int y = min(gidy, IMAGE_H-1);
+    for (int i = lidz; i < BLOCK_Y + HLEN - 1; i += BLOCK_Y) {
+        tile[i][lidx] = input[(mirror(z0 + i, IMAGE_Z)*IMAGE_H + y)*IMAGE_W + x];
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    if (gidy < IMAGE_H && gidx < IMAGE_W && gidz < IMAGE_Z) {
+        float sum = 0.0f;
+        #pragma unroll
+        for (int j = 0; j < HLEN; j++) {
+            sum += tile[lidz + j][lidx] * filter[HLEN-1 - j];
+        }
+        int idx = (gidz*IMAGE_H + gidy)*IMAGE_W + gidx;
+        output[idx] = POST_OP(sum, idx);
+    }
+}
+
+
+///
+/// 3D separable convolution in a single kernel. The tile of the work-group, extended by the filter
+/// half-width in the three directions, is loaded in local memory ; the horizontal and vertical passes
+/// are done on the tile (including the halo of the next passes), then the depth pass gives the result.
+///
+
+#ifdef FUSED_3D
+
+#define TX (BLOCK3_X + HLEN - 1)
+#define TY (BLOCK3_Y + HLEN - 1)
+#define TZ (BLOCK3_Z + HLEN - 1)
+
+__kernel __attribute__((reqd_work_group_size(BLOCK3_X, BLOCK3_Y, BLOCK3_Z)))
+void separable_convolution_3d_fused(
+    const __global float * input,
+    __global float * output,
+    __constant float * filter,
+    int IMAGE_W,
+    int IMAGE_H,
+    int IMAGE_Z,
+    const __global float * a,
+    const __global float * b)
+{
+    __local float tile[TZ][TY][TX];
+    __local float tmp1[TZ][TY][BLOCK3_X];  // after the horizontal pass
+    __local float tmp2[TZ][BLOCK3_Y][BLOCK3_X]; // after the vertical pass
+
+    int gidz = (int) get_global_id(2); // slow dim
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+    int lidz = (int) get_local_id(2);
+    int lidy = (int) get_local_id(1);
+    int lidx = (int) get_local_id(0);
+
+    int x0 = (int) get_group_id(0) * BLOCK3_X - HL;
+    int y0 = (int) get_group_id(1) * BLOCK3_Y - HL;
+    int z0 = (int) get_group_id(2) * BLOCK3_Z - HL;
+    for (int k = lidz; k < TZ; k += BLOCK3_Z) {
+        int slice = mirror(z0 + k, IMAGE_Z)*IMAGE_H;
+        for (int i = lidy; i < TY; i += BLOCK3_Y) {
+            int line = (slice + mirror(y0 + i, IMAGE_H))*IMAGE_W;
+            for (int j = lidx; j < TX; j += BLOCK3_X) {
+                int idx = line + mirror(x0 + j, IMAGE_W);
+                float x = input[idx];
+                tile[k][i][j] = PRE_OP(x, idx);
+            }
+        }
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    // Horizontal pass
+    for (int k = lidz; k < TZ; k += BLOCK3_Z) {
+        for (int i = lidy; i < TY; i += BLOCK3_Y) {
+            float sum = 0.0f;
+            #pragma unroll
+            for (int j = 0; j < HLEN; j++) {
+                sum += tile[k][i][lidx + j] * filter[HLEN-1 - j];
+            }
+            tmp1[k][i][lidx] = sum;
+        }
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    // Vertical pass
+    for (int k = lidz; k < TZ; k += BLOCK3_Z) {
+        float sum = 0.0f;
+        #pragma unroll
+        for (int j = 0; j < HLEN; j++) {
+            sum += tmp1[k][lidy + j][lidx] * filter[HLEN-1 - j];
+        }
+        tmp2[k][lidy][lidx] = sum;
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    // Depth pass
+    if (gidy < IMAGE_H && gidx < IMAGE_W && gidz < IMAGE_Z) {
+        float sum = 0.0f;
+        #pragma unroll
+        for (int j = 0; j < HLEN; j++) {
+            sum += tmp2[lidz + j][lidy][lidx] * filter[HLEN-1 - j];
+        }
+        int idx = (gidz*IMAGE_H + gidy)*IMAGE_W + gidx;
+        output[idx] = POST_OP(sum, idx);
+    }
+}
+
+#endif
@@ -0,0 +1,181 @@
+///
+/// Convolution kernels using local memory tiles.
+///
+/// These kernels are specialized at build time :
+///   - HLEN : filter size (the filter loops are fully unrolled)
+///   - BLOCK_X, BLOCK_Y : work-group size. horizontal_convolution_tiled and vertical_convolution_tiled
+///     use (BLOCK_X, BLOCK_Y, 1) work-groups ; depth_convolution_tiled uses (BLOCK_X, 1, BLOCK_Y) work-groups.
+///   - INPUT_T, OUTPUT_T : (optional) storage types of the input and output arrays (default float).
+///     The input can be any numeric type ; INPUT_HALF / OUTPUT_HALF have to be defined for half (fp16) storage,
+///     which is accessed with vload_half/vstore_half (no need for the cl_khr_fp16 extension).
+///   - USE_DOUBLE : (optional) computations (and filter coefficients) in double precision
+/// Each work-group loads its tile of the image, extended with the filter half-width, in local memory.
+/// The filter coefficients are in constant memory.
+/// The boundaries are handled by mirroring, as in convolution.cl
+///
+
+#ifndef HLEN
+    #error "HLEN (filter size) must be defined at build time"
+#endif
+#ifndef BLOCK_X
+    #define BLOCK_X 16
+#endif
+#ifndef BLOCK_Y
+    #define BLOCK_Y 8
+#endif
+
+#ifdef USE_DOUBLE
+    #pragma OPENCL EXTENSION cl_khr_fp64 : enable
+    typedef double real;
+#else
+    typedef float real;
+#endif
+#ifndef INPUT_T
+    #define INPUT_T float
+#endif
+#ifndef OUTPUT_T
+    #define OUTPUT_T float
+#endif
+#ifdef INPUT_HALF
+    #define LOAD_INPUT(p, i) ((real) vload_half((i), (p)))
+#else
+    #define LOAD_INPUT(p, i) ((real) (p)[i])
+#endif
+#ifdef OUTPUT_HALF
+    #define STORE_OUTPUT(p, i, v) vstore_half((float) (v), (i), (p))
+#else
+    #define STORE_OUTPUT(p, i, v) ((p)[i] = (OUTPUT_T) (v))
+#endif
+
+// Center of the filter : for an even filter size, the center is shifted to the left
+#define HL ((HLEN & 1) ? (HLEN/2) : (HLEN/2 - 1))
+
+
+static inline int mirror(int i, int n) {
+    if (i < 0) i = -i - 1;
+    if (i >= n) i = 2*n - i - 1;
+    return clamp(i, 0, n - 1);
+}
+
+
+///
+/// Horizontal convolution (along fast dim)
+///
+
+__kernel __attribute__((reqd_work_group_size(BLOCK_X, BLOCK_Y, 1)))
+void horizontal_convolution_tiled(
+    const __global INPUT_T * input,  // input array
+    __global OUTPUT_T * output, // output array
+    __constant real * filter, // filter coefficients
+    int IMAGE_W,
+    int IMAGE_H,
+    int IMAGE_Z
+)
+{
+    __local real tile[BLOCK_Y][BLOCK_X + HLEN - 1];
+
+    int gidz = (int) get_global_id(2); // slow dim
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+    int lidy = (int) get_local_id(1);
+    int lidx = (int) get_local_id(0);
+
+    // Load the tile. Out-of-image threads load a valid line, as all the threads have to reach the barrier.
+    int x0 = (int) get_group_id(0) * BLOCK_X - HL;
+    int line = (min(gidz, IMAGE_Z-1)*IMAGE_H + min(gidy, IMAGE_H-1))*IMAGE_W;
+    for (int i = lidx; i < BLOCK_X + HLEN - 1; i += BLOCK_X) {
+        tile[lidy][i] = LOAD_INPUT(input, line + mirror(x0 + i, IMAGE_W));
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    if (gidy < IMAGE_H && gidx < IMAGE_W && gidz < IMAGE_Z) {
+        real sum = 0;
+        #pragma unroll
+        for (int j = 0; j < HLEN; j++) {
+            sum += tile[lidy][lidx + j] * filter[HLEN-1 - j];
+        }
+        STORE_OUTPUT(output, (gidz*IMAGE_H + gidy)*IMAGE_W + gidx, sum);
+    }
+}
+
+
+///
+/// Vertical convolution
+///
+
+__kernel __attribute__((reqd_work_group_size(BLOCK_X, BLOCK_Y, 1)))
+void vertical_convolution_tiled(
+    const __global INPUT_T * input,  // input array
+    __global OUTPUT_T * output, // output array
+    __constant real * filter, // filter coefficients
+    int IMAGE_W,
+    int IMAGE_H,
+    int IMAGE_Z
+)
+{
+    __local real tile[BLOCK_Y + HLEN - 1][BLOCK_X];
+
+    int gidz = (int) get_global_id(2); // slow dim
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+    int lidy = (int) get_local_id(1);
+    int lidx = (int) get_local_id(0);
+
+    int y0 = (int) get_group_id(1) * BLOCK_Y - HL;
+    int x = min(gidx, IMAGE_W-1);
+    int slice = min(gidz, IMAGE_Z-1)*IMAGE_H;
+    for (int i = lidy; i < BLOCK_Y + HLEN - 1; i += BLOCK_Y) {
+        tile[i][lidx] = LOAD_INPUT(input, (slice + mirror(y0 + i, IMAGE_H))*IMAGE_W + x);
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    if (gidy < IMAGE_H && gidx < IMAGE_W && gidz < IMAGE_Z) {
+        real sum = 0;
+        #pragma unroll
+        for (int j = 0; j < HLEN; j++) {
+            sum += tile[lidy + j][lidx] * filter[HLEN-1 - j];
+        }
+        STORE_OUTPUT(output, (gidz*IMAGE_H + gidy)*IMAGE_W + gidx, sum);
+    }
+}
+
+
+///
+/// Depth convolution
+///
+
+__kernel __attribute__((reqd_work_group_size(BLOCK_X, 1, BLOCK_Y)))
+void depth_convolution_tiled(
+    const __global INPUT_T * input,  // input array
+    __global OUTPUT_T * output, // output array
+    __constant real * filter, // filter coefficients
+    int IMAGE_W,
+    int IMAGE_H,
+    int IMAGE_Z
+)
+{
+    __local real tile[BLOCK_Y + HLEN - 1][BLOCK_X];
+
+    int gidz = (int) get_global_id(2); // slow dim
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+    int lidz = (int) get_local_id(2);
+    int lidx = (int) get_local_id(0);
+
+    int z0 = (int) get_group_id(2) * BLOCK_Y - HL;
+    int x = min(gidx, IMAGE_W-1);
+    int y = min(gidy, IMAGE_H-1);
+    for (int i = lidz; i < BLOCK_Y + HLEN - 1; i += BLOCK_Y) {
+        tile[i][lidx] = LOAD_INPUT(input, (mirror(z0 + i, IMAGE_Z)*IMAGE_H + y)*IMAGE_W + x);
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    if (gidy < IMAGE_H && gidx < IMAGE_W && gidz < IMAGE_Z) {
+        real sum = 0;
+        #pragma unroll
+        for (int j = 0; j < HLEN; j++) {
+            sum += tile[lidz + j][lidx] * filter[HLEN-1 - j];
+        }
+        STORE_OUTPUT(output, (gidz*IMAGE_H + gidy)*IMAGE_W + gidx, sum);
+    }
+}
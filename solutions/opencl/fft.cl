@@ -0,0 +1,192 @@
+///
+/// Convolution in the frequency domain : radix-2 FFT of complex (float2) arrays, with the padding and
+/// cropping steps of the convolution.
+///
+/// The dimensions of the padded arrays are powers of two. The FFT along an axis is done by fft_local when a transform
+/// fits in local memory, otherwise by log2(n) launches of fft_radix2 (Stockham formulation : out-of-place, results
+/// in natural order), alternating between two buffers.
+///
+/// The input type DTYPE is defined at build time (float by default).
+///
+
+#ifndef DTYPE
+    #define DTYPE float
+#endif
+
+
+// Symmetric extension of the image ("reflect" mode of scipy.ndimage), for any distance to the border
+static inline int reflect(int i, int n) {
+    int period = 2*n;
+    i = i % period;
+    if (i < 0) i += period;
+    return (i < n) ? i : period - 1 - i;
+}
+
+
+///
+/// Copy the image into the padded complex array. The image starts at (off_x, off_y, off_z) in the padded array,
+/// the rest of the padded array is filled with the symmetric extension of the image.
+///
+
+__kernel void fft_pad(
+    const __global DTYPE * input,
+    __global float2 * output,
+    int IMAGE_W,
+    int IMAGE_H,
+    int IMAGE_Z,
+    int PAD_W,
+    int PAD_H,
+    int PAD_Z,
+    int off_x,
+    int off_y,
+    int off_z)
+{
+    int gidz = (int) get_global_id(2); // slow dim
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+
+    if (gidx < PAD_W && gidy < PAD_H && gidz < PAD_Z) {
+        int x = reflect(gidx - off_x, IMAGE_W);
+        int y = reflect(gidy - off_y, IMAGE_H);
+        int z = reflect(gidz - off_z, IMAGE_Z);
+        output[(gidz*PAD_H + gidy)*PAD_W + gidx] = (float2) ((float) input[(z*IMAGE_H + y)*IMAGE_W + x], 0.0f);
+    }
+}
+
+
+///
+/// One stage of the radix-2 FFT along an axis, for a batch of 1D transforms.
+///   - n : length of the transforms, stride : distance between two elements of a transform
+///   - the transform b of the batch starts at (b / stride)*(n*stride) + (b % stride) : the other axes of the
+///     C-ordered array are the slower ones (b / stride) and the faster ones (b % stride)
+///   - twiddles : exp(-2*i*pi*j/n) for j in [0, n/2), computed on the host
+///   - p : 1, 2, 4, ..., n/2 for the successive stages
+///   - sign : 1 for the forward transform, -1 for the inverse (unnormalized) transform
+/// The grid is (n/2, number of transforms).
+///
+
+__kernel void fft_radix2(
+    const __global float2 * src,
+    __global float2 * dst,
+    const __global float2 * twiddles,
+    int n,
+    int stride,
+    int p,
+    int n_batch,
+    float sign)
+{
+    int i = (int) get_global_id(0);
+    int b = (int) get_global_id(1);
+    if (i >= n/2 || b >= n_batch) return;
+
+    int base = (b / stride)*(n*stride) + (b % stride);
+    int k = i & (p - 1);
+    // exp(-sign*i*pi*k/p)
+    float2 w = twiddles[k * (n / (2*p))];
+    float c = w.x, s = sign * w.y;
+
+    float2 u0 = src[base + i*stride];
+    float2 v = src[base + (i + n/2)*stride];
+    float2 u1 = (float2) (v.x*c - v.y*s, v.x*s + v.y*c);
+
+    int j = (i << 1) - k;
+    dst[base + j*stride] = u0 + u1;
+    dst[base + (j + p)*stride] = u0 - u1;
+}
+
+
+///
+/// FFT along an axis, for a batch of 1D transforms (same parameters as fft_radix2), done in place.
+/// Each work-group computes a whole transform in local memory : all the stages in a single launch.
+/// The grid is (work-group size, number of transforms), buf0 and buf1 are n complex values each.
+///
+
+__kernel void fft_local(
+    __global float2 * data,
+    const __global float2 * twiddles,
+    int n,
+    int stride,
+    int n_batch,
+    float sign,
+    __local float2 * buf0,
+    __local float2 * buf1)
+{
+    int lid = (int) get_local_id(0);
+    int wg = (int) get_local_size(0);
+    int b = (int) get_global_id(1);
+    if (b >= n_batch) return; // the whole work-group returns
+
+    int base = (b / stride)*(n*stride) + (b % stride);
+    for (int j = lid; j < n; j += wg) {
+        buf0[j] = data[base + j*stride];
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    __local float2 * src = buf0;
+    __local float2 * dst = buf1;
+    for (int p = 1; p < n; p <<= 1) {
+        for (int i = lid; i < n/2; i += wg) {
+            int k = i & (p - 1);
+            float2 w = twiddles[k * (n / (2*p))];
+            float c = w.x, s = sign * w.y;
+            float2 u0 = src[i];
+            float2 v = src[i + n/2];
+            float2 u1 = (float2) (v.x*c - v.y*s, v.x*s + v.y*c);
+            int j = (i << 1) - k;
+            dst[j] = u0 + u1;
+            dst[j + p] = u0 - u1;
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+        __local float2 * tmp = src;
+        src = dst;
+        dst = tmp;
+    }
+
+    for (int j = lid; j < n; j += wg) {
+        data[base + j*stride] = src[j];
+    }
+}
+
+
+///
+/// Multiplication by the spectrum of the filter (normalization of the inverse transform included)
+///
+
+__kernel void fft_multiply(
+    __global float2 * data,
+    const __global float2 * spectrum,
+    int n)
+{
+    int i = (int) get_global_id(0);
+    if (i < n) {
+        float2 a = data[i];
+        float2 b = spectrum[i];
+        data[i] = (float2) (a.x*b.x - a.y*b.y, a.x*b.y + a.y*b.x);
+    }
+}
+
+
+///
+/// Real part of the image region of the padded array
+///
+
+__kernel void fft_crop(
+    const __global float2 * input,
+    __global float * output,
+    int IMAGE_W,
+    int IMAGE_H,
+    int IMAGE_Z,
+    int PAD_W,
+    int PAD_H,
+    int off_x,
+    int off_y,
+    int off_z)
+{
+    int gidz = (int) get_global_id(2); // slow dim
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+
+    if (gidx < IMAGE_W && gidy < IMAGE_H && gidz < IMAGE_Z) {
+        output[(gidz*IMAGE_H + gidy)*IMAGE_W + gidx] = input[((gidz + off_z)*PAD_H + gidy + off_y)*PAD_W + gidx + off_x].x;
+    }
+}
@@ -0,0 +1,65 @@
+///
+/// Flat-field correction : (raw - dark) / (flat - dark), optionally followed by -log().
+///
+/// The dark and the inverse of (flat - dark) ("gain") are computed once and stay on the device :
+/// the correction of each frame is then a single pass with one multiplication per pixel.
+/// DTYPE (type of the raw frames) must be defined at build time ; the frames are read without conversion on the host.
+///
+
+#ifndef DTYPE
+    #define DTYPE float
+#endif
+
+
+///
+/// Compute the gain 1/(flat - dark). Pixels where |flat - dark| <= eps are marked with a gain of 0.
+///
+
+__kernel void flatfield_gain(
+    const __global float * dark,
+    const __global float * flat,
+    __global float * gain,
+    int n,
+    float eps)
+{
+    int gid = (int) get_global_id(0);
+    if (gid < n) {
+        float d = flat[gid] - dark[gid];
+        gain[gid] = (fabs(d) > eps) ? 1.0f / d : 0.0f;
+    }
+}
+
+
+///
+/// Correct a batch of frames. Work-item (i, k) handles the pixel i of the frame k.
+/// Invalid pixels (gain of 0) are set to invalid_value.
+/// If take_log is not 0, the result is -log(max(val, log_min)).
+///
+
+__kernel void flatfield(
+    const __global DTYPE * raw,
+    __global float * output,
+    const __global float * dark,
+    const __global float * gain,
+    int frame_size,
+    int n_frames,
+    float invalid_value,
+    int take_log,
+    float log_min)
+{
+    int i = (int) get_global_id(0);
+    int k = (int) get_global_id(1); // frame index
+    if (i >= frame_size || k >= n_frames) return;
+
+    int idx = k*frame_size + i;
+    float g = gain[i];
+    float val;
+    if (g == 0.0f) {
+        val = invalid_value;
+    }
+    else {
+        val = ((float) raw[idx] - dark[i]) * g;
+        if (take_log) val = -log(fmax(val, log_min));
+    }
+    output[idx] = val;
+}
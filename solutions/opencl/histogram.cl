@@ -15,3 +15,126 @@ __kernel void histogram256(
         }
     }
 }
+
+
+///
+/// 256-bins histogram of a stack of frames : the third grid dimension is the frame index,
+/// and the histogram of frame k is hist[k*256 : (k+1)*256]
+///
+
+__kernel void histogram256_batched(
+    __global int * img,
+    __global int * hist,
+    int Nr,
+    int Nc,
+    int n_frames)
+{
+    int gidx = (int) get_global_id(0); // fast dim
+    int gidy = (int) get_global_id(1);
+    int k = (int) get_global_id(2); // frame index
+
+    if (gidy < Nr && gidx < Nc && k < n_frames) {
+        int val = img[(k*Nr + gidy)*Nc + gidx];
+        if (0 <= val && val <= 255) {
+            atomic_inc(&(hist[k*256 + val]));
+        }
+    }
+}
+
+
+
+///
+/// Histogram with an arbitrary number of bins over a float range [vmin, vmax].
+/// Each work-group accumulates a private histogram in local memory, which is merged
+/// into the global histogram at the end : there is one global atomic operation per bin and per work-group,
+/// instead of one per pixel.
+/// The second grid dimension is the frame index : the frames are stored contiguously in "data",
+/// and the histogram of frame i is hist[i*nbins : (i+1)*nbins].
+/// As in numpy.histogram, the last bin includes vmax, and values out of the range are ignored.
+///
+
+static inline int bin_index(float val, int nbins, float vmin, float vmax) {
+    if (!(val >= vmin && val <= vmax)) return -1; // also discards NaN
+    int b = (int) ((val - vmin) * nbins / (vmax - vmin));
+    return min(b, nbins - 1);
+}
+
+
+static inline void atomic_add_local_float(volatile __local float * addr, float val) {
+    union { unsigned int u; float f; } old, upd;
+    do {
+        old.f = *addr;
+        upd.f = old.f + val;
+    } while (atomic_cmpxchg((volatile __local unsigned int *) addr, old.u, upd.u) != old.u);
+}
+
+
+static inline void atomic_add_global_float(volatile __global float * addr, float val) {
+    union { unsigned int u; float f; } old, upd;
+    do {
+        old.f = *addr;
+        upd.f = old.f + val;
+    } while (atomic_cmpxchg((volatile __global unsigned int *) addr, old.u, upd.u) != old.u);
+}
+
+
+__kernel void histogram_local(
+    const __global float * data,
+    __global int * hist,
+    int n,          // number of pixels of a frame
+    int nbins,
+    float vmin,
+    float vmax,
+    __local int * lhist)
+{
+    int frame = (int) get_global_id(1);
+    int lid = (int) get_local_id(0);
+    int lsize = (int) get_local_size(0);
+    data += frame * n;
+    hist += frame * nbins;
+
+    for (int b = lid; b < nbins; b += lsize) lhist[b] = 0;
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    for (int i = (int) get_global_id(0); i < n; i += (int) get_global_size(0)) {
+        int b = bin_index(data[i], nbins, vmin, vmax);
+        if (b >= 0) atomic_inc(&(lhist[b]));
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    for (int b = lid; b < nbins; b += lsize) {
+        if (lhist[b]) atomic_add(&(hist[b]), lhist[b]);
+    }
+}
+
+
+__kernel void histogram_local_weighted(
+    const __global float * data,
+    const __global float * weights,
+    __global float * hist,
+    int n,          // number of pixels of a frame
+    int nbins,
+    float vmin,
+    float vmax,
+    __local float * lhist)
+{
+    int frame = (int) get_global_id(1);
+    int lid = (int) get_local_id(0);
+    int lsize = (int) get_local_size(0);
+    data += frame * n;
+    weights += frame * n;
+    hist += frame * nbins;
+
+    for (int b = lid; b < nbins; b += lsize) lhist[b] = 0.0f;
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    for (int i = (int) get_global_id(0); i < n; i += (int) get_global_size(0)) {
+        int b = bin_index(data[i], nbins, vmin, vmax);
+        if (b >= 0) atomic_add_local_float(&(lhist[b]), weights[i]);
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    for (int b = lid; b < nbins; b += lsize) {
+        if (lhist[b] != 0.0f) atomic_add_global_float(&(hist[b]), lhist[b]);
+    }
+}
@@ -0,0 +1,179 @@
+///
+/// Fused reductions : count, mean, sum of squared deviations (for the variance), min, max, argmin, argmax
+/// are computed in a single pass.
+/// The moments are combined with the parallel algorithm of Chan et al., which is more accurate
+/// than accumulating the sum of squares.
+///
+/// DTYPE (type of the input data) must be defined at build time.
+///
+
+#ifndef DTYPE
+    #define DTYPE float
+#endif
+
+typedef struct {
+    int n;
+    float mean;
+    float m2;     // sum of squared deviations from the mean
+    float vmin;
+    float vmax;
+    int imin;
+    int imax;
+    int pad;
+} stats_t;
+
+
+static inline stats_t stats_init(void) {
+    stats_t s;
+    s.n = 0;
+    s.mean = 0.0f;
+    s.m2 = 0.0f;
+    s.vmin = INFINITY;
+    s.vmax = -INFINITY;
+    s.imin = -1;
+    s.imax = -1;
+    s.pad = 0;
+    return s;
+}
+
+
+// Add one value (Welford update)
+static inline stats_t stats_push(stats_t s, float x, int i) {
+    s.n += 1;
+    float delta = x - s.mean;
+    s.mean += delta / s.n;
+    s.m2 += delta * (x - s.mean);
+    if (x < s.vmin || s.imin < 0) { s.vmin = x; s.imin = i; }
+    if (x > s.vmax || s.imax < 0) { s.vmax = x; s.imax = i; }
+    return s;
+}
+
+
+// Merge two partial results. For equal min/max values, the lowest index is kept (as numpy.argmin)
+static inline stats_t stats_merge(stats_t a, stats_t b) {
+    if (b.n == 0) return a;
+    if (a.n == 0) return b;
+    stats_t s;
+    s.n = a.n + b.n;
+    float delta = b.mean - a.mean;
+    float fb = ((float) b.n) / s.n;
+    s.mean = a.mean + delta * fb;
+    s.m2 = a.m2 + b.m2 + delta * delta * a.n * fb;
+    if (b.vmin < a.vmin || (b.vmin == a.vmin && b.imin < a.imin)) { s.vmin = b.vmin; s.imin = b.imin; }
+    else { s.vmin = a.vmin; s.imin = a.imin; }
+    if (b.vmax > a.vmax || (b.vmax == a.vmax && b.imax < a.imax)) { s.vmax = b.vmax; s.imax = b.imax; }
+    else { s.vmax = a.vmax; s.imax = a.imax; }
+    s.pad = 0;
+    return s;
+}
+
+
+// Tree reduction of the local array. The work-group size must be a power of two.
+static inline void stats_reduce_local(__local stats_t * ls, int lid, int lsize) {
+    for (int offset = lsize / 2; offset > 0; offset >>= 1) {
+        if (lid < offset) ls[lid] = stats_merge(ls[lid], ls[lid + offset]);
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+}
+
+
+///
+/// First stage : each work-group reduces a strided part of the data into one partial result
+///
+
+__kernel void reduce_stats(
+    const __global DTYPE * data,
+    int n,
+    __global stats_t * partial,
+    __local stats_t * ls)
+{
+    int lid = (int) get_local_id(0);
+    stats_t s = stats_init();
+    for (int i = (int) get_global_id(0); i < n; i += (int) get_global_size(0)) {
+        s = stats_push(s, (float) data[i], i);
+    }
+    ls[lid] = s;
+    barrier(CLK_LOCAL_MEM_FENCE);
+    stats_reduce_local(ls, lid, (int) get_local_size(0));
+    if (lid == 0) partial[get_group_id(0)] = ls[0];
+}
+
+
+///
+/// Next stages : reduction of the partial results
+///
+
+__kernel void reduce_stats_partial(
+    const __global stats_t * data,
+    int n,
+    __global stats_t * partial,
+    __local stats_t * ls)
+{
+    int lid = (int) get_local_id(0);
+    stats_t s = stats_init();
+    for (int i = (int) get_global_id(0); i < n; i += (int) get_global_size(0)) {
+        s = stats_merge(s, data[i]);
+    }
+    ls[lid] = s;
+    barrier(CLK_LOCAL_MEM_FENCE);
+    stats_reduce_local(ls, lid, (int) get_local_size(0));
+    if (lid == 0) partial[get_group_id(0)] = ls[0];
+}
+
+
+///
+/// Reduction along an axis. The data is seen as an array of shape (outer, length, inner),
+/// and reduced along the second dimension. Each work-item computes one output (o, i) :
+/// consecutive work-items read consecutive addresses when inner > 1.
+/// The indices of argmin/argmax are along the reduced axis.
+/// For a small inner dimension (for eg. the last axis, inner = 1), reduce_stats_lines is used instead.
+///
+
+__kernel void reduce_stats_axis(
+    const __global DTYPE * data,
+    int outer,
+    int length,
+    int inner,
+    __global stats_t * out)
+{
+    int i = (int) get_global_id(0);
+    int o = (int) get_global_id(1);
+    if (i >= inner || o >= outer) return;
+    stats_t s = stats_init();
+    const __global DTYPE * line = data + o * length * inner + i;
+    for (int k = 0; k < length; k++) {
+        s = stats_push(s, (float) line[k * inner], k);
+    }
+    out[o * inner + i] = s;
+}
+
+
+///
+/// Reduction along an axis, one work-group per reduced line (same layout as reduce_stats_axis).
+/// The work-items of a group take the elements of the line with a stride of the work-group size,
+/// then the partial results are merged in local memory. The grid is (work-group size, inner*outer).
+///
+
+__kernel void reduce_stats_lines(
+    const __global DTYPE * data,
+    int outer,
+    int length,
+    int inner,
+    __global stats_t * out,
+    __local stats_t * ls)
+{
+    int lid = (int) get_local_id(0);
+    int lsize = (int) get_local_size(0);
+    int b = (int) get_global_id(1);
+    if (b >= inner * outer) return; // the whole work-group returns
+    int o = b / inner, i = b % inner;
+    stats_t s = stats_init();
+    const __global DTYPE * line = data + o * length * inner + i;
+    for (int k = lid; k < length; k += lsize) {
+        s = stats_push(s, (float) line[k * inner], k);
+    }
+    ls[lid] = s;
+    barrier(CLK_LOCAL_MEM_FENCE);
+    stats_reduce_local(ls, lid, lsize);
+    if (lid == 0) out[b] = ls[0];
+}
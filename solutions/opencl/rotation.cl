@@ -56,3 +56,95 @@ __kernel void rotation(
     }
 }
 
+
+
+///
+/// Batched affine transforms.
+///
+/// Each output frame k is sampled from the input frame k (or from the single input frame if n_in == 1)
+/// at the coordinates given by the 2x3 matrix matrices[6*k : 6*k+6], precomputed on the host :
+///     x_in = m[0]*x + m[1]*y + m[2]
+///     y_in = m[3]*x + m[4]*y + m[5]
+/// The interpolation is bilinear, and the values outside the input are 0.
+/// The image kernels use the texture units ; affine_transform_buffer computes the same interpolation
+/// on a buffer, for devices without image support.
+///
+
+__constant sampler_t sampler_linear = CLK_NORMALIZED_COORDS_FALSE | CLK_ADDRESS_CLAMP | CLK_FILTER_LINEAR;
+
+
+static inline float2 affine_coords(const __global float * matrices, int k, int x, int y) {
+    const __global float * m = matrices + 6*k;
+    return (float2) (m[0]*x + m[1]*y + m[2], m[3]*x + m[4]*y + m[5]);
+}
+
+
+__kernel void affine_transform_image2d(
+    read_only image2d_t img,
+    __global float * output,
+    const __global float * matrices,
+    int OUT_W,
+    int OUT_H,
+    int n_frames)
+{
+    int gidx = (int) get_global_id(0);
+    int gidy = (int) get_global_id(1);
+    int k = (int) get_global_id(2); // frame index
+    if (gidx >= OUT_W || gidy >= OUT_H || k >= n_frames) return;
+
+    float2 pos = affine_coords(matrices, k, gidx, gidy);
+    // Pixel centers are at (i + 0.5) for unnormalized coordinates
+    output[(k*OUT_H + gidy)*OUT_W + gidx] = read_imagef(img, sampler_linear, pos + 0.5f).x;
+}
+
+
+__kernel void affine_transform_image3d(
+    read_only image3d_t img,
+    __global float * output,
+    const __global float * matrices,
+    int OUT_W,
+    int OUT_H,
+    int n_frames)
+{
+    int gidx = (int) get_global_id(0);
+    int gidy = (int) get_global_id(1);
+    int k = (int) get_global_id(2); // frame index
+    if (gidx >= OUT_W || gidy >= OUT_H || k >= n_frames) return;
+
+    float2 pos = affine_coords(matrices, k, gidx, gidy) + 0.5f;
+    // Sampling at the center of the slice : no interpolation between frames
+    output[(k*OUT_H + gidy)*OUT_W + gidx] = read_imagef(img, sampler_linear, (float4) (pos.x, pos.y, k + 0.5f, 0.0f)).x;
+}
+
+
+static inline float pixel_or_zero(const __global float * img, int x, int y, int IMG_W, int IMG_H) {
+    return (x >= 0 && x < IMG_W && y >= 0 && y < IMG_H) ? img[y*IMG_W + x] : 0.0f;
+}
+
+
+__kernel void affine_transform_buffer(
+    const __global float * img,
+    __global float * output,
+    const __global float * matrices,
+    int IMG_W,
+    int IMG_H,
+    int n_in,
+    int OUT_W,
+    int OUT_H,
+    int n_frames)
+{
+    int gidx = (int) get_global_id(0);
+    int gidy = (int) get_global_id(1);
+    int k = (int) get_global_id(2); // frame index
+    if (gidx >= OUT_W || gidy >= OUT_H || k >= n_frames) return;
+
+    float2 pos = affine_coords(matrices, k, gidx, gidy);
+    const __global float * frame = img + ((n_in == 1) ? 0 : k) * IMG_W * IMG_H;
+    int xm = (int) floor(pos.x);
+    int ym = (int) floor(pos.y);
+    float fx = pos.x - xm;
+    float fy = pos.y - ym;
+    float val = (1.0f - fy) * ((1.0f - fx) * pixel_or_zero(frame, xm, ym, IMG_W, IMG_H) + fx * pixel_or_zero(frame, xm+1, ym, IMG_W, IMG_H))
+                       + fy * ((1.0f - fx) * pixel_or_zero(frame, xm, ym+1, IMG_W, IMG_H) + fx * pixel_or_zero(frame, xm+1, ym+1, IMG_W, IMG_H));
+    output[(k*OUT_H + gidy)*OUT_W + gidx] = val;
+}
@@ -1,4 +1,91 @@
 
+///
+/// Center of the filter : for an even filter size, the center is shifted to the left
+///
+
+static inline void filter_center(int hlen, int * c, int * hL, int * hR) {
+    if (hlen & 1) { // odd kernel size
+        *c = hlen/2;
+        *hL = *c;
+        *hR = *c;
+    }
+    else { // even kernel size : center is shifted to the left
+        *c = hlen/2 - 1;
+        *hL = *c;
+        *hR = *c+1;
+    }
+}
+
+
+///
+/// Convolutions of one pixel of an image
+///
+
+static inline float horizontal_pixel(const __global float * input, __global float * filter, int hlen, int IMAGE_W, int gidx, int gidy) {
+    int c, hL, hR;
+    filter_center(hlen, &c, &hL, &hR);
+    int jx1 = c - gidx;
+    int jx2 = IMAGE_W - 1 - gidx + c;
+    float sum = 0.0f;
+
+    // Convolution with boundaries extension
+    for (int jx = 0; jx <= hR+hL; jx++) {
+        int idx_x = gidx - c + jx;
+        if (jx < jx1) idx_x = jx1-jx-1;
+        if (jx > jx2) idx_x = IMAGE_W - (jx-jx2);
+
+        sum += input[(gidy)*IMAGE_W + idx_x] * filter[hlen-1 - jx];
+    }
+    return sum;
+}
+
+
+static inline float vertical_pixel(const __global float * input, __global float * filter, int hlen, int IMAGE_W, int IMAGE_H, int gidx, int gidy) {
+    int c, hL, hR;
+    filter_center(hlen, &c, &hL, &hR);
+    int jy1 = c - gidy;
+    int jy2 = IMAGE_H - 1 - gidy + c;
+    float sum = 0.0f;
+
+    // Convolution with boundaries extension
+    for (int jy = 0; jy <= hR+hL; jy++) {
+        int idx_y = gidy - c + jy;
+        if (jy < jy1) idx_y = jy1-jy-1;
+        if (jy > jy2) idx_y = IMAGE_H - (jy-jy2);
+
+        sum += input[(idx_y)*IMAGE_W + gidx] * filter[hlen-1 - jy];
+    }
+    return sum;
+}
+
+
+static inline float nonseparable_pixel(const __global float * input, __global float * filter, int hlen, int IMAGE_W, int IMAGE_H, int gidx, int gidy) {
+    int c, hL, hR;
+    filter_center(hlen, &c, &hL, &hR);
+    int jx1 = c - gidx;
+    int jx2 = IMAGE_W - 1 - gidx + c;
+    int jy1 = c - gidy;
+    int jy2 = IMAGE_H - 1 - gidy + c;
+    float sum = 0.0f;
+
+    // Convolution with boundaries extension
+    for (int jy = 0; jy <= hR+hL; jy++) {
+        int idx_y = gidy - c + jy;
+        if (jy < jy1) idx_y = jy1-jy-1;
+        if (jy > jy2) idx_y = IMAGE_H - (jy-jy2);
+
+        for (int jx = 0; jx <= hR+hL; jx++) {
+            int idx_x = gidx - c + jx;
+            if (jx < jx1) idx_x = jx1-jx-1;
+            if (jx > jx2) idx_x = IMAGE_W - (jx-jx2);
+
+            sum += input[(idx_y)*IMAGE_W + idx_x] * filter[(hlen-1 - jy)*hlen + (hlen-1-jx)];
+        }
+    }
+    return sum;
+}
+
+
 ///
 /// Horizontal convolution (along fast dim)
 ///
@@ -15,31 +102,7 @@ __kernel void horizontal_convolution(
     int gidx = (int) get_global_id(0); // fast dim
 
     if (gidy < IMAGE_H && gidx < IMAGE_W) {
-
-        int c, hL, hR;
-        if (hlen & 1) { // odd kernel size
-            c = hlen/2;
-            hL = c;
-            hR = c;
-        }
-        else { // even kernel size : center is shifted to the left
-            c = hlen/2 - 1;
-            hL = c;
-            hR = c+1;
-        }
-        int jx1 = c - gidx;
-        int jx2 = IMAGE_W - 1 - gidx + c;
-        float sum = 0.0f;
-
-        // Convolution with boundaries extension
-        for (int jx = 0; jx <= hR+hL; jx++) {
-            int idx_x = gidx - c + jx;
-            if (jx < jx1) idx_x = jx1-jx-1;
-            if (jx > jx2) idx_x = IMAGE_W - (jx-jx2);
-
-            sum += input[(gidy)*IMAGE_W + idx_x] * filter[hlen-1 - jx];
-        }
-        output[(gidy)*IMAGE_W + gidx] =  sum;
+        output[(gidy)*IMAGE_W + gidx] = horizontal_pixel(input, filter, hlen, IMAGE_W, gidx, gidy);
     }
 }
 
@@ -60,31 +123,7 @@ __kernel void vertical_convolution(
     int gidx = (int) get_global_id(0); // fast dim
 
     if (gidy < IMAGE_H && gidx < IMAGE_W) {
-
-        int c, hL, hR;
-        if (hlen & 1) { // odd kernel size
-            c = hlen/2;
-            hL = c;
-            hR = c;
-        }
-        else { // even kernel size : center is shifted to the left
-            c = hlen/2 - 1;
-            hL = c;
-            hR = c+1;
-        }
-        int jy1 = c - gidy;
-        int jy2 = IMAGE_H - 1 - gidy + c;
-        float sum = 0.0f;
-
-        // Convolution with boundaries extension
-        for (int jy = 0; jy <= hR+hL; jy++) {
-            int idx_y = gidy - c + jy;
-            if (jy < jy1) idx_y = jy1-jy-1;
-            if (jy > jy2) idx_y = IMAGE_H - (jy-jy2);
-
-            sum += input[(idx_y)*IMAGE_W + gidx] * filter[hlen-1 - jy];
-        }
-        output[(gidy)*IMAGE_W + gidx] =  sum;
+        output[(gidy)*IMAGE_W + gidx] = vertical_pixel(input, filter, hlen, IMAGE_W, IMAGE_H, gidx, gidy);
     }
 }
 
@@ -102,46 +141,71 @@ __kernel void nonseparable_convolution(
     int gidx = (int) get_global_id(0); // fast dim
 
     if (gidy < IMAGE_H && gidx < IMAGE_W) {
+        output[(gidy)*IMAGE_W + gidx] = nonseparable_pixel(input, filter, hlen, IMAGE_W, IMAGE_H, gidx, gidy);
+    }
+}
 
-        int c, hL, hR;
-        if (hlen & 1) { // odd kernel size
-            c = hlen/2;
-            hL = c;
-            hR = c;
-        }
-        else { // even kernel size : center is shifted to the left
-            c = hlen/2 - 1;
-            hL = c;
-            hR = c+1;
-        }
-
-
-        int jx1 = c - gidx;
-        int jx2 = IMAGE_W - 1 - gidx + c;
-        int jy1 = c - gidy;
-        int jy2 = IMAGE_H - 1 - gidy + c;
-        float sum = 0.0f;
 
-        // Convolution with boundaries extension
-        for (int jy = 0; jy <= hR+hL; jy++) {
-            int idx_y = gidy - c + jy;
-            if (jy < jy1) idx_y = jy1-jy-1;
-            if (jy > jy2) idx_y = IMAGE_H - (jy-jy2);
+///
+/// Batched versions : the frames of a stack are processed in a single launch,
+/// the third grid dimension is the frame index.
+///
 
-            for (int jx = 0; jx <= hR+hL; jx++) {
-                int idx_x = gidx - c + jx;
-                if (jx < jx1) idx_x = jx1-jx-1;
-                if (jx > jx2) idx_x = IMAGE_W - (jx-jx2);
+__kernel void horizontal_convolution_batched(
+    const __global float * input,
+    __global float * output,
+    __global float * filter,
+    int hlen,
+    int IMAGE_W,
+    int IMAGE_H,
+    int n_frames)
+{
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+    int k = (int) get_global_id(2); // frame index
 
-                sum += input[(idx_y)*IMAGE_W + idx_x] * filter[(hlen-1 - jy)*hlen + (hlen-1-jx)];
-            }
-        }
-        output[(gidy)*IMAGE_W + gidx] =  sum;
+    if (gidy < IMAGE_H && gidx < IMAGE_W && k < n_frames) {
+        int offset = k*IMAGE_H*IMAGE_W;
+        output[offset + (gidy)*IMAGE_W + gidx] = horizontal_pixel(input + offset, filter, hlen, IMAGE_W, gidx, gidy);
     }
 }
 
 
+__kernel void vertical_convolution_batched(
+    const __global float * input,
+    __global float * output,
+    __global float * filter,
+    int hlen,
+    int IMAGE_W,
+    int IMAGE_H,
+    int n_frames)
+{
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+    int k = (int) get_global_id(2); // frame index
 
+    if (gidy < IMAGE_H && gidx < IMAGE_W && k < n_frames) {
+        int offset = k*IMAGE_H*IMAGE_W;
+        output[offset + (gidy)*IMAGE_W + gidx] = vertical_pixel(input + offset, filter, hlen, IMAGE_W, IMAGE_H, gidx, gidy);
+    }
+}
 
 
+__kernel void nonseparable_convolution_batched(
+    const __global float * input,
+    __global float * output,
+    __global float * filter,
+    int hlen,
+    int IMAGE_W,
+    int IMAGE_H,
+    int n_frames)
+{
+    int gidy = (int) get_global_id(1);
+    int gidx = (int) get_global_id(0); // fast dim
+    int k = (int) get_global_id(2); // frame index
 
+    if (gidy < IMAGE_H && gidx < IMAGE_W && k < n_frames) {
+        int offset = k*IMAGE_H*IMAGE_W;
+        output[offset + (gidy)*IMAGE_W + gidx] = nonseparable_pixel(input + offset, filter, hlen, IMAGE_W, IMAGE_H, gidx, gidy);
+    }
+}
@@ -2,8 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-import math
 from oclutils import Ocl
+from filters import comp_kern_scipy
 import matplotlib.pyplot as plt
 try:
     from scipy.ndimage import gaussian_filter as scipy_gaussian_filter
@@ -12,28 +12,6 @@ except ImportError:
     __has_ndimage = False
 
 
-def comp_kern_scipy(sigma, truncate=4):
-    sd = float(sigma)
-    # make the radius of the filter equal to truncate standard deviations
-    lw = int(truncate * sd + 0.5)
-    weights = [0.0] * (2 * lw + 1)
-    weights[lw] = 1.0
-    sum = 1.0
-    sd = sd * sd
-    # calculate the kernel:
-    for ii in range(1, lw + 1):
-        tmp = math.exp(-0.5 * float(ii * ii) / sd)
-        weights[lw + ii] = tmp
-        weights[lw - ii] = tmp
-        sum += 2.0 * tmp
-    for ii in range(2 * lw + 1):
-        weights[ii] /= sum
-    return np.ascontiguousarray(weights)
-
-
-
-
-
 if __name__ == "__main__":
 
     from scipy.misc import lena
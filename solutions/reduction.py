@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pyopencl as cl
+from oclutils import Ocl, CL_TYPES
+
+
+# Layout of the stats_t structure of reduction.cl
+STATS_DTYPE = np.dtype([
+    ("n", np.int32), ("mean", np.float32), ("m2", np.float32),
+    ("vmin", np.float32), ("vmax", np.float32),
+    ("imin", np.int32), ("imax", np.int32), ("pad", np.int32),
+])
+
+
+class Reduction:
+    """
+    Helper class for parallel reductions on device buffers.
+    A single pass computes all the statistics : sum, mean, var, std, min, max, argmin, argmax.
+    Only the (small) result is transferred back to the host.
+    """
+
+
+    def __init__(self, device=None, program_path=None, ocl=None, wg=256):
+        """
+        @param device : (optional) device in the format (0, 0)
+        @param program_path : (optional) path of the reduction program
+        @param ocl : (optional) existing Ocl instance
+        @param wg : (optional) work-group size, a power of two
+        """
+        self.ocl = ocl if ocl is not None else Ocl(device=device)
+        self.program_path = program_path if program_path is not None else "opencl/reduction.cl"
+        self.wg = min(wg, self.ocl.device.max_work_group_size)
+        self.kernels = {}
+
+
+    def get_kernels(self, dtype):
+        """
+        Return the kernels for an input data type. The program is built once for each data type.
+        """
+        dtype = np.dtype(dtype)
+        if dtype not in CL_TYPES:
+            raise ValueError("Reduction: unsupported data type %s" % dtype)
+        if dtype not in self.kernels:
+            program = self.ocl.compile_file(self.program_path, defines={"DTYPE": CL_TYPES[dtype]})
+            self.kernels[dtype] = dict((name, self.ocl.kernel(program, name)) for name in ["reduce_stats", "reduce_stats_partial", "reduce_stats_axis", "reduce_stats_lines"])
+        return self.kernels[dtype]
+
+
+    def reduce_device(self, d_data, shape=None, dtype=None, axis=None, wait_for=None):
+        """
+        Reduce a device buffer. Returns (d_stats, stats_shape, event) where d_stats is a device buffer
+        of STATS_DTYPE structures, of shape stats_shape (a single structure if axis is None).
+
+        @param d_data : device buffer, for eg. created by Ocl.to_device() or Ocl.create_buffer()
+        @param shape : (optional) shape of the data. Default is guessed from the book-keeping of Ocl.
+        @param dtype : (optional) data type of the data. Default is guessed from the book-keeping of Ocl.
+        @param axis : (optional) axis along which the data is reduced. Default is the whole array.
+        @param wait_for : (optional) list of events to wait for
+        """
+        if shape is None or dtype is None:
+            shape2, dtype2 = self.ocl.buffer_type(d_data, "reduce_device")
+            shape = shape2 if shape is None else shape
+            dtype = dtype2 if dtype is None else dtype
+        shape = tuple(shape) if hasattr(shape, "__len__") else (shape,)
+        kernels = self.get_kernels(dtype)
+        n = int(np.prod(shape))
+
+        if axis is not None:
+            axis = axis % len(shape)
+            outer = int(np.prod(shape[:axis]))
+            length = shape[axis]
+            inner = int(np.prod(shape[axis+1:]))
+            out_shape = shape[:axis] + shape[axis+1:]
+            d_stats = self.ocl.create_buffer(out_shape, STATS_DTYPE)
+            nbytes = n * np.dtype(dtype).itemsize
+            if inner >= min(self.wg, 64):
+                # One work-item per output : the reads of a work-group are contiguous along the inner dimension
+                block = (min(self.wg, 64), 1)
+                ev = self.ocl.call(kernels["reduce_stats_axis"], (inner, outer), block, d_data, outer, length, inner, d_stats,
+                                   wait_for=wait_for, nbytes=nbytes)
+            else:
+                # One work-group per reduced line, with a tree reduction in local memory
+                wg = 1
+                while wg < length and 2 * wg <= self.wg:
+                    wg <<= 1
+                ev = self.ocl.call(kernels["reduce_stats_lines"], (wg, inner * outer), (wg, 1), d_data, outer, length, inner, d_stats,
+                                   cl.LocalMemory(wg * STATS_DTYPE.itemsize), wait_for=wait_for, nbytes=nbytes)
+            return d_stats, out_shape, ev
+
+        # Each stage reduces its input to n_groups partial results, until a single one is left
+        kernel = kernels["reduce_stats"]
+        d_in = d_data
+        temporaries = []
+        while True:
+            n_groups = max(1, min((n + self.wg - 1) // self.wg, self.wg))
+            d_out = self.ocl.create_buffer(n_groups, STATS_DTYPE)
+            temporaries.append(d_out)
+            ev = self.ocl.call(kernel, (n_groups * self.wg,), (self.wg,), d_in, n, d_out, cl.LocalMemory(self.wg * STATS_DTYPE.itemsize),
+                               wait_for=wait_for)
+            wait_for = None
+            if n_groups == 1:
+                break
+            d_in, n = d_out, n_groups
+            kernel = kernels["reduce_stats_partial"]
+        for d_id in temporaries[:-1]:
+            self.ocl.release_buffer(d_id)
+        return d_out, (), ev
+
+
+    @staticmethod
+    def finalize(stats, ddof=0):
+        """
+        Compute the statistics from an array of STATS_DTYPE structures.
+        """
+        n = stats["n"].astype(np.float64)
+        mean = stats["mean"].astype(np.float64)
+        var = stats["m2"].astype(np.float64) / np.maximum(n - ddof, 1)
+        res = {
+            "count": stats["n"],
+            "sum": mean * n,
+            "mean": mean,
+            "var": var,
+            "std": np.sqrt(var),
+            "min": stats["vmin"],
+            "max": stats["vmax"],
+            "argmin": stats["imin"],
+            "argmax": stats["imax"],
+        }
+        if stats.ndim == 0:
+            res = dict((k, v[()]) for k, v in res.items())
+        return res
+
+
+    def stats(self, data, axis=None, ddof=0):
+        """
+        Compute all the statistics of an array in a single pass.
+        Returns a dictionary with the keys count, sum, mean, var, std, min, max, argmin, argmax.
+        The values are scalars, or arrays for a reduction along an axis.
+        argmin/argmax are indices in the flattened array (as numpy), or along the axis.
+
+        @param data : numpy array or device buffer (created by the Ocl instance)
+        @param axis : (optional) axis along which the data is reduced. Default is the whole array.
+        @param ddof : (optional) "delta degrees of freedom" of the variance, as in numpy.var
+        """
+        if isinstance(data, cl.Buffer):
+            d_data = data
+        else:
+            data = np.asarray(data)
+            if data.dtype not in CL_TYPES:
+                data = Ocl.check_array(data)
+            d_data = self.ocl.to_device(data, flags="r")
+        d_stats, stats_shape, ev = self.reduce_device(d_data, axis=axis)
+        stats = self.ocl.fetch(d_stats, dest=np.empty(stats_shape, dtype=STATS_DTYPE))
+        self.ocl.release_buffer(d_stats)
+        if d_data is not data:
+            self.ocl.release_buffer(d_data)
+        return Reduction.finalize(stats, ddof)
+
+
+    def sum(self, data, axis=None):
+        return self.stats(data, axis)["sum"]
+
+    def mean(self, data, axis=None):
+        return self.stats(data, axis)["mean"]
+
+    def std(self, data, axis=None, ddof=0):
+        return self.stats(data, axis, ddof)["std"]
+
+    def min(self, data, axis=None):
+        return self.stats(data, axis)["min"]
+
+    def max(self, data, axis=None):
+        return self.stats(data, axis)["max"]
+
+    def argmin(self, data, axis=None):
+        return self.stats(data, axis)["argmin"]
+
+    def argmax(self, data, axis=None):
+        return self.stats(data, axis)["argmax"]
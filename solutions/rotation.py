@@ -1,12 +1,169 @@
 import numpy as np
+import pyopencl as cl
 from oclutils import Ocl
-import matplotlib.pyplot as plt
+
+
+class Gpurotation:
+    """
+    Helper class for batched rotations and affine transforms of images on GPU.
+    A whole stack of frames is transformed in a single launch, each frame with its own matrix.
+    The interpolation uses image objects (texture units) when the device supports them and the frames fit
+    in its maximum image sizes, and falls back to a kernel on buffers otherwise.
+    """
+
+
+    def __init__(self, shape, device=None, program_path=None, ocl=None, use_images=None):
+        """
+        @param shape : shape (Nr, Nc) of the frames
+        @param device : (optional) device in the format (0, 0)
+        @param program_path : (optional) path of the rotation program
+        @param ocl : (optional) existing Ocl instance
+        @param use_images : (optional) force (True) or disable (False) image objects. Default is to use them when supported.
+        """
+        self.ocl = ocl if ocl is not None else Ocl(device=device)
+        self.shape = tuple(shape)
+        if program_path is None:
+            program_path = "opencl/rotation.cl"
+        self.program = self.ocl.compile_file(program_path)
+        self.kernels = {}
+        for name in ["affine_transform_image2d", "affine_transform_image3d", "affine_transform_buffer"]:
+            self.kernels[name] = self.ocl.kernel(self.program, name)
+        self.image_format = cl.ImageFormat(cl.channel_order.R, cl.channel_type.FLOAT)
+        if use_images is None:
+            use_images = self.images_supported()
+        self.use_images = use_images
+        self.images = {} # number of frames -> image object, reused between the calls
+
+
+    def images_supported(self):
+        """
+        Check that the device supports 2D and 3D float images
+        """
+        if not self.ocl.device.image_support:
+            return False
+        for image_type in [cl.mem_object_type.IMAGE2D, cl.mem_object_type.IMAGE3D]:
+            formats = cl.get_supported_image_formats(self.ocl.ctx, cl.mem_flags.READ_ONLY, image_type)
+            if not any(f.channel_order == self.image_format.channel_order and f.channel_data_type == self.image_format.channel_data_type for f in formats):
+                return False
+        return True
+
+
+    def images_fit(self, n_frames):
+        """
+        Check that n_frames frames fit in an image object : a 2D image for a single frame, a 3D image otherwise
+        """
+        Nr, Nc = self.shape
+        dev = self.ocl.device
+        if n_frames == 1:
+            return Nc <= dev.image2d_max_width and Nr <= dev.image2d_max_height
+        return Nc <= dev.image3d_max_width and Nr <= dev.image3d_max_height and n_frames <= dev.image3d_max_depth
+
+
+    def get_image(self, n_frames):
+        """
+        Return an image object for n_frames frames : a 2D image for a single frame, a 3D image otherwise
+        """
+        if n_frames not in self.images:
+            Nr, Nc = self.shape
+            shape = (Nc, Nr) if n_frames == 1 else (Nc, Nr, n_frames)
+            self.images[n_frames] = cl.Image(self.ocl.ctx, cl.mem_flags.READ_ONLY, self.image_format, shape=shape)
+        return self.images[n_frames]
+
+
+    @staticmethod
+    def rotation_matrices(angles, shape, center=None):
+        """
+        Compute the matrices of rotations of the frames around a center. Returns a (N, 2, 3) float32 array.
+
+        @param angles : rotation angles in radians (scalar or sequence)
+        @param shape : shape (Nr, Nc) of the frames
+        @param center : (optional) center (x, y) of the rotation. Default is the center of the frames.
+        """
+        angles = np.atleast_1d(np.asarray(angles, dtype=np.float64))
+        Nr, Nc = shape
+        cx, cy = ((Nc - 1)/2., (Nr - 1)/2.) if center is None else center
+        ct, st = np.cos(angles), np.sin(angles)
+        matrices = np.zeros((angles.size, 2, 3), dtype=np.float64)
+        matrices[:, 0, 0] = ct
+        matrices[:, 0, 1] = -st
+        matrices[:, 0, 2] = cx - cx*ct + cy*st
+        matrices[:, 1, 0] = st
+        matrices[:, 1, 1] = ct
+        matrices[:, 1, 2] = cy - cx*st - cy*ct
+        return matrices.astype(np.float32)
+
+
+    def transform_device(self, d_input, n_in, matrices, d_output=None, wait_for=None):
+        """
+        Transform frames already on the device. Returns the output device buffer (n_frames, Nr, Nc)
+        and the event of the kernel.
+
+        @param d_input : device buffer of n_in float32 frames
+        @param n_in : number of input frames : 1 (the same frame is transformed by all the matrices) or n_frames
+        @param matrices : (n_frames, 2, 3) array mapping the output coordinates (x, y, 1) to the input coordinates
+        @param d_output : (optional) output device buffer
+        @param wait_for : (optional) list of events to wait for
+        """
+        matrices = np.ascontiguousarray(matrices, dtype=np.float32).reshape((-1, 2, 3))
+        n_frames = matrices.shape[0]
+        if n_in not in [1, n_frames]:
+            raise ValueError("transform_device(): expected 1 or %d input frames, got %d" % (n_frames, n_in))
+        Nr, Nc = self.shape
+        if d_output is None:
+            d_output = self.ocl.create_buffer((n_frames, Nr, Nc), np.float32)
+        d_matrices = self.ocl.to_device(matrices, flags="r")
+        grid = (Nc, Nr, n_frames)
+        nbytes = (n_in + n_frames) * Nr * Nc * 4
+        if self.use_images and self.images_fit(n_in):
+            img = self.get_image(n_in)
+            region = (Nc, Nr) if n_in == 1 else (Nc, Nr, n_in)
+            ev_copy = self.ocl.copy_to_image(img, d_input, region, wait_for=wait_for)
+            name = "affine_transform_image2d" if n_in == 1 else "affine_transform_image3d"
+            ev = self.ocl.call(self.kernels[name], grid, None, img, d_output, d_matrices, Nc, Nr, n_frames,
+                               wait_for=[ev_copy], nbytes=nbytes)
+        else:
+            ev = self.ocl.call(self.kernels["affine_transform_buffer"], grid, None, d_input, d_output, d_matrices,
+                               Nc, Nr, n_in, Nc, Nr, n_frames, wait_for=wait_for, nbytes=nbytes)
+        self.ocl.release_buffer(d_matrices)
+        return d_output, ev
+
+
+    def transform(self, images, matrices):
+        """
+        Apply affine transforms to an image or a stack of images. Returns a (n_frames, Nr, Nc) float32 array.
+
+        @param images : image (Nr, Nc), transformed by all the matrices, or stack of n_frames images (n_frames, Nr, Nc)
+        @param matrices : (n_frames, 2, 3) array mapping the output coordinates (x, y, 1) to the input coordinates
+        """
+        images = Ocl.check_array(images).astype(np.float32, copy=False)
+        if images.shape[-2:] != self.shape:
+            raise ValueError("transform(): invalid frame size: expected %s, got %s" % (str(self.shape), str(images.shape[-2:])))
+        n_in = 1 if images.ndim == 2 else images.shape[0]
+        d_input = self.ocl.to_device(images, flags="r")
+        d_output, ev = self.transform_device(d_input, n_in, matrices)
+        res = self.ocl.fetch(d_output)
+        self.ocl.release_buffer(d_input)
+        self.ocl.release_buffer(d_output)
+        return res
+
+
+    def rotate(self, images, angles, center=None):
+        """
+        Rotate an image or a stack of images. Returns a (n_frames, Nr, Nc) float32 array.
+
+        @param images : image (Nr, Nc), rotated by all the angles, or stack of images (n_frames, Nr, Nc)
+        @param angles : rotation angles in radians, one for each output frame
+        @param center : (optional) center (x, y) of the rotation. Default is the center of the frames.
+        """
+        return self.transform(images, Gpurotation.rotation_matrices(angles, self.shape, center))
 
 
 
 
 if __name__ == "__main__":
 
+    import matplotlib.pyplot as plt
+
     from scipy.misc import lena
     img = lena().astype(np.float32)
     Nr, Nc = img.shape
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import pyopencl as cl
+from oclutils import Ocl
+from convol import Gpuconvol
+from binning import Binning
+from filters import device_gaussian
+from devarray import DeviceArray
+
+
+class ScaleSpace:
+    """
+    Gaussian scale space of a 2D image or a 3D volume on GPU : octaves of Gaussian levels, and their differences (DoG).
+
+    Each octave has n_scales + 1 levels of blur sigma0 * k**i (i = 0 ... n_scales, k = 2**(1/n_scales)),
+    in pixels of the octave. Each level is computed from the previous one by the Gaussian of standard deviation
+    sqrt(sigma_i**2 - sigma_{i-1}**2), which is much smaller than sigma_i : the filters have fewer coefficients
+    than filters of the input image. The first level of the next octave is the last level binned by 2 along each
+    axis (binning.cl) : pixel j of octave o is centered on (j + 0.5) * 2**o - 0.5 in the input.
+
+    All the levels and DoG stay on the device, and are transferred on demand :
+        ss = ScaleSpace(img.shape)
+        ss.compute(img)
+        blurred = ss.level(1, 2)
+        dog = ss.dog(0, 1)
+    """
+
+
+    def __init__(self, shape, device=None, program_dir=None, ocl=None, sigma0=1.6, n_scales=3, n_octaves=None, init_sigma=0.5,
+                 min_size=16, tiled=False):
+        """
+        @param shape : shape of the images/volumes
+        @param device : (optional) device in the format (0, 0)
+        @param program_dir : (optional) directory of the OpenCL programs
+        @param ocl : (optional) existing Ocl instance
+        @param sigma0 : (optional) blur of the first level of each octave, in pixels of the octave
+        @param n_scales : (optional) number of levels per doubling of sigma
+        @param n_octaves : (optional) number of octaves. Default is to stop before a dimension gets smaller than min_size.
+        @param init_sigma : (optional) blur assumed in the input image
+        @param min_size : (optional) with the default n_octaves, minimum size of the octaves along each axis
+        @param tiled : (optional) use the tiled convolution kernels (see Gpuconvol)
+        """
+        self.ocl = ocl if ocl is not None else Ocl(device=device)
+        self.program_dir = program_dir if program_dir is not None else "opencl"
+        self.shape = tuple(shape)
+        self.ndim = len(self.shape)
+        if self.ndim not in [2, 3]:
+            raise ValueError("ScaleSpace: expected a 2D or 3D shape, got %s" % str(self.shape))
+        if sigma0 <= 0 or n_scales < 1:
+            raise ValueError("ScaleSpace: sigma0 must be positive and n_scales at least 1")
+        self.sigma0 = float(sigma0)
+        self.n_scales = n_scales
+        self.init_sigma = float(init_sigma)
+        self.k = 2. ** (1. / n_scales)
+
+        # Shapes of the octaves
+        self.factors = (2,) * self.ndim
+        self.shapes = [self.shape]
+        while True:
+            next_shape = Binning.output_shape(self.shapes[-1], self.factors)
+            if (n_octaves is not None and len(self.shapes) >= n_octaves) or (n_octaves is None and min(next_shape) < min_size):
+                break
+            if min(next_shape) < 1:
+                raise ValueError("ScaleSpace: %d octaves do not fit in shape %s" % (n_octaves, str(self.shape)))
+            self.shapes.append(next_shape)
+        self.n_octaves = len(self.shapes)
+
+        # One convolution helper per octave (for its kernels and temporary buffers), and resident levels
+        program_path = os.path.join(self.program_dir, "convolution.cl")
+        self.convols = [Gpuconvol(s, ocl=self.ocl, program_path=program_path, tiled=tiled, fft=False) for s in self.shapes]
+        self.binning = Binning(ocl=self.ocl, program_path=os.path.join(self.program_dir, "binning.cl"))
+        self.levels = [[self.ocl.create_buffer(s, np.float32) for i in range(n_scales + 1)] for s in self.shapes]
+        self.dogs = [[None] * n_scales for s in self.shapes] # buffers of the DoG, allocated at the first request
+        self.dogs_valid = [[False] * n_scales for s in self.shapes] # DoG computed from the current levels
+        self.blur = [[None] * (n_scales + 1) for s in self.shapes] # actual blur of the levels, in pixels of the octave
+        self.event = None
+
+
+    def sigma(self, octave, index):
+        """
+        Blur of a level, in pixels of the input image
+        """
+        return self.blur[octave][index] * 2 ** octave
+
+
+    def smooth(self, octave, d_src, d_dst, blur_src, blur_dst, wait_for=None):
+        """
+        Enqueue the Gaussian filter bringing d_src from blur_src to blur_dst. Returns the event of the last pass.
+        """
+        conv = self.convols[octave]
+        if blur_dst <= blur_src:
+            return cl.enqueue_copy(self.ocl.queue, d_dst, d_src, byte_count=int(np.prod(conv.image_shape)) * 4, wait_for=wait_for)
+        d_gaussian, ksize = device_gaussian(self.ocl, np.sqrt(blur_dst ** 2 - blur_src ** 2))
+        # convolve() writes its result in its second (3D) or third (2D) buffer
+        if self.ndim == 3:
+            d_res, ev = conv.convolve(d_src, d_dst, conv.d_tmp, d_gaussian, ksize, wait_for=wait_for)
+        else:
+            d_res, ev = conv.convolve(d_src, conv.d_output, d_dst, d_gaussian, ksize, wait_for=wait_for)
+        return ev
+
+
+    def compute_device(self, d_input, wait_for=None):
+        """
+        Compute all the levels from a float32 image/volume already on the device. Returns the event of the last kernel.
+        The DoG of the previous image are discarded : their buffers are reused by the next requests.
+        """
+        ev = None
+        for o in range(self.n_octaves):
+            levels = self.levels[o]
+            if o == 0:
+                ev = self.smooth(0, d_input, levels[0], self.init_sigma, self.sigma0, wait_for=wait_for)
+                self.blur[0][0] = max(self.init_sigma, self.sigma0)
+            else:
+                # The 2x2 binning halves the blur, and adds the blur of the box filter (variance 1/4 in the previous octave)
+                d_res, ev = self.binning.bin_device(self.levels[o-1][-1], self.shapes[o-1], np.float32, self.factors, d_output=levels[0])
+                self.blur[o][0] = np.sqrt(self.blur[o-1][-1] ** 2 + 0.25) / 2
+            for i in range(1, self.n_scales + 1):
+                target = max(self.sigma0 * self.k ** i, self.blur[o][i-1])
+                ev = self.smooth(o, levels[i-1], levels[i], self.blur[o][i-1], target)
+                self.blur[o][i] = target
+        self.dogs_valid = [[False] * self.n_scales for s in self.shapes]
+        self.event = ev
+        return ev
+
+
+    def compute(self, image):
+        """
+        Compute all the levels of an image/volume. The levels stay on the device (see level() and dog()).
+        """
+        image = np.asarray(image)
+        if image.shape != self.shape:
+            raise ValueError("ScaleSpace: invalid image size: expected %s, got %s" % (str(self.shape), str(image.shape)))
+        conv = self.convols[0]
+        d_input = self.ocl.to_device(np.ascontiguousarray(image, dtype=np.float32), destbuf=conv.d_input)
+        self.compute_device(d_input)
+        return self
+
+
+    def dog_device(self, octave, index):
+        """
+        Return the device buffer of the difference of Gaussians levels[index + 1] - levels[index] of an octave.
+        It is computed at the first request, and stays on the device.
+        """
+        if not(self.dogs_valid[octave][index]):
+            shape = self.shapes[octave]
+            a = DeviceArray(self.ocl, self.levels[octave][index], shape, np.float32)
+            b = DeviceArray(self.ocl, self.levels[octave][index + 1], shape, np.float32)
+            d_dog = self.dogs[octave][index]
+            out = DeviceArray(self.ocl, d_dog, shape, np.float32) if d_dog is not None else None
+            self.dogs[octave][index] = (b - a).evaluate(out=out).buffer
+            self.dogs_valid[octave][index] = True
+        return self.dogs[octave][index]
+
+
+    def level(self, octave, index):
+        """
+        Transfer a Gaussian level to the host
+        """
+        return self.ocl.fetch(self.levels[octave][index], dest=np.empty(self.shapes[octave], dtype=np.float32))
+
+
+    def dog(self, octave, index):
+        """
+        Transfer a difference of Gaussians to the host
+        """
+        return self.ocl.fetch(self.dog_device(octave, index), dest=np.empty(self.shapes[octave], dtype=np.float32))
+
+
+    def pyramid(self):
+        """
+        Transfer the first level of each octave to the host
+        """
+        return [self.level(o, 0) for o in range(self.n_octaves)]
+
+
+    def release(self):
+        """
+        Release the device buffers of the levels and DoG, and the buffers of the convolutions
+        """
+        for buffers in self.levels + self.dogs:
+            for d_id in buffers:
+                if d_id is not None:
+                    self.ocl.release_buffer(d_id)
+        for conv in self.convols:
+            conv.release()
+        self.levels = []
+        self.dogs = []
+        self.dogs_valid = []
+        self.convols = []
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the code generation of the element-wise expressions (devarray.py).
+The generated code is checked without a device : the arrays are placeholders (buffer objects are only compared
+by identity). The evaluation is checked against numpy when a device is available.
+"""
+
+import numpy as np
+import pyopencl as cl
+import pytest
+import devarray
+from devarray import DeviceArray, Expression
+
+
+class Buffer:
+    pass
+
+
+def arrays(*dtypes):
+    return [DeviceArray(None, Buffer(), (4, 5), dtype) for dtype in dtypes]
+
+
+def codegen(expr):
+    leaves = expr.leaves()
+    scalars = []
+    code = expr.generate(leaves, scalars)
+    return code, leaves, scalars
+
+
+def test_generate_nested():
+    a, b, c = arrays(np.float32, np.float32, np.float32)
+    code, leaves, scalars = codegen((a - b) * c + 2)
+    assert code == "(((((float) in0[i]) - ((float) in1[i])) * ((float) in2[i])) + s0)"
+    assert [leaf.buffer for leaf in leaves] == [a.buffer, b.buffer, c.buffer]
+    assert scalars == [2.0]
+    assert ((a - b) * c + 2).count_ops() == 3
+
+
+def test_generate_functions():
+    a, b = arrays(np.float32, np.uint16)
+    code, leaves, scalars = codegen(devarray.sqrt(abs(a) / 3.5) - devarray.maximum(b, 0.5) ** 2)
+    assert code == "(sqrt((fabs(((float) in0[i])) / s0)) - pow(fmax(((float) in1[i]), s1), s2))"
+    assert scalars == [3.5, 0.5, 2.0]
+    code, leaves, scalars = codegen(-a)
+    assert code == "(-((float) in0[i]))"
+
+
+def test_reversed_operands():
+    a, = arrays(np.float32)
+    code, leaves, scalars = codegen(1 - 2 / a)
+    assert code == "(s0 - (s1 / ((float) in0[i])))"
+    assert scalars == [1.0, 2.0]
+    code, leaves, scalars = codegen(np.float32(3) * a)
+    assert code == "(s0 * ((float) in0[i]))"
+
+
+def test_arguments_dedup():
+    a, b = arrays(np.float32, np.int16)
+    # A DeviceArray used several times, or two DeviceArray of the same buffer, are a single argument
+    a2 = DeviceArray(None, a.buffer, a.shape, a.dtype)
+    expr = (a * a + b) / (a2 - b)
+    code, leaves, scalars = codegen(expr)
+    assert len(leaves) == 2
+    assert code == "(((((float) in0[i]) * ((float) in0[i])) + ((float) in1[i])) / (((float) in0[i]) - ((float) in1[i])))"
+    src = Expression.kernel_source(code, leaves, len(scalars))
+    assert "const __global float * in0,\n    const __global short * in1,\n    int n)" in src
+    assert "__global float * output" in src
+    assert "if (i < n) output[i] = %s;" % code in src
+
+
+def test_kernel_source_scalars():
+    a, b = arrays(np.uint8, np.float32)
+    code, leaves, scalars = codegen(a * 0.25 + b * 4)
+    src = Expression.kernel_source(code, leaves, len(scalars))
+    args = src[src.index("(") + 1:src.index(")\n")].split(",\n    ")
+    assert args == ["__global float * output", "const __global uchar * in0", "const __global float * in1", "float s0", "float s1", "int n"]
+
+
+def test_scalar_only_expression():
+    with pytest.raises(TypeError):
+        Expression.wrap("a")
+    with pytest.raises(ValueError):
+        (Expression.wrap(1) + 2).evaluate()
+
+
+def test_evaluate():
+    try:
+        from oclutils import Ocl
+        ocl = Ocl(device={})
+    except (cl.Error, RuntimeError) as exc:
+        pytest.skip("no OpenCL device: %s" % exc)
+    rng = np.random.RandomState(0)
+    a_h, b_h = rng.rand(4, 5).astype(np.float32), (100 * rng.rand(4, 5)).astype(np.uint16)
+    a, b = DeviceArray.from_host(ocl, a_h), DeviceArray.from_host(ocl, b_h)
+    res = (devarray.sqrt(a * b + 1) - a / 2).get()
+    assert np.allclose(res, np.sqrt(a_h * b_h + 1) - a_h / 2, rtol=1e-5)
+    # The kernel is reused for other values of the scalars
+    n_kernels = len(devarray._kernels[ocl])
+    assert np.allclose((devarray.sqrt(a * b + 3) - a / 5).get(), np.sqrt(a_h * b_h + 3) - a_h / 5, rtol=1e-5)
+    assert len(devarray._kernels[ocl]) == n_kernels
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the filter coefficients and of the FilterCache of filters.py. Run with : python -m pytest
+The tests needing an OpenCL device are skipped when none is available.
+"""
+
+import gc
+import numpy as np
+import pyopencl as cl
+import pytest
+from scipy.ndimage import gaussian_filter1d
+import filters
+from filters import gaussian_kernel, FilterCache, filter_cache, device_gaussian
+from oclutils import Ocl
+
+
+@pytest.fixture(scope="module")
+def device():
+    try:
+        return cl.create_some_context(interactive=False).devices[0]
+    except (cl.Error, RuntimeError) as exc:
+        pytest.skip("no OpenCL device: %s" % exc)
+
+
+# Coefficients
+
+@pytest.mark.parametrize("sigma", [0.7, 1.0, 2.5, 6.0])
+@pytest.mark.parametrize("order", [0, 1, 2, 3])
+@pytest.mark.parametrize("truncate", [3, 4])
+def test_gaussian_kernel(sigma, order, truncate):
+    kern = gaussian_kernel(sigma, truncate, order)
+    radius = int(truncate * sigma + 0.5)
+    assert kern.shape == (2*radius + 1,) and kern.dtype == np.float64
+    # Response of gaussian_filter1d to a delta : the convolution weights, in the same order
+    delta = np.zeros(4*radius + 1)
+    delta[2*radius] = 1
+    ref = gaussian_filter1d(delta, sigma, order=order, truncate=truncate, mode="constant")[radius:3*radius + 1]
+    assert np.allclose(kern, ref, rtol=0, atol=1e-12)
+
+
+def test_gaussian_kernel_invalid_order():
+    with pytest.raises(ValueError):
+        gaussian_kernel(1.0, order=-1)
+
+
+# FilterCache
+
+def test_cache_hits(device):
+    ocl = Ocl(device=device)
+    cache = FilterCache(ocl)
+    d_a, size = cache.get(2.0)
+    assert size == 17
+    assert np.array_equal(ocl.fetch(d_a), gaussian_kernel(2.0).astype(np.float32))
+    assert cache.get(2.0) == (d_a, size)
+    # Another truncation, order or data type is another entry
+    cache.get(2.0, truncate=3)
+    cache.get(2.0, order=1)
+    cache.get(2.0, dtype=np.float16)
+    assert cache.stats() == {"entries": 4, "hits": 1, "misses": 4}
+    cache.clear()
+    assert cache.stats()["entries"] == 0
+
+
+def test_cache_lru_eviction(device):
+    ocl = Ocl(device=device)
+    cache = FilterCache(ocl, max_size=2)
+    d_1 = cache.get(1.0)[0]
+    cache.get(2.0)
+    # Using 1.0 makes it the most recently used : 2.0 is released first
+    assert cache.get(1.0)[0] is d_1
+    cache.get(3.0)
+    assert list(cache.buffers) == [(1.0, 4.0, 0, "<f4"), (3.0, 4.0, 0, "<f4")]
+    cache.get(2.0)
+    assert cache.stats() == {"entries": 2, "hits": 1, "misses": 4}
+
+
+def test_cache_shared(device):
+    ocl = Ocl(device=device)
+    assert filter_cache(ocl) is filter_cache(ocl)
+    assert filter_cache(ocl) is not filter_cache(Ocl(device=device))
+    assert device_gaussian(ocl, 1.5) is filter_cache(ocl).get(1.5)
+
+
+def test_cache_weakref(device):
+    ocl = Ocl(device=device)
+    n_caches = len(filters._caches)
+    cache = filter_cache(ocl)
+    cache.get(1.0)
+    assert len(filters._caches) == n_caches + 1
+    # The cache does not keep the Ocl instance alive, and is dropped with it
+    del ocl
+    gc.collect()
+    assert len(filters._caches) == n_caches
+    assert cache.ocl is None
+    cache.clear()
+    assert cache.stats()["entries"] == 0
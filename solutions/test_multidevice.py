@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the splitting of the data by MultiOcl.map(). They do not need an OpenCL device :
+the "devices" are placeholders given to MultiOcl as Ocl instances, which map() only passes to func.
+"""
+
+import numpy as np
+import pytest
+from multidevice import MultiOcl, chunk_window
+
+
+def moving_sum(x, halo):
+    """
+    Sum of the items at a distance of at most halo, the data being extended by zeros
+    """
+    c = np.concatenate([[0], np.cumsum(x)])
+    i = np.arange(len(x))
+    return c[np.minimum(i + halo + 1, len(x))] - c[np.maximum(i - halo, 0)]
+
+
+def check_windows(n, size, halo):
+    for z0 in range(0, n, size):
+        z1 = min(z0 + size, n)
+        a0, a1 = chunk_window(z0, z1, size, halo, n)
+        assert a1 - a0 == min(size + 2*halo, n)
+        assert 0 <= a0 and a1 <= n
+        # The window contains the chunk and its halos, clipped to the data
+        assert a0 <= max(z0 - halo, 0) and a1 >= min(z1 + halo, n)
+
+
+@pytest.mark.parametrize("n, size, halo", [(10, 3, 0), (10, 3, 1), (37, 6, 4), (10, 2, 5), (7, 10, 2), (1, 1, 3), (100, 7, 20)])
+def test_chunk_window(n, size, halo):
+    check_windows(n, size, halo)
+
+
+@pytest.mark.parametrize("n, chunk_size, halo, adaptive", [
+    (37, 6, 0, False),  # the chunks do not divide the length
+    (37, 6, 2, False),
+    (37, 3, 5, False),  # halo larger than a chunk
+    (20, 4, 30, False), # halo larger than the data
+    (53, 2, 3, True),   # chunk sizes scaled by the throughput
+])
+def test_map(n, chunk_size, halo, adaptive):
+    multi = MultiOcl(ocls=["dev0", "dev1"])
+    data = np.random.RandomState(0).rand(n)
+    windows = []
+
+    def func(dev, window):
+        windows.append(len(window))
+        return moving_sum(window, halo)
+
+    res = multi.map(func, data, halo=halo, chunk_size=chunk_size, adaptive=adaptive)
+    assert np.allclose(res, moving_sum(data, halo))
+    if not adaptive:
+        assert set(windows) == set([min(chunk_size + 2*halo, n)])
+    assert sum(p for p in multi.processed) == n
+
+
+def test_map_empty():
+    multi = MultiOcl(ocls=["dev0"])
+    res = multi.map(lambda dev, window: window, np.zeros((0, 4, 5), dtype=np.uint16))
+    assert res.shape == (0, 4, 5) and res.dtype == np.uint16
+
+
+def test_map_states():
+    multi = MultiOcl(ocls=["dev0", "dev1"])
+    calls = []
+
+    def init(dev):
+        calls.append(dev)
+        return dev
+
+    data = np.arange(20)
+    multi.map(lambda state, window: window, data, init=init, chunk_size=2)
+    assert multi.states == {}
+    for i in range(2):
+        multi.map(lambda state, window: window, data, init=init, chunk_size=2, name="identity")
+    assert len(multi.states) == 2 and len(calls) == 4
+    multi.clear_states("identity")
+    assert multi.states == {}
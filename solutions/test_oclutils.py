@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the helpers of oclutils.py. Run with : python -m pytest
+The tests needing an OpenCL device are skipped when none is available.
+"""
+
+import os
+from types import SimpleNamespace
+import numpy as np
+import pyopencl as cl
+import pytest
+from oclutils import Ocl, BinaryCache, BufferPool, parse_device_spec, parse_size, device_matches, device_score
+
+
+SRC = "__kernel void twice(__global float * a) { a[get_global_id(0)] *= 2.0f; }"
+
+
+def fake_device(name="dev", driver_version="1.0", platform="platform"):
+    return SimpleNamespace(name=name, driver_version=driver_version, platform=SimpleNamespace(name=platform))
+
+
+@pytest.fixture(scope="module")
+def ctx():
+    try:
+        return cl.create_some_context(interactive=False)
+    except (cl.Error, RuntimeError) as exc:
+        pytest.skip("no OpenCL device: %s" % exc)
+
+
+# BinaryCache
+
+def test_cache_key():
+    dev = fake_device()
+    key = BinaryCache.key(SRC, ["-DN=1"], dev)
+    assert key == BinaryCache.key(SRC, ["-DN=1"], fake_device())
+    assert len(key) == 40
+    # Any change of the source, the options, the device or the driver gives another key
+    assert key != BinaryCache.key(SRC + " ", ["-DN=1"], dev)
+    assert key != BinaryCache.key(SRC, ["-DN=2"], dev)
+    assert key != BinaryCache.key(SRC, [], dev)
+    assert key != BinaryCache.key(SRC, ["-DN=1"], fake_device(name="other"))
+    assert key != BinaryCache.key(SRC, ["-DN=1"], fake_device(driver_version="1.1"))
+    assert key != BinaryCache.key(SRC, ["-DN=1"], fake_device(platform="other"))
+
+
+def test_cache_store_load(tmp_path):
+    cache = BinaryCache(str(tmp_path / "cache"))
+    assert cache.load("a") is None
+    cache.store("a", b"binary")
+    assert cache.load("a") == b"binary"
+    assert not [f for f in os.listdir(cache.path) if f.endswith(".tmp")]
+    st = cache.stats()
+    assert (st["hits"], st["misses"], st["entries"], st["size"]) == (1, 1, 1, 6)
+    cache.discard("a")
+    cache.discard("a") # no error for a missing entry
+    assert cache.load("a") is None
+
+
+def test_cache_lru_eviction(tmp_path):
+    cache = BinaryCache(str(tmp_path), max_size=250)
+    cache.store("a", b"a" * 100)
+    cache.store("b", b"b" * 100)
+    os.utime(cache.fname("a"), (1000, 1000))
+    os.utime(cache.fname("b"), (2000, 2000))
+    # Loading "a" makes it the most recently used : "b" is evicted first
+    assert cache.load("a") is not None
+    cache.store("c", b"c" * 100)
+    assert cache.load("b") is None
+    assert cache.load("a") is not None and cache.load("c") is not None
+    assert cache.evictions == 1
+    assert cache.stats()["size"] <= 250
+
+
+def test_cache_corrupt_entry(tmp_path, ctx):
+    ocl = Ocl(device=ctx.devices[0], cache_dir=str(tmp_path))
+    key = ocl.cache.key(SRC, [], ocl.device)
+    ocl.cache.store(key, b"not a binary")
+    # The rejected binary is discarded, the program is rebuilt from source and stored again
+    program = ocl.build_program(SRC)
+    a = np.arange(16, dtype=np.float32)
+    d_a = ocl.to_device(a)
+    ocl.call(program.twice, (16,), None, d_a).wait()
+    assert np.array_equal(ocl.fetch(d_a), 2 * a)
+    with open(ocl.cache.fname(key), "rb") as fid:
+        assert fid.read() != b"not a binary"
+    assert ocl.cache.hits == 1
+    ocl.build_program(SRC)
+    assert ocl.cache.hits == 2
+
+
+# BufferPool
+
+def test_pool_size_class():
+    assert [BufferPool.size_class(n) for n in [1, 2, 3, 4, 5, 1000, 1024, 1025]] == [1, 2, 4, 4, 8, 1024, 1024, 2048]
+
+
+def test_pool_reuse(ctx):
+    pool = BufferPool(ctx)
+    flags = cl.mem_flags.READ_WRITE
+    a = pool.allocate(1000, flags)
+    assert a.size == 1024 and pool.owns(a)
+    assert pool.release(a)
+    # Same size class and flags : the idle buffer is handed back
+    b = pool.allocate(600, flags)
+    assert b.int_ptr == a.int_ptr
+    # Other size class, other flags : new buffers
+    c = pool.allocate(2000, flags)
+    d = pool.allocate(1000, cl.mem_flags.READ_ONLY)
+    assert len(set([b.int_ptr, c.int_ptr, d.int_ptr])) == 3
+    st = pool.stats()
+    assert (st["hits"], st["misses"]) == (1, 3)
+    assert st["used_bytes"] == 1024 + 2048 + 1024
+    # Buffers not allocated by the pool are not taken
+    other = cl.Buffer(ctx, flags, 64)
+    assert not pool.release(other)
+    other.release()
+
+
+def test_pool_trim(ctx):
+    pool = BufferPool(ctx, max_size=2048)
+    flags = cl.mem_flags.READ_WRITE
+    bufs = [pool.allocate(1024, flags) for i in range(3)]
+    for buf in bufs:
+        pool.release(buf)
+    # The least recently released buffer is freed when the idle memory exceeds max_size
+    st = pool.stats()
+    assert (st["idle_bytes"], st["evictions"], st["used_bytes"]) == (2048, 1, 0)
+    assert not pool.owns(bufs[0]) and pool.owns(bufs[2])
+    pool.trim(0)
+    assert pool.stats()["idle_bytes"] == 0
+
+
+def test_pool_waits_for_pending_commands(ctx):
+    pool = BufferPool(ctx)
+    buf = pool.allocate(64, cl.mem_flags.READ_WRITE)
+    user_event = cl.UserEvent(ctx)
+    pool.release(buf, wait_for=[user_event])
+    assert pool.events[buf.int_ptr] == [user_event]
+    user_event.set_status(cl.command_execution_status.COMPLETE)
+    assert pool.allocate(64, cl.mem_flags.READ_WRITE).int_ptr == buf.int_ptr
+    assert buf.int_ptr not in pool.events
+
+
+# Device selection
+
+def fake_cl_device(name="dev", vendor="vendor", dev_type=cl.device_type.CPU, units=4, clock=2000, mem=8*1024**3,
+                   local_mem=32*1024, image=True, double=True):
+    return SimpleNamespace(name=name, vendor=vendor, type=dev_type, max_compute_units=units, max_clock_frequency=clock,
+                           global_mem_size=mem, local_mem_size=local_mem, image_support=image,
+                           extensions="cl_khr_fp64" if double else "")
+
+
+def test_parse_device_spec():
+    assert parse_device_spec(None) == {}
+    assert parse_device_spec("0,0") == {"index": (0, 0)}
+    assert parse_device_spec(" 1 , 2 ") == {"index": (1, 2)}
+    rules = {"type": "GPU"}
+    assert parse_device_spec(rules) == rules and parse_device_spec(rules) is not rules
+    assert parse_device_spec("gpu") == {"type": "GPU"}
+    assert parse_device_spec("cpu, min_mem=4G") == {"type": "CPU", "min_mem": "4G"}
+    assert parse_device_spec("Type=GPU, name=GeForce") == {"type": "GPU", "name": "GeForce"}
+    for spec in ["geforce", "0", "0,0,1", "gpu, fast"]:
+        with pytest.raises(ValueError):
+            parse_device_spec(spec)
+
+
+def test_parse_size():
+    assert [parse_size(v) for v in ["512", "4K", "1.5M", "2g"]] == [512, 4096, int(1.5*1024**2), 2*1024**3]
+
+
+def test_device_matches():
+    gpu = fake_cl_device(name="NVIDIA GeForce RTX", vendor="NVIDIA Corporation", dev_type=cl.device_type.GPU, mem=4*1024**3, double=False)
+    platform = SimpleNamespace(name="NVIDIA CUDA")
+    assert device_matches(gpu, platform, parse_device_spec("gpu"))
+    assert not device_matches(gpu, platform, parse_device_spec("cpu"))
+    # Case-insensitive substrings
+    assert device_matches(gpu, platform, parse_device_spec("name=geforce, vendor=nvidia, platform=cuda"))
+    assert not device_matches(gpu, platform, parse_device_spec("name=radeon"))
+    assert device_matches(gpu, platform, parse_device_spec("min_mem=4G, min_units=4, image=1"))
+    assert not device_matches(gpu, platform, parse_device_spec("min_mem=5G"))
+    assert not device_matches(gpu, platform, parse_device_spec("double=1"))
+    with pytest.raises(ValueError):
+        device_matches(gpu, platform, parse_device_spec("type=fpga"))
+    with pytest.raises(ValueError):
+        device_matches(gpu, platform, parse_device_spec("colour=blue"))
+
+
+def test_device_score():
+    cpu = fake_cl_device(units=16, clock=3000)
+    gpu = fake_cl_device(dev_type=cl.device_type.GPU, units=16, clock=1500)
+    small_gpu = fake_cl_device(dev_type=cl.device_type.GPU, units=4, clock=1500)
+    acc = fake_cl_device(dev_type=cl.device_type.ACCELERATOR, units=16, clock=1500)
+    assert device_score(gpu) > device_score(acc) > device_score(cpu)
+    assert device_score(gpu) > device_score(small_gpu)
+    # Same processing power : more memory, images and double precision are preferred
+    assert device_score(gpu) > device_score(fake_cl_device(dev_type=cl.device_type.GPU, units=16, clock=1500, mem=1024**3))
+    assert device_score(gpu) > device_score(fake_cl_device(dev_type=cl.device_type.GPU, units=16, clock=1500, image=False))
+    assert device_score(gpu) > device_score(fake_cl_device(dev_type=cl.device_type.GPU, units=16, clock=1500, double=False))
+    # An unknown clock frequency (reported as 0) does not cancel the score
+    assert device_score(fake_cl_device(clock=0)) > 0